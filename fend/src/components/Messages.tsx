@@ -65,6 +65,8 @@ type MessagesStateType = {
   selectedTypes: LogEventType[];
   selectedLevels: string[];
   paginationModel: GridPaginationModel;
+  // page -> next_cursor of the page before it, for the pages reached so far.
+  pageCursors: Record<number, number>;
   sortModel: GridSortModel;
   filterModel: GridFilterModel;
   detailData: Record<string, unknown> | null;
@@ -80,6 +82,7 @@ export default class Messages extends Component<MessagesPropsType, MessagesState
       selectedTypes: [],
       selectedLevels: [],
       paginationModel: {page: 0, pageSize: 25},
+      pageCursors: {},
       sortModel: [{field: 'timestamp', sort: 'desc'}],
       filterModel: {items: []},
       detailData: null,
@@ -118,9 +121,13 @@ export default class Messages extends Component<MessagesPropsType, MessagesState
      server-side: the grid only ever holds the current page's rows,
      everything else is a query param against /logs. */
   fetchMessages() {
-    const {paginationModel, sortModel, filterModel, selectedTypes, selectedLevels} = this.state;
+    const {paginationModel, pageCursors, sortModel, filterModel, selectedTypes, selectedLevels} = this.state;
+    const page = paginationModel.page;
     const params = new URLSearchParams();
-    params.set('start', String(paginationModel.page * paginationModel.pageSize));
+    params.set('start', String(page * paginationModel.pageSize));
+    // Going page by page, the next page picks up after the last row seen
+    // instead of having the server count off `start` rows.
+    if (pageCursors[page] !== undefined) params.set('cursor', String(pageCursors[page]));
     params.set('count', String(paginationModel.pageSize));
     params.set('sort', sortModel.length > 0 && sortModel[0].sort === 'asc' ? 'asc' : 'desc');
 
@@ -145,7 +152,9 @@ export default class Messages extends Component<MessagesPropsType, MessagesState
         message: log.message ?? '',
         data: log.data ?? undefined,
       }));
-      this.setState({entries: entries, total: res.total});
+      const cursors = {...this.state.pageCursors};
+      if (res.next_cursor !== undefined && res.next_cursor !== null) cursors[page + 1] = res.next_cursor;
+      this.setState({entries: entries, total: res.total, pageCursors: cursors});
     });
   }
 
@@ -178,27 +187,28 @@ export default class Messages extends Component<MessagesPropsType, MessagesState
   }
 
   handlePaginationModelChange(model: GridPaginationModel) {
-    this.setState({paginationModel: model}, () => this.fetchMessages());
+    const pageCursors = model.pageSize === this.state.paginationModel.pageSize ? this.state.pageCursors : {};
+    this.setState({paginationModel: model, pageCursors}, () => this.fetchMessages());
   }
 
   handleSortModelChange(model: GridSortModel) {
-    this.setState({sortModel: model}, () => this.fetchMessages());
+    this.setState({sortModel: model, pageCursors: {}}, () => this.fetchMessages());
   }
 
   handleFilterModelChange(model: GridFilterModel) {
-    this.setState({filterModel: model, paginationModel: {...this.state.paginationModel, page: 0}}, () => this.fetchMessages());
+    this.setState({filterModel: model, paginationModel: {...this.state.paginationModel, page: 0}, pageCursors: {}}, () => this.fetchMessages());
   }
 
   handleTypesChange(event: SelectChangeEvent<LogEventType[]>) {
     const value = event.target.value;
     const selectedTypes = (typeof value === 'string' ? value.split(',') : value) as LogEventType[];
-    this.setState({selectedTypes, paginationModel: {...this.state.paginationModel, page: 0}}, () => this.fetchMessages());
+    this.setState({selectedTypes, paginationModel: {...this.state.paginationModel, page: 0}, pageCursors: {}}, () => this.fetchMessages());
   }
 
   handleLevelsChange(event: SelectChangeEvent<string[]>) {
     const value = event.target.value;
     const selectedLevels = typeof value === 'string' ? value.split(',') : value;
-    this.setState({selectedLevels, paginationModel: {...this.state.paginationModel, page: 0}}, () => this.fetchMessages());
+    this.setState({selectedLevels, paginationModel: {...this.state.paginationModel, page: 0}, pageCursors: {}}, () => this.fetchMessages());
   }
 
   handleOpenDetail(data: Record<string, unknown>) {
@@ -16,6 +16,8 @@ export type LogEntry = components["schemas"]["LogEntry"];
 export type LogEventType = components["schemas"]["LogEventType"];
 export type LogsResponse = components["schemas"]["LogsResponse"];
 export type LogFacets = components["schemas"]["LogFacets"];
+export type LogStats = components["schemas"]["LogStats"];
+export type ProgressSeries = components["schemas"]["ProgressSeries"];
 
 // The backend's "DiskImageType" schema describes a restore-type *catalog*
 // entry (id/filestem/catalogDirectory/partition_plan/...) - unrelated to
@@ -65,6 +65,44 @@ export interface paths {
         patch?: never;
         trace?: never;
     };
+    "/logs/runs/{run}/progress": {
+        parameters: {
+            query?: never;
+            header?: never;
+            path?: never;
+            cookie?: never;
+        };
+        /**
+         * Route Logs Run Progress
+         * @description A run's progress over time, e.g. for a throughput graph. The runs are
+         *     the PLAN rows of /logs - run is the PLAN row's id.
+         */
+        get: operations["route_logs_run_progress"];
+        put?: never;
+        post?: never;
+        delete?: never;
+        options?: never;
+        head?: never;
+        patch?: never;
+        trace?: never;
+    };
+    "/logs/stats": {
+        parameters: {
+            query?: never;
+            header?: never;
+            path?: never;
+            cookie?: never;
+        };
+        /** Route Logs Stats */
+        get: operations["route_logs_stats"];
+        put?: never;
+        post?: never;
+        delete?: never;
+        options?: never;
+        head?: never;
+        patch?: never;
+        trace?: never;
+    };
     "/logs/facets": {
         parameters: {
             query?: never;
@@ -969,6 +1007,26 @@ export interface components {
             /** Sources */
             sources: string[];
         };
+        /**
+         * LogStats
+         * @description How the log store's writer keeps up. lag is how many seconds the
+         *     oldest row waiting has waited. dropped is rows dropped because too many
+         *     were waiting, by level (or by table, for rows without one).
+         */
+        LogStats: {
+            /** Waiting */
+            waiting: number;
+            /** Capacity */
+            capacity: number;
+            /** Lag */
+            lag: number;
+            /** Written */
+            written: number;
+            /** Dropped */
+            dropped: {
+                [key: string]: number;
+            };
+        };
         /**
          * LogMessageEvent
          * @description Payload for the 'message' socket event (UserMessages/ErrorMessages via
@@ -990,6 +1048,8 @@ export interface components {
             total: number;
             /** Logs */
             logs: components["schemas"]["LogEntry"][];
+            /** Next Cursor */
+            next_cursor?: number | null;
         };
         /** NetworkDeviceStatus */
         NetworkDeviceStatus: {
@@ -1030,6 +1090,11 @@ export interface components {
              * @default []
              */
             tasks: components["schemas"]["TaskStatus"][];
+            /**
+             * Delta
+             * @default false
+             */
+            delta: boolean;
         };
         /** OpticalDriveInfo */
         OpticalDriveInfo: {
@@ -1043,6 +1108,37 @@ export interface components {
             /** Opticaldrives */
             opticaldrives: components["schemas"]["OpticalDriveInfo"][];
         };
+        /**
+         * ProgressSample
+         * @description One step of a runner at one point in time.
+         */
+        ProgressSample: {
+            /** Timestamp */
+            timestamp: string;
+            /** Device */
+            device?: string | null;
+            /** Step */
+            step?: number | null;
+            /** Status */
+            status?: string | null;
+            /** Progress */
+            progress?: number | null;
+            /** Elapse */
+            elapse?: number | null;
+            /** Runtime */
+            runTime?: number | null;
+            /** Runestimate */
+            runEstimate?: number | null;
+            /** Bytes */
+            bytes?: number | null;
+        };
+        /** ProgressSeries */
+        ProgressSeries: {
+            /** Run */
+            run: number;
+            /** Samples */
+            samples: components["schemas"]["ProgressSample"][];
+        };
         /** RestoreTypesResponse */
         RestoreTypesResponse: {
             /** Restoretypes */
@@ -1085,6 +1181,8 @@ export interface components {
              * @default []
              */
             taskVerdict: string[];
+            /** Taskbytes */
+            taskBytes?: number | null;
         };
         /**
          * TriageUpdateEvent
@@ -1178,9 +1276,11 @@ export interface operations {
                 type?: components["schemas"]["LogEventType"][];
                 level?: string[];
                 source?: string[];
-                /** @description substring filter on message text */
+                /** @description substring filter on message and data text */
                 q?: string | null;
                 sort?: string;
+                /** @description next_cursor of the previous page; start is ignored */
+                cursor?: number | null;
             };
             header?: never;
             path?: never;
@@ -1208,6 +1308,57 @@ export interface operations {
             };
         };
     };
+    route_logs_run_progress: {
+        parameters: {
+            query?: never;
+            header?: never;
+            path: {
+                run: number;
+            };
+            cookie?: never;
+        };
+        requestBody?: never;
+        responses: {
+            /** @description Successful Response */
+            200: {
+                headers: {
+                    [name: string]: unknown;
+                };
+                content: {
+                    "application/json": components["schemas"]["ProgressSeries"];
+                };
+            };
+            /** @description Validation Error */
+            422: {
+                headers: {
+                    [name: string]: unknown;
+                };
+                content: {
+                    "application/json": components["schemas"]["HTTPValidationError"];
+                };
+            };
+        };
+    };
+    route_logs_stats: {
+        parameters: {
+            query?: never;
+            header?: never;
+            path?: never;
+            cookie?: never;
+        };
+        requestBody?: never;
+        responses: {
+            /** @description Successful Response */
+            200: {
+                headers: {
+                    [name: string]: unknown;
+                };
+                content: {
+                    "application/json": components["schemas"]["LogStats"];
+                };
+            };
+        };
+    };
     route_logs_facets: {
         parameters: {
             query?: never;
@@ -1594,6 +1745,8 @@ export interface operations {
                 restoretype: string;
                 /** @description Wipe request */
                 wipe_request?: string;
+                /** @description Load all disks from one read of the image */
+                batch?: boolean;
             };
             header?: never;
             path?: never;
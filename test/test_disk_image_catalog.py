@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from wce_triage.lib import disk_images
+from wce_triage.lib.disk_images import DiskImageCatalog, IMAGE_META_JSON_FILE
+
+
+class Test_disk_image_catalog(unittest.TestCase):
+  """The catalog index against a made-up wce-disk-images."""
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.addCleanup(self.tmpdir.cleanup)
+    self.images_dir = os.path.join(self.tmpdir.name, "wce-disk-images")
+    self.index_path = os.path.join(self.tmpdir.name, "index.json")
+    os.makedirs(self.images_dir)
+    # Long enough ago for the index to trust mtimes.
+    self.past = time.time() - 3600
+    self.add_catalog("wce-18", "wce-mate18")
+    self.add_catalog("wce-16", "wce-mate16")
+    self.add_image("wce-18", "a.ext4.partclone.gz")
+    self.add_image("wce-16", "b.ext4.partclone.zst")
+    self.settle()
+    patch = mock.patch.object(disk_images, "WCE_IMAGES", self.images_dir)
+    patch.start()
+    self.addCleanup(patch.stop)
+    self.use_catalog(DiskImageCatalog(index_path=self.index_path))
+    pass
+
+  def use_catalog(self, catalog):
+    self.catalog = catalog
+    patch = mock.patch.object(disk_images, "_catalog_", catalog)
+    patch.start()
+    self.addCleanup(patch.stop)
+    pass
+
+  def add_catalog(self, name, filestem):
+    os.makedirs(os.path.join(self.images_dir, name))
+    self.write_meta(name, {"id": name, "filestem": filestem})
+    pass
+
+  def write_meta(self, name, meta):
+    with open(os.path.join(self.images_dir, name, IMAGE_META_JSON_FILE), "w") as f:
+      json.dump(meta, f)
+      pass
+    pass
+
+  def add_image(self, name, filename):
+    with open(os.path.join(self.images_dir, name, filename), "w") as f:
+      f.write("FOO!")
+      pass
+    pass
+
+  def settle(self):
+    self.past += 1
+    for dirpath, dirnames, filenames in os.walk(self.images_dir):
+      for filename in filenames:
+        os.utime(os.path.join(dirpath, filename), (self.past, self.past))
+        pass
+      os.utime(dirpath, (self.past, self.past))
+      pass
+    pass
+
+  def image_names(self):
+    return [image["name"] for image in disk_images.get_disk_images()]
+
+  def test_unchanged_is_not_listed_again(self):
+    self.assertEqual(self.image_names(), ["b.ext4.partclone.zst", "a.ext4.partclone.gz"])
+    self.assertEqual(self.catalog.listdirs, 3)
+    self.assertEqual(sorted(t["id"] for t in disk_images.read_disk_image_types()), ["wce-16", "wce-18"])
+    self.assertEqual(self.catalog.listdirs, 3)
+    pass
+
+  def test_new_process_starts_from_saved_index(self):
+    images = disk_images.get_disk_images()
+    self.use_catalog(DiskImageCatalog(index_path=self.index_path))
+    self.assertEqual(disk_images.get_disk_images(), images)
+    self.assertEqual(self.catalog.listdirs, 0)
+    pass
+
+  def test_changes_are_seen(self):
+    self.image_names()
+    self.add_image("wce-18", "c.ext4.partclone.gz")
+    os.remove(os.path.join(self.images_dir, "wce-16", "b.ext4.partclone.zst"))
+    self.write_meta("wce-16", {"id": "wce-16", "filestem": "wce-mate16-new"})
+    with open(os.path.join(self.images_dir, ".list-order"), "w") as f:
+      f.write("wce-16\nwce-18\n")
+      pass
+    self.settle()
+    listdirs = self.catalog.listdirs
+    self.assertEqual(self.image_names(), ["c.ext4.partclone.gz", "a.ext4.partclone.gz"])
+    # The two catalogs and the top directory, for .list-order.
+    self.assertEqual(self.catalog.listdirs - listdirs, 3)
+    self.assertEqual([(t["id"], t["filestem"]) for t in disk_images.read_disk_image_types()],
+                     [("wce-16", "wce-mate16-new"), ("wce-18", "wce-mate18")])
+    pass
+
+  def test_recent_changes_are_looked_at_again(self):
+    self.image_names()
+    self.add_image("wce-18", "c.ext4.partclone.gz")
+    listdirs = self.catalog.listdirs
+    self.assertIn("c.ext4.partclone.gz", self.image_names())
+    self.image_names()
+    # wce-18 was modified just now - something may yet change in the same tick.
+    self.assertEqual(self.catalog.listdirs - listdirs, 2)
+    # And c.ext4.partclone.gz may still be being written.
+    with open(os.path.join(self.images_dir, "wce-18", "c.ext4.partclone.gz"), "a") as f:
+      f.write("BAR!")
+      pass
+    sizes = {image["name"]: image["size"] for image in disk_images.get_disk_images()}
+    self.assertEqual(sizes["c.ext4.partclone.gz"], 8)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -5,9 +5,10 @@ import subprocess
 import tempfile
 import shutil
 import os
+import json
 ROOTDIR=os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
 
-tlog = init_triage_logger(filename='/tmp/disk_images.log')
+tlog = get_triage_logger()
 
 disk = Disk(device_name="/dev/null")
 disk.byte_size = 64 * 2**30
@@ -16,8 +17,8 @@ class Test_DiskImages(unittest.TestCase):
 
   def setUp(self):
     self.test_dir = tempfile.mkdtemp()
-    cmd = ["rsync", "-a", os.path.join(ROOTDIR, "wce_triage/setup/share/wce/wce-disk-images"), self.test_dir]
-    subprocess.run(cmd)
+    shutil.copytree(os.path.join(ROOTDIR, "wce_triage/setup/share/wce/wce-disk-images"),
+                    os.path.join(self.test_dir, "wce-disk-images"))
     set_wce_disk_image_dir(os.path.join(self.test_dir, "wce-disk-images"))
 
     test1 = os.path.join(self.test_dir, "wce-disk-images", "wce-18", "test1.partclone.gz")
@@ -51,7 +52,10 @@ class Test_DiskImages(unittest.TestCase):
 
   def test_read_disk_image_types(self):
     image_types = read_disk_image_types()
-    expected = self.image_types
+    # With no .list-order, the catalogs come in the order the directory lists them.
+    entries = os.listdir(os.path.join(self.test_dir, "wce-disk-images"))
+    expected = sorted(self.image_types, key=lambda image_type: entries.index(image_type["id"]))
+    self.assertEqual(len(image_types), len(expected))
 
     index = 0
     for image_type in image_types:
@@ -82,12 +86,15 @@ class Test_DiskImages(unittest.TestCase):
 
   def test_get_disk_image(self):
     images = get_disk_images()
-    expected = [ {'mtime': '<wild>', 'restoreType': 'wce-18', 'name': 'test1.partclone.gz', 'fullpath': "<random>", 'size': 4, 'subdir': 'wce-18', 'index': 0},
-                 {'mtime': '<wild>', 'restoreType': 'wce-16', 'name': 'test2.partclone.gz', 'fullpath': "<random>", 'size': 4, 'subdir': 'wce-16', 'index': 1} ]
+    # Names in reverse order, with no .list-order to say otherwise.
+    expected = [ {'mtime': '<wild>', 'restoreType': 'wce-16', 'name': 'test2.partclone.gz', 'fullpath': "<random>", 'size': 4, 'subdir': 'wce-16', 'codec': 'gzip', 'index': 0},
+                 {'mtime': '<wild>', 'restoreType': 'wce-18', 'name': 'test1.partclone.gz', 'fullpath': "<random>", 'size': 4, 'subdir': 'wce-18', 'codec': 'gzip', 'index': 1} ]
+    self.assertEqual(len(images), len(expected))
     index = 0
     for image in images:
       self.assertEqual(image['name'], expected[index]["name"])
       self.assertEqual(image['restoreType'], expected[index]["restoreType"])
+      self.assertEqual(image['index'], expected[index]["index"])
       index += 1
       pass
     pass
@@ -96,13 +103,36 @@ class Test_DiskImages(unittest.TestCase):
     self.assertEqual(get_file_system_from_source("a.ext4.partclone.gz"), "ext4")
     self.assertEqual(get_file_system_from_source("a.ext4.partclone"), None)
     self.assertEqual(get_file_system_from_source("a.partclone.gz"), None)
+    self.assertEqual(get_file_system_from_source("a.ext4.partclone.zst"), "ext4")
+    pass
+
+  def test_zstd_catalog(self):
+    catalog_dir = os.path.join(self.test_dir, "wce-disk-images", "wce-18")
+    with open(os.path.join(catalog_dir, IMAGE_META_JSON_FILE)) as meta_file:
+      image_meta = json.load(meta_file)
+      pass
+    image_meta["compression"] = {"codec": "zstd", "level": 19}
+    with open(os.path.join(catalog_dir, IMAGE_META_JSON_FILE), "w") as meta_file:
+      json.dump(image_meta, meta_file)
+      pass
+    self.assertEqual(get_image_compression(read_disk_image_type(catalog_dir)), {"codec": "zstd", "level": 19, "long": DEFAULT_ZSTD_LONG})
+    self.assertTrue(make_disk_image_name(catalog_dir, None).endswith(".ext4.partclone.zst"))
+
+    with open(os.path.join(catalog_dir, "test3.ext4.partclone.zst"), "w") as test_fd:
+      test_fd.write("FOO!")
+      pass
+    codecs = {image["name"]: image["codec"] for image in get_disk_images()}
+    self.assertEqual(codecs["test3.ext4.partclone.zst"], "zstd")
+    self.assertEqual(codecs["test1.partclone.gz"], "gzip")
     pass
 
   def test_translate_disk_image_path(self):
-    expected = [ {'fullpath': 'http://10.3.2.1:8080/wce/wce-disk-images/wce-18/test1.partclone.gz'},
-                 {'fullpath': 'http://10.3.2.1:8080/wce/wce-disk-images/wce-16/test2.partclone.gz'} ]
+    expected = [ {'fullpath': 'http://10.3.2.1:8080/wce/wce-disk-images/wce-16/test2.partclone.gz'},
+                 {'fullpath': 'http://10.3.2.1:8080/wce/wce-disk-images/wce-18/test1.partclone.gz'} ]
+    disk_images = get_disk_images()
+    self.assertEqual(len(disk_images), len(expected))
     index = 0
-    for disk_image in get_disk_images():
+    for disk_image in disk_images:
       self.assertEqual(expected[index]['fullpath'], translate_disk_image_name_to_url("http://10.3.2.1:8080/wce", disk_image["name"])['fullpath'])
       index += 1
       pass
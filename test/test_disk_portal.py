@@ -0,0 +1,143 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from wce_triage.components import disk as disk_module
+from wce_triage.components.disk import DiskPortal, Nvme
+
+
+class Test_disk_portal(unittest.TestCase):
+  """DiskPortal against a made-up /sys and /run/udev/data."""
+
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.sysfs = os.path.join(self.tmpdir.name, "sys")
+    self.udev_data = os.path.join(self.tmpdir.name, "udev")
+    os.makedirs(os.path.join(self.sysfs, "block"))
+    os.makedirs(self.udev_data)
+    patches = [mock.patch.object(disk_module, "SYSFS_ROOT", self.sysfs),
+               mock.patch.object(disk_module, "UDEV_DATA_DIR", self.udev_data)]
+    for patch in patches:
+      patch.start()
+      self.addCleanup(patch.stop)
+      pass
+    self.addCleanup(self.tmpdir.cleanup)
+    self.reads = 0
+    read_device_properties = disk_module._read_device_properties
+    def counting_read(name, devnum):
+      self.reads += 1
+      return read_device_properties(name, devnum)
+    patch = mock.patch.object(disk_module, "_read_device_properties", counting_read)
+    patch.start()
+    self.addCleanup(patch.stop)
+    pass
+
+  def add_disk(self, name, devnum, model="", sectors=1000, udev=True):
+    device_dir = os.path.join(self.sysfs, "devices", "pci0000:00", name)
+    os.makedirs(os.path.join(device_dir, "device"))
+    for attribute, value in [("dev", devnum), ("size", str(sectors)),
+                             ("device/model", model), ("device/serial", model + "-serial")]:
+      with open(os.path.join(device_dir, attribute), "w") as f:
+        f.write(value + "\n")
+        pass
+      pass
+    os.symlink(device_dir, os.path.join(self.sysfs, "block", name))
+    if udev and not name.startswith("nvme"):
+      self.add_udev_data(devnum, model)
+      pass
+    pass
+
+  def add_udev_data(self, devnum, model):
+    with open(os.path.join(self.udev_data, "b" + devnum), "w") as f:
+      f.write("S:disk/by-id/ata-%s\nE:ID_BUS=ata\nE:ID_MODEL=%s\nE:ID_SERIAL=%s_1234\n" % (model, model, model))
+      pass
+    pass
+
+  def remove_disk(self, name):
+    os.unlink(os.path.join(self.sysfs, "block", name))
+    pass
+
+  def device_names(self, portal):
+    return [disk.device_name for disk in portal.disks]
+
+  def test_detects_disks(self):
+    self.add_disk("sdq", "65:0", model="Q")
+    self.add_disk("sda", "8:0", model="A", sectors=2000)
+    self.add_disk("nvme0n1", "259:0", model="N")
+    self.add_disk("sda1", "8:1")
+    portal = DiskPortal(live_system=True)
+    # sdq is past the 16 disks of major 8.
+    self.assertEqual(self.device_names(portal), ["/dev/sda", "/dev/sdq", "/dev/nvme0n1"])
+    sda = portal.find_disk_by_device_name("/dev/sda")
+    self.assertEqual((sda.devnum, sda.model_name, sda.serial_no, sda.byte_size), ("8:0", "A", "A_1234", 1024000))
+    self.assertEqual(sda.bus_type, disk_module.BusType.ATA)
+    nvme = portal.find_disk_by_device_name("/dev/nvme0n1")
+    self.assertIsInstance(nvme, Nvme)
+    self.assertEqual((nvme.model_name, nvme.serial_no, nvme.byte_size), ("N", "N-serial", 512000))
+    pass
+
+  def test_known_disks_are_not_read_again(self):
+    self.add_disk("sda", "8:0", model="A")
+    portal = DiskPortal(live_system=True)
+    sda = portal.disks[0]
+    reads = self.reads
+    self.assertEqual(portal.detect_disks(), ([], [], []))
+    self.assertIs(portal.disks[0], sda)
+    self.assertEqual(self.reads, reads)
+    pass
+
+  def test_added_and_removed(self):
+    self.add_disk("sda", "8:0", model="A")
+    portal = DiskPortal(live_system=True)
+    sda = portal.disks[0]
+    self.add_disk("sdb", "8:16", model="B")
+    added, updated, removed = portal.detect_disks()
+    self.assertEqual([disk.device_name for disk in added], ["/dev/sdb"])
+    self.assertEqual((updated, removed), ([], []))
+    self.remove_disk("sda")
+    added, updated, removed = portal.detect_disks()
+    self.assertEqual((added, updated, removed), ([], [], [sda]))
+    self.assertEqual(self.device_names(portal), ["/dev/sdb"])
+    self.assertIsNone(portal.find_disk_by_device_name("/dev/sda"))
+    pass
+
+  def test_changed_disk_is_detected_again(self):
+    self.add_disk("sda", "8:0", model="A")
+    portal = DiskPortal(live_system=True)
+    sda = portal.disks[0]
+    portal.note_uevent("change", "8:0")
+    # Not a disk the portal knows.
+    portal.note_uevent("change", "8:16")
+    added, updated, removed = portal.detect_disks()
+    self.assertEqual(removed, [sda])
+    self.assertEqual(len(added), 1)
+    self.assertIsNot(added[0], sda)
+    self.assertEqual(added[0].device_name, "/dev/sda")
+    pass
+
+  def test_disk_waits_for_udev(self):
+    self.add_disk("sda", "8:0", model="A", udev=False)
+    portal = DiskPortal(live_system=True)
+    # The kernel's uevent came before udev's rules ran.
+    self.assertEqual(portal.disks, [])
+    self.add_udev_data("8:0", "A")
+    added, updated, removed = portal.detect_disks()
+    self.assertEqual([disk.device_name for disk in added], ["/dev/sda"])
+    self.assertEqual(added[0].bus_type, disk_module.BusType.ATA)
+    pass
+
+  def test_disk_udev_never_heard_of(self):
+    self.add_disk("sda", "8:0", model="A", udev=False)
+    portal = DiskPortal(live_system=True)
+    with mock.patch.object(disk_module, "UDEV_SETTLE_SECONDS", 0):
+      portal.detect_disks()
+      pass
+    self.assertEqual(self.device_names(portal), ["/dev/sda"])
+    self.assertEqual(portal.disks[0].model_name, "A")
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,67 @@
+import copy
+import threading
+import unittest
+
+from wce_triage.api.emitter import EmitQueue
+
+
+class Test_emit_queue(unittest.TestCase):
+
+  def test_latest_snapshot_per_event(self):
+    emit_queue = EmitQueue()
+    for i in range(100):
+      emit_queue.put(("loadimage", {"runTime": i}))
+      emit_queue.put(("zerowipe", {"runTime": i}))
+      pass
+    self.assertEqual(emit_queue.qsize(), 2)
+    self.assertEqual(emit_queue.get_batch(), [("loadimage", {"runTime": 99}), ("zerowipe", {"runTime": 99})])
+    metrics = emit_queue.metrics()
+    self.assertEqual(metrics.put, 200)
+    self.assertEqual(metrics.coalesced, 198)
+    self.assertEqual(metrics.emitted, 2)
+    self.assertEqual(metrics.depth, 0)
+    pass
+
+  def test_messages_stay_in_order(self):
+    emit_queue = EmitQueue(max_ordered=5)
+    for i in range(8):
+      emit_queue.put(("message", {"message": str(i)}))
+      emit_queue.put(("loadimage", {"runTime": i}))
+      pass
+    batch = emit_queue.get_batch()
+    self.assertEqual([message["message"] for event, message in batch if event == "message"], ["3", "4", "5", "6", "7"])
+    self.assertEqual(batch[-1], ("loadimage", {"runTime": 7}))
+    self.assertEqual(emit_queue.metrics().dropped, 3)
+    pass
+
+  def test_messages_are_not_changed(self):
+    # send_to_ui() hands the same dicts to the log store, which only turns
+    # them into JSON later.
+    emit_queue = EmitQueue()
+    sent = [("message", {"message": "hello", "severity": 1, "_sequence_": 1}),
+            ("loadimage", {"report": "tasks", "tasks": [{"step": 0}], "_sequence_": 2}),
+            ("loadimage", {"report": "task_progress", "tasks": [{"step": 1}], "_sequence_": 3})]
+    originals = copy.deepcopy(sent)
+    for item in sent:
+      emit_queue.put(item)
+      pass
+    batch = emit_queue.get_batch()
+    self.assertEqual(sent, originals)
+    for event, message in batch:
+      self.assertTrue(any(message is item[1] for item in sent))
+      pass
+    pass
+
+  def test_get_batch_waits(self):
+    emit_queue = EmitQueue()
+    self.assertEqual(emit_queue.get_batch(timeout=0.01), [])
+    timer = threading.Timer(0.05, emit_queue.put, args=[("disks", {"disks": []})])
+    timer.start()
+    self.assertEqual(emit_queue.get_batch(timeout=5), [("disks", {"disks": []})])
+    timer.join()
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
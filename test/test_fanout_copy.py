@@ -0,0 +1,189 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from wce_triage.bin.fanout_copy import SharedRing, writer, WRITER_DETACHED, WRITER_DONE, WRITER_FAILED, WRITER_RUNNING
+from wce_triage.lib.verify import new_hash
+
+
+class Test_fanout_copy(unittest.TestCase):
+  """Runs bin/fanout_copy.py end to end against plain files - the writer
+  processes and the shared-memory ring only exist in a real run."""
+
+  def setUp(self):
+    self.tempdir = tempfile.TemporaryDirectory()
+    self.source = os.path.join(self.tempdir.name, "source")
+    # Not a multiple of the 32MiB copy buffer, so the last chunk is short.
+    self.payload = os.urandom(2**20) * 70 + b"tail"
+    with open(self.source, "wb") as source:
+      source.write(self.payload)
+      pass
+    pass
+
+  def tearDown(self):
+    self.tempdir.cleanup()
+    pass
+
+  def run_fanout(self, *destinations, options=()):
+    argv = [sys.executable, "-m", "wce_triage.bin.fanout_copy"] + list(options) + [self.source] + list(destinations)
+    result = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
+    reports = {}
+    for line in result.stderr.decode("utf-8").splitlines():
+      if line.strip():
+        message = json.loads(line)["message"]
+        reports[message["key"]] = message
+        pass
+      pass
+    return result, reports
+
+  def test_copy_to_every_destination(self):
+    dests = [os.path.join(self.tempdir.name, "dest%d" % idx) for idx in range(3)]
+    result, reports = self.run_fanout(*["d%d:%s" % (idx, dest) for idx, dest in enumerate(dests)])
+    self.assertEqual(result.returncode, 0)
+    for idx, dest in enumerate(dests):
+      with open(dest, "rb") as copied:
+        self.assertEqual(copied.read(), self.payload)
+        pass
+      self.assertEqual(reports["d%d" % idx]["runStatus"], "Success")
+      self.assertEqual(reports["d%d" % idx]["progress"], 100)
+      pass
+    pass
+
+  def test_failed_destination_does_not_stop_others(self):
+    good = os.path.join(self.tempdir.name, "good")
+    bad = os.path.join(self.tempdir.name, "no-such-dir", "bad")
+    result, reports = self.run_fanout("good:" + good, "bad:" + bad)
+    with open(good, "rb") as copied:
+      self.assertEqual(copied.read(), self.payload)
+      pass
+    self.assertEqual(reports["good"]["runStatus"], "Success")
+    self.assertEqual(reports["bad"]["runStatus"], "Failed")
+    self.assertEqual(reports["bad"]["progress"], 999)
+    pass
+
+  def test_small_lag_window(self):
+    dests = [os.path.join(self.tempdir.name, "dest%d" % idx) for idx in range(2)]
+    result, reports = self.run_fanout(*["d%d:%s" % (idx, dest) for idx, dest in enumerate(dests)], options=["-k", "1"])
+    self.assertEqual(result.returncode, 0)
+    for dest in dests:
+      with open(dest, "rb") as copied:
+        self.assertEqual(copied.read(), self.payload)
+        pass
+      pass
+    pass
+
+  def test_verify(self):
+    dests = [os.path.join(self.tempdir.name, "dest%d" % idx) for idx in range(2)]
+    result, reports = self.run_fanout(*["d%d:%s" % (idx, dest) for idx, dest in enumerate(dests)], options=["-v"])
+    self.assertEqual(result.returncode, 0)
+    for idx in range(2):
+      self.assertEqual(reports["d%d" % idx]["runStatus"], "Success")
+      self.assertEqual(reports["d%d" % idx]["verdict"], "Verified")
+      pass
+    pass
+  pass
+
+
+class Test_shared_ring(unittest.TestCase):
+
+  def setUp(self):
+    self.ring = SharedRing(2, 2, 4096)
+    pass
+
+  def tearDown(self):
+    self.ring.release()
+    pass
+
+  def test_slow_writer_detaches_past_lag_window(self):
+    ring = self.ring
+    # Ring holds lag_window + 1 chunks, all unread by writer 1.
+    for chunk in range(3):
+      self.assertTrue(ring.wait_for_free_slot(timeout=0))
+      ring.publish(4096)
+      pass
+    self.assertFalse(ring.wait_for_free_slot(timeout=0))
+
+    for chunk in range(3):
+      self.assertEqual(ring.next_chunk(0), (chunk, 4096))
+      ring.chunk_written(0, 4096)
+      pass
+
+    # Writer 1 is 3 chunks behind writer 0 - it has to go on its own.
+    self.assertEqual(ring.next_chunk(1), WRITER_DETACHED)
+    self.assertEqual(ring.states[1], WRITER_DETACHED)
+    self.assertEqual(ring.states[0], WRITER_RUNNING)
+    # and no longer holds the slots.
+    self.assertTrue(ring.wait_for_free_slot(timeout=0))
+    pass
+
+  def test_detached_writer_copies_from_source(self):
+    ring = self.ring
+    with tempfile.TemporaryDirectory() as tempdir:
+      source = os.path.join(tempdir, "source")
+      payload = os.urandom(4096 * 5 + 7)
+      with open(source, "wb") as source_file:
+        source_file.write(payload)
+        pass
+      for chunk in range(3):
+        ring.publish(4096)
+        self.assertEqual(ring.next_chunk(0), (chunk, 4096))
+        ring.chunk_written(0, 4096)
+        pass
+
+      dest = os.path.join(tempdir, "dest")
+      writer(1, "slow", dest, ring, source, len(payload))
+      with open(dest, "rb") as copied:
+        self.assertEqual(copied.read(), payload)
+        pass
+      self.assertEqual(ring.states[1], WRITER_DONE)
+      self.assertEqual(ring.written[1], len(payload))
+      pass
+    pass
+
+  def test_verify_catches_wrong_source_digest(self):
+    ring = self.ring
+    with tempfile.TemporaryDirectory() as tempdir:
+      source = os.path.join(tempdir, "source")
+      payload = os.urandom(4096 * 2)
+      with open(source, "wb") as source_file:
+        source_file.write(payload)
+        pass
+      hasher = new_hash()
+      hasher.update(b"something else")
+      ring.publish(4096)
+      ring.publish(4096)
+      ring.close_stream(digest=hasher.digest())
+
+      dest = os.path.join(tempdir, "dest")
+      writer(0, "dest", dest, ring, source, len(payload), verify=True)
+      self.assertEqual(ring.states[0], WRITER_FAILED)
+      self.assertEqual(ring.verify_failed[0], 1)
+      self.assertEqual(ring.verified[0], len(payload))
+      pass
+    pass
+
+  def test_writers_within_window_stay_attached(self):
+    ring = self.ring
+    ring.publish(4096)
+    ring.publish(100)
+    self.assertEqual(ring.next_chunk(0), (0, 4096))
+    ring.chunk_written(0, 4096)
+    self.assertEqual(ring.next_chunk(1), (0, 4096))
+    ring.chunk_written(1, 4096)
+    self.assertEqual(ring.next_chunk(1), (1, 100))
+    ring.chunk_written(1, 100)
+    ring.close_stream()
+    self.assertEqual(ring.next_chunk(0), (1, 100))
+    ring.chunk_written(0, 100)
+    self.assertIsNone(ring.next_chunk(0))
+    self.assertIsNone(ring.next_chunk(1))
+    self.assertEqual(list(ring.written), [4196, 4196])
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,121 @@
+import io
+import os
+import tempfile
+import unittest
+
+from wce_triage.components.disk import Partition
+from wce_triage.lib.fs_extents import parse_dumpe2fs_output, used_extents_from_free_ranges, disk_used_extents, merge_extents, SWAP_HEADER_SIZE
+from wce_triage.bin.binarycopy import binary_copy
+
+dumpe2fs_output = """Filesystem volume name:   <none>
+Block count:              4096
+Free blocks:              3000
+Block size:               4096
+
+Group 0: (Blocks 0-2047) csum 0x1234 [ITABLE_ZEROED]
+  Primary superblock at 0, Group descriptors at 1-1
+  1000 free blocks, 2037 free inodes, 2 directories, 2037 unused inodes
+  Free blocks: 100-1099
+  Free inodes: 12-2048
+Group 1: (Blocks 2048-4095) csum 0x5678 [INODE_UNINIT, ITABLE_ZEROED]
+  2000 free blocks, 2048 free inodes, 0 directories, 2048 unused inodes
+  Free blocks: 2048-2048, 2050-4095
+  Free inodes: 2049-4096
+"""
+
+
+class Test_fs_extents(unittest.TestCase):
+
+  def test_parse_dumpe2fs_output(self):
+    block_size, block_count, free_ranges = parse_dumpe2fs_output(dumpe2fs_output)
+    self.assertEqual(block_size, 4096)
+    self.assertEqual(block_count, 4096)
+    self.assertEqual(free_ranges, [(100, 1099), (2048, 2048), (2050, 4095)])
+    pass
+
+  def test_used_extents_are_the_gaps_between_free_ranges(self):
+    extents = used_extents_from_free_ranges(*parse_dumpe2fs_output(dumpe2fs_output))
+    self.assertEqual(extents, [(0, 100 * 4096), (1100 * 4096, 948 * 4096), (2049 * 4096, 4096)])
+    pass
+
+  def test_merge_extents(self):
+    self.assertEqual(merge_extents([(100, 10), (0, 50), (50, 10), (105, 20), (200, 0)]),
+                     [(0, 60), (100, 25)])
+    pass
+
+  def test_disk_used_extents(self):
+    parts = [Partition(device_name="/dev/sdz1", file_system="ext4", start_sector=2048, end_sector=4095),
+             Partition(device_name="/dev/sdz2", file_system="linux-swap(v1)", start_sector=4096, end_sector=8191),
+             Partition(device_name="/dev/sdz3", file_system="fat32", start_sector=8192, end_sector=9215)]
+    used = {"/dev/sdz1": [(0, 4096), (65536, 4096)]}
+    extents = disk_used_extents(parts, 9216 * 512 + 4096, used_extents=lambda device_name: used[device_name])
+    self.assertEqual(extents, [
+      # Partition table and the gap up to the first partition, with the first block of sdz1.
+      (0, 2048 * 512 + 4096),
+      (2048 * 512 + 65536, 4096),
+      (4096 * 512, SWAP_HEADER_SIZE),
+      # The vfat partition is copied whole, and so is what follows the last partition.
+      (8192 * 512, 1024 * 512 + 4096)])
+    pass
+
+  def test_unreadable_ext_partition_is_copied_whole(self):
+    def used_extents(device_name):
+      raise Exception("dumpe2fs failed")
+    parts = [Partition(device_name="/dev/sdz1", file_system="ext4", start_sector=2048, end_sector=4095)]
+    self.assertEqual(disk_used_extents(parts, 4096 * 512, used_extents=used_extents), [(0, 4096 * 512)])
+    pass
+  pass
+
+
+class Test_sparse_binary_copy(unittest.TestCase):
+
+  def test_only_extents_are_copied(self):
+    with tempfile.TemporaryDirectory() as tempdir:
+      payload = os.urandom(2**22 * 2 + 1000)
+      source = os.path.join(tempdir, "source")
+      with open(source, "wb") as source_file:
+        source_file.write(payload)
+        pass
+      dest = os.path.join(tempdir, "dest")
+      extents = [(0, 1000), (2**22 - 10, 2**22 + 20), (len(payload) - 100, 100)]
+      with io.FileIO(source) as source_file:
+        failed = binary_copy(source_file, len(payload), [dest], output=io.StringIO(), verify=True, extents=extents)
+        pass
+      self.assertEqual(failed, [])
+
+      with open(dest, "rb") as copied:
+        data = copied.read()
+        pass
+      self.assertEqual(len(data), len(payload))
+      expected = bytearray(len(payload))
+      for offset, length in extents:
+        expected[offset:offset + length] = payload[offset:offset + length]
+        pass
+      self.assertEqual(data, bytes(expected))
+      pass
+    pass
+
+  def test_unaligned_tail_is_copied(self):
+    # The destination is O_DIRECT where the file system does it, which
+    # doesn't take the last 1000 bytes.
+    with tempfile.TemporaryDirectory() as tempdir:
+      payload = os.urandom(2**22 * 2 + 1000)
+      source = os.path.join(tempdir, "source")
+      with open(source, "wb") as source_file:
+        source_file.write(payload)
+        pass
+      dest = os.path.join(tempdir, "dest")
+      with io.FileIO(source) as source_file:
+        failed = binary_copy(source_file, len(payload), [dest], output=io.StringIO(), verify=True)
+        pass
+      self.assertEqual(failed, [])
+      with open(dest, "rb") as copied:
+        self.assertEqual(copied.read(), payload)
+        pass
+      pass
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+from wce_triage.lib.io_tuner import WriteSizeTuner
+
+
+class FakeDevice:
+  """Device whose write takes fixed overhead + bytes / bandwidth, driven
+  off a fake clock so the test doesn't depend on real disks."""
+
+  def __init__(self, overhead, bandwidth):
+    self.now = 0.0
+    self.overhead = overhead
+    self.bandwidth = bandwidth
+    pass
+
+  def clock(self):
+    return self.now
+
+  def write(self, nbytes):
+    self.now += self.overhead + nbytes / self.bandwidth
+    pass
+  pass
+
+
+class Test_write_size_tuner(unittest.TestCase):
+
+  def drive(self, tuner, device, limit=100000):
+    for _ in range(limit):
+      if tuner.locked:
+        return
+      size = tuner.next_size()
+      started = tuner.start()
+      device.write(size)
+      tuner.record(size, started)
+      pass
+    self.fail("tuner never locked in a size")
+    pass
+
+  def test_probes_every_candidate_in_order(self):
+    device = FakeDevice(0.001, 100 * 2**20)
+    tuner = WriteSizeTuner(candidates=[2**20, 2**16], probe_seconds=0.1, clock=device.clock)
+    self.assertEqual(tuner.next_size(), 2**16)
+    self.drive(tuner, device)
+    self.assertEqual(sorted(tuner.throughputs.keys()), [2**16, 2**20])
+    pass
+
+  def test_per_write_overhead_favors_big_writes(self):
+    device = FakeDevice(0.005, 100 * 2**20)
+    tuner = WriteSizeTuner(candidates=[2**16, 2**20, 2**22], probe_seconds=0.2, clock=device.clock)
+    self.drive(tuner, device)
+    self.assertEqual(tuner.best_size, 2**22)
+    self.assertEqual(tuner.next_size(), 2**22)
+    pass
+
+  def test_size_that_degrades_loses(self):
+    # Throughput falls off a cliff past 1MB, e.g. a USB stick's erase block.
+    class CliffDevice(FakeDevice):
+      def write(self, nbytes):
+        bandwidth = self.bandwidth if nbytes <= 2**20 else self.bandwidth / 4
+        self.now += self.overhead + nbytes / bandwidth
+        pass
+      pass
+    device = CliffDevice(0.0001, 20 * 2**20)
+    tuner = WriteSizeTuner(candidates=[2**18, 2**20, 2**22], probe_seconds=0.5, clock=device.clock)
+    self.drive(tuner, device)
+    self.assertEqual(tuner.best_size, 2**20)
+    pass
+
+  def test_fast_device_is_probed_by_bytes(self):
+    device = FakeDevice(0, 10 * 2**30)
+    tuner = WriteSizeTuner(candidates=[2**20], probe_seconds=10, probe_bytes=8 * 2**20, clock=device.clock)
+    for _ in range(8):
+      self.assertFalse(tuner.locked)
+      started = tuner.start()
+      device.write(2**20)
+      tuner.record(2**20, started)
+      pass
+    self.assertTrue(tuner.locked)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,16 +1,19 @@
+import glob
 import logging
 import os
+import sqlite3
 import tempfile
 import threading
 import time
 import unittest
+from unittest import mock
 
-from wce_triage.lib.log_store import LogEventType, LogStore, install_sqlite_log_handler
+from wce_triage.lib.log_store import LogEventType, LogStore, ProgressRecorder, install_sqlite_log_handler
 
 
 def _cleanup_db_files(path):
-  for ext in ("", "-wal", "-shm"):
-    candidate = path + ext
+  # The segments, path.000001 and on, and their -wal/-shm.
+  for candidate in [path] + glob.glob(glob.escape(path) + ".*"):
     if os.path.exists(candidate):
       os.unlink(candidate)
       pass
@@ -137,6 +140,55 @@ class Test_log_store(unittest.TestCase):
     self.assertEqual([r["message"] for r in rows], ["line 3", "line 4", "line 5", "line 6"])
     pass
 
+  def test_cursor_pages(self):
+    for i in range(10):
+      self.store.log(LogEventType.LOG, "line %d" % i)
+      pass
+    self.assertTrue(self._wait_for(lambda: self.store.query()[1] == 10))
+
+    seen = []
+    cursor = None
+    while True:
+      rows, total = self.store.query(count=4, cursor=cursor)
+      self.assertEqual(total, 10)
+      seen.extend(r["message"] for r in rows)
+      if len(rows) < 4:
+        break
+      cursor = rows[-1]["id"]
+      pass
+    self.assertEqual(seen, ["line %d" % i for i in range(9, -1, -1)])
+
+    rows, _ = self.store.query(count=3, cursor=rows[0]["id"], sort_desc=False)
+    self.assertEqual([r["message"] for r in rows], ["line 2", "line 3", "line 4"])
+    pass
+
+  def test_search_message_and_data(self):
+    self.store.log(LogEventType.LOG, "Restore volume finished")
+    self.store.log(LogEventType.COMMAND_START, "Start process", data={"argv": ["partclone.ext4", "-r"]})
+    self.store.log(LogEventType.LOG, "nothing to see")
+    self.assertTrue(self._wait_for(lambda: self.store.query()[1] == 3))
+
+    # Substrings, either case, as LIKE did.
+    rows, total = self.store.query(q="STORE vol")
+    self.assertEqual((total, rows[0]["message"]), (1, "Restore volume finished"))
+    rows, total = self.store.query(q="partclone")
+    self.assertEqual((total, rows[0]["type"]), (1, "COMMAND_START"))
+    # Too short for the full-text index.
+    rows, total = self.store.query(q="no")
+    self.assertEqual((total, rows[0]["message"]), (1, "nothing to see"))
+    pass
+
+  def test_total_follows_new_rows(self):
+    for i in range(5):
+      self.store.log(LogEventType.ERROR if i % 2 else LogEventType.LOG, "line %d" % i)
+      pass
+    self.assertTrue(self._wait_for(lambda: self.store.query()[1] == 5))
+    self.assertEqual(self.store.query(event_types=[LogEventType.ERROR])[1], 2)
+    self.store.log(LogEventType.ERROR, "one more")
+    self.assertTrue(self._wait_for(lambda: self.store.query()[1] == 6))
+    self.assertEqual(self.store.query(event_types=[LogEventType.ERROR])[1], 3)
+    pass
+
   def test_concurrent_writes_and_reads_do_not_error(self):
     errors = []
     stop = threading.Event()
@@ -166,8 +218,9 @@ class Test_log_store(unittest.TestCase):
     pass
 
   def test_pruning_keeps_size_bounded_and_recent_rows(self):
-    # Tiny cap forces pruning well before 500 rows accumulate.
-    small_store = LogStore(db_path=tempfile.mktemp(suffix=".db"), max_bytes=20 * 1024)
+    # Tiny cap forces pruning well before 500 rows accumulate. Segments of
+    # 100 rows at most, as whole segments are what goes.
+    small_store = LogStore(db_path=tempfile.mktemp(suffix=".db"), max_bytes=20 * 1024, segment_rows=100)
     try:
       for i in range(500):
         small_store.log(LogEventType.LOG, "line %d" % i, source="pruning-test")
@@ -182,6 +235,8 @@ class Test_log_store(unittest.TestCase):
 
       rows, total = small_store.query(count=1000, sort_desc=False)
       self.assertLess(total, 500)
+      # The remembered count started over after the prune.
+      self.assertEqual(total, len(rows))
       # Oldest surviving row should be newer than "line 0" - confirms the
       # deletion targeted the oldest rows, not an arbitrary subset.
       self.assertNotEqual(rows[0]["message"], "line 0")
@@ -194,6 +249,134 @@ class Test_log_store(unittest.TestCase):
       pass
     pass
 
+  def test_pages_across_segments(self):
+    store = LogStore(db_path=tempfile.mktemp(suffix=".db"), segment_rows=4)
+    try:
+      for i in range(10):
+        store.log(LogEventType.ERROR if i % 3 == 0 else LogEventType.LOG, "line %d" % i)
+        pass
+      self.assertTrue(self._wait_for(lambda: store.query()[1] == 10))
+      self.assertEqual(len(glob.glob(glob.escape(store.db_path) + ".[0-9]*[0-9]")), 3)
+
+      rows, total = store.query(start=3, count=4, sort_desc=False)
+      self.assertEqual([r["message"] for r in rows], ["line 3", "line 4", "line 5", "line 6"])
+      rows, total = store.query(start=2, count=5)
+      self.assertEqual([r["message"] for r in rows], ["line 7", "line 6", "line 5", "line 4", "line 3"])
+      rows, total = store.query(count=3, cursor=rows[-1]["id"])
+      self.assertEqual([r["message"] for r in rows], ["line 2", "line 1", "line 0"])
+      rows, total = store.query(event_types=[LogEventType.ERROR])
+      self.assertEqual((total, [r["message"] for r in rows]), (4, ["line 9", "line 6", "line 3", "line 0"]))
+    finally:
+      store.close()
+      _cleanup_db_files(store.db_path)
+      pass
+    pass
+
+  def test_reopen_carries_on(self):
+    self.store.log(LogEventType.LOG, "before")
+    self.assertTrue(self._wait_for(lambda: self.store.query()[1] == 1))
+    self.store.close()
+    self.store = LogStore(db_path=self.db_path)
+    self.store.log(LogEventType.LOG, "after")
+    self.assertTrue(self._wait_for(lambda: self.store.query()[1] == 2))
+    rows, _ = self.store.query()
+    self.assertEqual([r["message"] for r in rows], ["after", "before"])
+    self.assertGreater(rows[0]["id"], rows[1]["id"])
+    pass
+
+  def test_single_file_log_becomes_first_segment(self):
+    db_path = tempfile.mktemp(suffix=".db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE event_log (id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, "
+                 "type TEXT NOT NULL, level TEXT, source TEXT, message TEXT, data TEXT)")
+    conn.execute("INSERT INTO event_log (timestamp, type, message) VALUES ('2026-01-01T00:00:00', 'LOG', 'old line')")
+    conn.commit()
+    conn.close()
+    store = LogStore(db_path=db_path)
+    try:
+      store.log(LogEventType.LOG, "new line")
+      self.assertTrue(self._wait_for(lambda: store.query()[1] == 2))
+      rows, _ = store.query(q="line")
+      self.assertEqual([r["message"] for r in rows], ["new line", "old line"])
+      self.assertFalse(os.path.exists(db_path))
+      # Not indexed at startup - q goes through LIKE there, even reopened.
+      self.assertFalse(store._segments[0].fts)
+      store.close()
+      store = LogStore(db_path=db_path)
+      self.assertFalse(store._segments[0].fts)
+      rows, total = store.query(q="old line")
+      self.assertEqual((total, rows[0]["message"]), (1, "old line"))
+    finally:
+      store.close()
+      _cleanup_db_files(db_path)
+      pass
+    pass
+
+  def test_progress_samples(self):
+    recorder = ProgressRecorder(interval=60, store=self.store)
+
+    def report(kind, run_status, tasks, step=None):
+      return {"report": kind, "device": "/dev/sdb", "runStatus": run_status, "runMessage": kind,
+              "runTime": 10, "runEstimate": 100, "step": step, "tasks": tasks}
+
+    def task(step, status, progress, bytes_done=None):
+      return {"step": step, "taskCategory": "Copy", "taskProgress": progress, "taskEstimate": 50,
+              "taskElapse": 5, "taskStatus": status, "taskExplain": "", "taskBytes": bytes_done}
+
+    recorder.record("loadimage", report("tasks", "Preflight", [task(0, "waiting", 0), task(1, "waiting", 0)]))
+    recorder.record("loadimage", report("task_progress", "Running", [task(0, "running", 10, 1000), task(1, "waiting", 0)]))
+    # Within the interval, and nothing changed state
+    for progress in range(11, 50):
+      recorder.record("loadimage", report("task_progress", "Running", [task(0, "running", progress, 1000 * progress)]))
+      pass
+    recorder.record("loadimage", report("task_success", "Running", [task(0, "done", 100, 10 ** 6), task(1, "running", 1)], step=0))
+    recorder.record("loadimage", report("run_progress", "Success", [task(1, "done", 100)]))
+
+    self.assertTrue(self._wait_for(lambda: self.store.query()[1] == 4))
+    plans, _ = self.store.query(event_types=[LogEventType.PLAN])
+    run = plans[0]["id"]
+    self.assertEqual(plans[0]["data"]["tasks"][1]["step"], 1)
+    rows, total = self.store.query(event_types=[LogEventType.PROGRESS], sort_desc=False)
+    self.assertEqual([r["data"]["runStatus"] for r in rows], ["Running", "Running", "Success"])
+    self.assertTrue(all(r["data"]["run"] == run for r in rows))
+
+    self.assertTrue(self._wait_for(lambda: len(self.store.progress_series(run)) == 3))
+    samples = self.store.progress_series(run)
+    self.assertEqual([(s["step"], s["status"], s["progress"], s["bytes"]) for s in samples],
+                     [(0, "running", 10, 1000), (0, "done", 100, 10 ** 6), (1, "running", 1, None)])
+    self.assertEqual((samples[0]["device"], samples[0]["runTime"], samples[0]["runEstimate"]), ("/dev/sdb", 10, 100))
+    self.assertEqual(self.store.progress_series(run + 1000), [])
+    pass
+
+  def test_full_ring_drops_debug_first(self):
+    store = LogStore(db_path=tempfile.mktemp(suffix=".db"), ring_size=4)
+    try:
+      # The writer stays behind until the ring is full.
+      with mock.patch.object(store, "_drain"):
+        store.log(LogEventType.LOG, "first", level="INFO")
+        store.log(LogEventType.LOG, "%s of %d", level="INFO", args=("second", 4))
+        store.log(LogEventType.LOG, "debug", level="DEBUG")
+        store.log(LogEventType.LOG, "third", level="INFO")
+        store.log(LogEventType.LOG, "fourth", level="INFO")
+        store.log(LogEventType.LOG, "fifth", level="INFO")
+        stats = store.stats()
+        self.assertEqual((stats["waiting"], stats["capacity"]), (4, 4))
+        self.assertEqual(stats["dropped"], {"DEBUG": 1, "INFO": 1})
+        self.assertGreaterEqual(stats["lag"], 0)
+        store.overflow = "drop-oldest"
+        store.log(LogEventType.ERROR, "newest", level="ERROR")
+        self.assertEqual(store.stats()["dropped"], {"DEBUG": 1, "INFO": 2})
+        pass
+      self.assertTrue(self._wait_for(lambda: store.query()[1] == 4))
+      rows, _ = store.query(sort_desc=False)
+      self.assertEqual([row["message"] for row in rows], ["second of 4", "third", "fourth", "newest"])
+      self.assertEqual(store.stats()["written"], 4)
+    finally:
+      store.close()
+      _cleanup_db_files(store.db_path)
+      pass
+    pass
+
   def test_install_sqlite_log_handler_emits_exactly_once(self):
     logger = logging.getLogger("test_log_store.no_double_emit")
     logger.setLevel(logging.DEBUG)
@@ -219,6 +402,27 @@ class Test_log_store(unittest.TestCase):
       pass
     pass
 
+  def test_install_sqlite_log_handler_formats_args_later(self):
+    logger = logging.getLogger("test_log_store.deferred_format")
+    logger.setLevel(logging.DEBUG)
+    install_sqlite_log_handler(logger)
+
+    import wce_triage.lib.log_store as log_store_module
+    original = log_store_module._log_store_
+    log_store_module._log_store_ = self.store
+    try:
+      # The handler hands msg and args over as they are - the writer does the %.
+      with mock.patch.object(logging.LogRecord, "getMessage", side_effect=AssertionError("formatted in emit")):
+        logger.info("%d disks loaded from %s", 2, "wce-mate18")
+        pass
+      self.assertTrue(self._wait_for(lambda: self.store.query()[1] == 1))
+      rows, _ = self.store.query()
+      self.assertEqual(rows[0]["message"], "2 disks loaded from wce-mate18")
+    finally:
+      log_store_module._log_store_ = original
+      pass
+    pass
+
 
 if __name__ == "__main__":
   unittest.main()
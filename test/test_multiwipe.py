@@ -0,0 +1,101 @@
+import errno
+import os
+import struct
+import tempfile
+import unittest
+from unittest import mock
+
+from wce_triage.bin import multiwipe
+
+
+class Test_block_wiper(unittest.TestCase):
+  """BlockWiper against a plain file, with the block ioctls faked - the
+  real ones need a real block device."""
+
+  def setUp(self):
+    self.tempfile = tempfile.NamedTemporaryFile()
+    self.device = open(self.tempfile.name, "wb", buffering=0)
+    self.calls = []
+    pass
+
+  def tearDown(self):
+    self.tempfile.close()
+    pass
+
+  def fake_ioctl(self, unsupported):
+    def ioctl(fd, request, arg):
+      start, length = struct.unpack("QQ", arg)
+      self.calls.append((request, start, length))
+      if request in unsupported:
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+      return arg
+    return ioctl
+
+  def wipe(self, n_sectors, method, unsupported=()):
+    wiper = multiwipe.BlockWiper(n_sectors, self.device, self.tempfile.name, method=method)
+    with mock.patch.object(multiwipe.fcntl, "ioctl", self.fake_ioctl(unsupported)), \
+         mock.patch.object(multiwipe, "ioctl_range_size", 2 ** 20):
+      wiper.run()
+      pass
+    return wiper
+
+  def test_zeroout_covers_whole_device_in_slices(self):
+    wiper = self.wipe(5000, multiwipe.WIPE_ZEROOUT)
+    self.assertEqual(wiper.n_written, 5000)
+    self.assertTrue(wiper.synced)
+    self.assertEqual([request for request, start, length in self.calls], [multiwipe.BLKZEROOUT] * 3)
+    self.assertEqual(sum(length for request, start, length in self.calls), 5000 * 512)
+    self.assertEqual(self.calls[-1][1], 2 * 2 ** 20)
+    pass
+
+  def test_discard_falls_back_to_zeroout_when_secure_discard_is_not_supported(self):
+    wiper = self.wipe(4096, multiwipe.WIPE_DISCARD, unsupported=[multiwipe.BLKSECDISCARD])
+    self.assertEqual(wiper.n_written, 4096)
+    self.assertEqual(wiper.phase, multiwipe.PHASE_SYNC)
+    # Never a plain TRIM - it doesn't promise the data is gone.
+    self.assertEqual([request for request, start, length in self.calls],
+                     [multiwipe.BLKSECDISCARD, multiwipe.BLKZEROOUT, multiwipe.BLKZEROOUT])
+    pass
+
+  def test_zeroout_failure_fails_the_wipe(self):
+    wiper = self.wipe(4096, multiwipe.WIPE_ZEROOUT, unsupported=[multiwipe.BLKZEROOUT])
+    self.assertEqual(wiper.n_written, 0)
+    self.assertFalse(wiper.synced)
+    pass
+  pass
+
+
+class ShortWriter:
+  """A device that takes at most 1000 bytes a write."""
+
+  def __init__(self, path):
+    self.file = open(path, "wb", buffering=0)
+    pass
+
+  def write(self, data):
+    return self.file.write(data[:1000])
+
+  def fileno(self):
+    return self.file.fileno()
+
+  def close(self):
+    self.file.close()
+    pass
+  pass
+
+
+class Test_wiper(unittest.TestCase):
+
+  def test_short_writes_are_counted_as_written(self):
+    with tempfile.NamedTemporaryFile() as device_file:
+      wiper = multiwipe.Wiper(10, ShortWriter(device_file.name), device_file.name)
+      wiper.run()
+      self.assertEqual(wiper.n_written, 10)
+      self.assertEqual(os.path.getsize(device_file.name), 10 * 512)
+      pass
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,96 @@
+import sys
+import unittest
+
+from wce_triage.lib.output_buffer import OutputBuffer
+from wce_triage.ops.tasks import op_task_process_simple
+
+
+class Test_output_buffer(unittest.TestCase):
+
+  def test_lines_across_feeds(self):
+    buffer = OutputBuffer()
+    buffer.feed("one\ntw")
+    buffer.feed("o\nthr")
+    self.assertEqual(buffer.take_lines(), ["one", "two"])
+    self.assertEqual(buffer.text(), "thr")
+    buffer.feed("ee\n")
+    self.assertEqual(buffer.take_lines(), ["three"])
+    self.assertEqual(buffer.text(), "")
+    pass
+
+  def test_keeps_head_and_tail(self):
+    buffer = OutputBuffer(head_lines=3, max_bytes=40)
+    for i in range(1000):
+      buffer.feed("line %04d\n" % i)
+      pass
+    # 10 bytes a line, so 4 lines fit the tail.
+    self.assertEqual(buffer.head, ["line 0000", "line 0001", "line 0002"])
+    self.assertEqual(list(buffer.tail), ["line 0996", "line 0997", "line 0998", "line 0999"])
+    self.assertEqual(buffer.dropped, 993)
+    self.assertEqual(buffer.text(),
+                     "line 0000\nline 0001\nline 0002\n[... 993 lines dropped ...]\n"
+                     "line 0996\nline 0997\nline 0998\nline 0999\n")
+    pass
+
+  def test_endless_line_is_capped(self):
+    buffer = OutputBuffer(max_bytes=100)
+    for i in range(100):
+      buffer.feed("\r%3d%%" % i)
+      pass
+    self.assertEqual(len(buffer.fragment), 100)
+    self.assertTrue(buffer.text().endswith(" 99%"))
+    pass
+
+  def test_head_is_capped_in_bytes(self):
+    buffer = OutputBuffer(head_lines=10, max_bytes=100)
+    # One huge line as the process starts, then its newline.
+    for i in range(100):
+      buffer.feed("%3d%% " % i)
+      pass
+    buffer.feed("\n")
+    for i in range(20):
+      buffer.feed("line %04d\n" % i)
+      pass
+    self.assertEqual(len(buffer.head), 1)
+    self.assertEqual(len(buffer.head[0]), 99)
+    self.assertTrue(buffer.head[0].endswith(" 99% "))
+    # The rest go to the tail, which keeps its last 100 bytes.
+    self.assertEqual(list(buffer.tail), ["line %04d" % i for i in range(10, 20)])
+    pass
+  pass
+
+
+class Test_process_output(unittest.TestCase):
+
+  def run_task(self, task):
+    task.pre_setup()
+    task.setup()
+    while task.progress < 100:
+      task.poll()
+      pass
+    return task
+
+  def test_chatty_process_is_bounded(self):
+    script = "import sys\nfor i in range(200000): print('progress %d' % i)\nprint('bad block', file=sys.stderr)"
+    task = op_task_process_simple("chatty", argv=[sys.executable, "-c", script], time_estimate=60,
+                                  output_head_lines=5, output_max_bytes=2**12)
+    self.run_task(task)
+    self.assertEqual(task.progress, 100)
+    self.assertTrue(task.out.startswith("progress 0\nprogress 1\n"))
+    self.assertTrue(task.out.endswith("progress 199999\n"))
+    self.assertLess(len(task.out), 2**13)
+    self.assertEqual(task.err, "bad block\n")
+    pass
+
+  def test_utf8_split_between_reads(self):
+    # Every read ends in the middle of "é" at one point or another.
+    script = "import sys\nsys.stdout.write('é' * 100000)"
+    task = op_task_process_simple("utf8", argv=[sys.executable, "-c", script], time_estimate=60)
+    self.run_task(task)
+    self.assertEqual(task.out, "é" * 100000)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from unittest import mock
+
+from wce_triage.ops.partclone_tasks import task_restore_disk_images
+from wce_triage.ops.protocol import DriverEvent, DriverEventType
+from wce_triage.ops.tasks import op_task_process
+
+
+class FakePartition:
+  def __init__(self, device_name):
+    self.device_name = device_name
+    pass
+  pass
+
+
+class FakeDisk:
+  def __init__(self, device_name):
+    self.device_name = device_name
+    self.partition = FakePartition(device_name + "1")
+    pass
+
+  def estimate_speed(self, operation=None):
+    return 100 * 2 ** 20
+
+  def find_partition(self, part_id):
+    return self.partition
+  pass
+
+
+class FakeProcess:
+  returncode = None
+  pass
+
+
+def partclone_event(device, type=DriverEventType.line, line=None, returncode=None):
+  return DriverEvent(type=type, proc="partclone:" + device, stream="stderr",
+                     line=line, returncode=returncode).model_dump_json(exclude_none=True) + "\n"
+
+
+def progress_line(percent):
+  return "current block:   %d, total block:   1000, Complete:  %.2f%%" % (percent * 10, percent)
+
+
+class Test_restore_disk_images(unittest.TestCase):
+
+  def setUp(self):
+    self.disks = [FakeDisk("/dev/sdx"), FakeDisk("/dev/sdy")]
+    self.task = task_restore_disk_images("Restore", targets=[(disk, 1) for disk in self.disks],
+                                         source="/tmp/wce-mate18.ext4.partclone.gz", source_size=2 ** 30)
+    # Only the process it would start is left out.
+    with mock.patch.object(op_task_process, "setup"):
+      self.task.setup()
+      pass
+    self.task.process = FakeProcess()
+    pass
+
+  def test_progress_per_disk(self):
+    self.task.err_buffer.feed(partclone_event("/dev/sdx1", line=progress_line(40.5))
+                              + partclone_event("/dev/sdy1", line=progress_line(12.25))
+                              + DriverEvent(type=DriverEventType.line, proc="wget", line=progress_line(90)).model_dump_json() + "\n")
+    self.task.parse_partclone_progress()
+    self.assertEqual(self.task.device_progress, {"/dev/sdx1": 40.5, "/dev/sdy1": 12.25})
+    # The slowest disk is the task's progress.
+    self.assertEqual(self.task.progress, 12)
+    self.assertEqual(self.task.message, "12% done on 2 disks")
+    pass
+
+  def test_failed_disk_drops_out(self):
+    self.task.err_buffer.feed(partclone_event("/dev/sdx1", line=progress_line(50))
+                              + partclone_event("/dev/sdy1", line=progress_line(10))
+                              + partclone_event("/dev/sdy1", type=DriverEventType.exit, returncode=1))
+    self.task.parse_partclone_progress()
+    self.assertEqual(self.task.failed_disks(), [self.disks[1]])
+    self.assertIn("/dev/sdy1: restore failed with return code 1", self.task.verdict)
+    self.assertEqual(self.task.progress, 50)
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -29,8 +29,8 @@ class Test_pipereader(unittest.TestCase):
 
   def read_line(self):
     """Loop readline() until it returns an actual line, regardless of how
-    many underlying reads that takes - readline() only reads 1 byte per
-    call, so a multi-byte line legitimately needs several calls."""
+    many underlying reads that takes - a line trickling in a byte at a time
+    legitimately needs several calls."""
     for _ in range(100000):
       result = self.reader.readline()
       if result is not None:
@@ -66,6 +66,25 @@ class Test_pipereader(unittest.TestCase):
     self.assertEqual(self.read_line(), "done\n")
     pass
 
+  def test_line_split_across_writes(self):
+    self.write(b'progress 1')
+    # Nothing is terminated yet, so there's no line.
+    self.assertIsNone(self.reader.readline())
+    self.write(b'0%\rprogr')
+    self.assertEqual(self.reader.readline(), "progress 10%\n")
+    self.write(b'ess 20%\r')
+    self.assertEqual(self.read_line(), "progress 20%\n")
+    pass
+
+  def test_many_lines_take_one_read(self):
+    self.write(b'a\rb\nc\r')
+    self.assertEqual(self.reader.readline(), "a\n")
+    # The rest came in with the first read; the pipe is empty now, so these
+    # would block if they read it.
+    self.assertEqual(self.reader.readline(), "b\n")
+    self.assertEqual(self.reader.readline(), "c\n")
+    pass
+
   def test_eof_flushes_trailing_fragment_then_signals_closed(self):
     self.write(b'no terminator here')
     os.close(self.writer_fd)
@@ -1,11 +1,16 @@
 import json
+import os
 import subprocess
 import sys
 import threading
 import time
 import unittest
+from unittest import mock
 
 from wce_triage.bin.process_driver import DriverEmitter, PipeInfo, drive_process
+from wce_triage.ops.protocol import (DriverEventType, DriverFrameDecoder, DRIVER_FRAMING_ENV, DRIVER_FRAMING_STRUCT,
+                                     DRIVER_PARTIAL_FAILURE)
+from wce_triage.ops.tasks import op_task_process_simple
 
 
 class RecordingStream:
@@ -132,13 +137,28 @@ class Test_driver_emitter(unittest.TestCase):
     self.assertEqual([e["type"] for e in events], ["start", "exit"])
     pass
 
+  def test_framed(self):
+    stream = RecordingStream()
+    emitter = DriverEmitter(stream=stream, framed=True)
+    emitter.start("proc", 42)
+    emitter.line("proc", "stdout", "progress 50%")
+    emitter.exit("proc", 42, 0)
+    emitter.close()
+    decoder = DriverFrameDecoder()
+    self.assertEqual(decoder.feed(b"".join(stream.chunks)), b"")
+    events = decoder.take_events()
+    self.assertEqual([(e.type, e.pid, e.line, e.returncode) for e in events],
+                     [(DriverEventType.start, 42, None, None), (DriverEventType.exit, 42, None, 0),
+                      (DriverEventType.line, None, "progress 50%", None)])
+    pass
+
 
 class Test_drive_process(unittest.TestCase):
-  """Exercises drive_process() end to end with real subprocesses - the thread-
-  per-pipe/thread-per-process design that replaced the old select.poll() loop.
+  """Exercises drive_process() end to end with real subprocesses - every pipe
+  and exit multiplexed on one selector.
   """
 
-  def _run(self, specs):
+  def _run(self, specs, independent=()):
     """specs: list of (proc_name, argv). Launches each with stdout+stderr
     piped, drives them, and returns (retcode, recorded events) with
     DriverEmitter's NDJSON captured instead of sent to the real stderr."""
@@ -155,7 +175,7 @@ class Test_drive_process(unittest.TestCase):
     old_stderr = sys.stderr
     sys.stderr = stream
     try:
-      retcode = drive_process("TEST", processes, pipes)
+      retcode = drive_process("TEST", processes, pipes, independent=independent)
     finally:
       sys.stderr = old_stderr
       pass
@@ -199,6 +219,131 @@ class Test_drive_process(unittest.TestCase):
     self.assertIn("two-out", lines)
     pass
 
+  def test_independent_failure_leaves_siblings_running(self):
+    retcode, events = self._run([
+      ("failer", ["sh", "-c", "exit 7"]),
+      ("worker", ["sh", "-c", "sleep 0.5; echo done"]),
+    ], independent=["failer", "worker"])
+    self.assertEqual(retcode, DRIVER_PARTIAL_FAILURE)
+    exits = {e["proc"]: e["returncode"] for e in events if e["type"] == "exit"}
+    self.assertEqual(exits, {"failer": 7, "worker": 0})
+    pass
+
+  def test_all_independent_failing_fails(self):
+    retcode, events = self._run([
+      ("one", ["sh", "-c", "exit 3"]),
+      ("two", ["sh", "-c", "sleep 0.2; exit 3"]),
+    ], independent=["one", "two"])
+    self.assertEqual(retcode, 3)
+    pass
+
+  def test_wide_fanout_runs_on_one_thread(self):
+    specs = [("copy%d" % i, ["sh", "-c", "printf 'copy%d half\\rcopy%d done\\n'; sleep 0.3" % (i, i)]) for i in range(16)]
+    threads_before = threading.active_count()
+    peak = []
+    done = threading.Event()
+    def watch():
+      while not done.is_set():
+        peak.append(threading.active_count())
+        time.sleep(0.05)
+        pass
+      pass
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    try:
+      retcode, events = self._run(specs)
+    finally:
+      done.set()
+      watcher.join()
+      pass
+    self.assertEqual(retcode, 0)
+    exits = {e["proc"]: e["returncode"] for e in events if e["type"] == "exit"}
+    self.assertEqual(exits, {"copy%d" % i: 0 for i in range(16)})
+    lines = [e["line"] for e in events if e["type"] == "line"]
+    for i in range(16):
+      self.assertIn("copy%d done" % i, lines)
+      pass
+    # The watcher and the emitter's writer, nothing per child.
+    self.assertLessEqual(max(peak), threads_before + 2)
+    pass
+
+  def test_thread_backed_process(self):
+    # StreamFeeder is a thread posing as a process. Its pid is ours, so
+    # there's no pidfd for it.
+    class FakeProcess:
+      def __init__(self):
+        self.pid = os.getpid()
+        self.released = threading.Event()
+        pass
+
+      def wait(self):
+        self.released.wait()
+        return 5
+
+      def terminate(self):
+        self.released.set()
+        pass
+      pass
+
+    fake = FakeProcess()
+    threading.Timer(0.2, fake.released.set).start()
+    stream = RecordingStream()
+    old_stderr = sys.stderr
+    sys.stderr = stream
+    try:
+      retcode = drive_process("TEST", [("feeder", fake)], [])
+    finally:
+      sys.stderr = old_stderr
+      pass
+    self.assertEqual(retcode, 5)
+    exits = [e for e in stream.events() if e["type"] == "exit"]
+    self.assertEqual([(e["proc"], e["returncode"]) for e in exits], [("feeder", 5)])
+    pass
+  pass
+
+
+# A process_driver running echo, for a task to read.
+DRIVE_ECHO = (
+  "import subprocess, sys\n"
+  "from wce_triage.bin.process_driver import PipeInfo, drive_process\n"
+  "echo = subprocess.Popen(['sh', '-c', 'echo hello world'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)\n"
+  "sys.exit(drive_process('TEST', [('echoer', echo)], [PipeInfo('echoer', echo, 'stdout', echo.stdout),"
+  " PipeInfo('echoer', echo, 'stderr', echo.stderr)]))\n")
+
+
+class Test_driver_framing(unittest.TestCase):
+  """A task asking for frames gets them from its process_driver."""
+
+  def run_task(self, driver_framing):
+    task = op_task_process_simple("drive", argv=[sys.executable, "-c", DRIVE_ECHO], time_estimate=1)
+    task.driver_framing = driver_framing
+    task.pre_setup()
+    task.setup()
+    while task.process.returncode is None or task.read_set:
+      task._poll_process()
+      pass
+    self.assertEqual(task.process.returncode, 0)
+    return task.take_driver_events()
+
+  def test_framed(self):
+    taken = self.run_task(True)
+    self.assertTrue(taken)
+    self.assertTrue(all(line is None and event is not None for line, event in taken))
+    events = [event for line, event in taken]
+    self.assertEqual([event.type for event in events if event.type != DriverEventType.line],
+                     [DriverEventType.start, DriverEventType.exit])
+    self.assertIn("hello world", [event.line for event in events])
+    pass
+
+  def test_only_the_task_that_asks_gets_frames(self):
+    with mock.patch.dict(os.environ, {DRIVER_FRAMING_ENV: DRIVER_FRAMING_STRUCT}):
+      taken = self.run_task(False)
+      pass
+    self.assertTrue(all(line for line, event in taken))
+    self.assertIn("hello world", [event.line for line, event in taken])
+    pass
+  pass
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,163 @@
+import contextlib
+import io
+import json
+import unittest
+
+from wce_triage.ops.json_ui import json_ui
+from wce_triage.ops.protocol import (DriverEvent, DriverEventType, DriverFrameDecoder, OperationProgress,
+                                     ProgressEnvelope, ProgressReport, TaskStatus, encode_driver_frame, merge_progress,
+                                     parse_lines)
+from wce_triage.ops.run_state import RunState
+from wce_triage.ops.runner import Runner
+from wce_triage.ops.tasks import op_task_python_simple
+
+
+class Test_parse_lines(unittest.TestCase):
+
+  def line(self, proc, text):
+    return DriverEvent(type=DriverEventType.line, proc=proc, stream="stderr", line=text).model_dump_json(exclude_none=True)
+
+  def test_batch(self):
+    lines = [self.line("partclone", "Completed: %d%%" % pct) for pct in range(10)]
+    events = parse_lines(DriverEvent, lines)
+    self.assertEqual([event.line for event in events], ["Completed: %d%%" % pct for pct in range(10)])
+    pass
+
+  def test_other_lines_are_none_and_the_rest_still_parse(self):
+    lines = [self.line("partclone", "one"),
+             "Traceback (most recent call last):",
+             "",
+             "  ",
+             self.line("partclone", "two")]
+    events = parse_lines(DriverEvent, lines)
+    self.assertEqual(len(events), len(lines))
+    self.assertEqual(events[0].line, "one")
+    self.assertEqual(events[1:4], [None, None, None])
+    self.assertEqual(events[4].line, "two")
+    pass
+
+  def test_two_objects_on_a_line_dont_shift_the_rest(self):
+    two = self.line("partclone", "a") + "," + self.line("partclone", "b")
+    events = parse_lines(DriverEvent, [two, self.line("partclone", "c")])
+    self.assertEqual(len(events), 2)
+    self.assertIsNone(events[0])
+    self.assertEqual(events[1].line, "c")
+    pass
+
+  def test_envelope(self):
+    report = ProgressReport(key="/dev/sdb", runStatus=RunState.Running, runMessage="copying", progress=40)
+    line = ProgressEnvelope(event="fanoutcopy", message=report).model_dump_json(exclude_none=True)
+    envelopes = parse_lines(ProgressEnvelope, [line, self.line("rsync", "not a report")])
+    self.assertEqual(envelopes[0].message, report)
+    self.assertIsNone(envelopes[1])
+    pass
+  pass
+
+
+class Test_driver_frames(unittest.TestCase):
+
+  events = [DriverEvent(type=DriverEventType.start, proc="partclone:/dev/sdb1", pid=4242),
+            DriverEvent(type=DriverEventType.line, proc="rsync", stream="stdout",
+                        line="  1,048,576  42%   10.00MB/s    0:00:06"),
+            DriverEvent(type=DriverEventType.error, proc="wget", line="résumé \u2013 failed"),
+            DriverEvent(type=DriverEventType.exit, proc="partclone:/dev/sdb1", pid=4242, returncode=-15)]
+
+  def frame(self, event):
+    return encode_driver_frame(event.type, event.proc, stream=event.stream, pid=event.pid,
+                               line=event.line, returncode=event.returncode)
+
+  def test_round_trip(self):
+    decoder = DriverFrameDecoder()
+    self.assertEqual(decoder.feed(b"".join(self.frame(event) for event in self.events)), b"")
+    self.assertEqual([DriverEvent(**event._asdict()) for event in decoder.take_events()], self.events)
+    self.assertEqual(decoder.take_events(), [])
+    pass
+
+  def test_names_are_told_apart(self):
+    events = [DriverEvent(type=DriverEventType.line, proc="ab", stream="c", line="1"),
+              DriverEvent(type=DriverEventType.line, proc="a", stream="bc", line="2"),
+              DriverEvent(type=DriverEventType.line, proc="a", stream="", line="3"),
+              DriverEvent(type=DriverEventType.exit, proc="a", returncode=3),
+              DriverEvent(type=DriverEventType.line, proc="ab", stream="c", line="4")]
+    decoder = DriverFrameDecoder()
+    decoder.feed(b"".join(self.frame(event) for event in events))
+    self.assertEqual([DriverEvent(**event._asdict()) for event in decoder.take_events()], events)
+    pass
+
+  def test_frames_cut_anywhere_and_text_in_between(self):
+    data = (b"Traceback (most recent call last):\n" + self.frame(self.events[0]) + self.frame(self.events[1])
+            + b"oops\n" + self.frame(self.events[2]) + self.frame(self.events[3]))
+    decoder = DriverFrameDecoder()
+    text = b"".join(decoder.feed(data[i:i + 1]) for i in range(len(data)))
+    self.assertEqual(text, b"Traceback (most recent call last):\noops\n")
+    self.assertEqual([DriverEvent(**event._asdict()) for event in decoder.take_events()], self.events)
+    pass
+  pass
+
+
+class Test_merge_progress(unittest.TestCase):
+
+  def status(self, step, category, status="waiting"):
+    return TaskStatus(step=step, taskCategory=category, taskProgress=0, taskEstimate=1, taskElapse=0,
+                      taskStatus=status, taskExplain=category)
+
+  def test_changed_step_replaces_all_its_entries(self):
+    plan = OperationProgress(report="tasks", device="/dev/sdb", runStatus=RunState.Preflight, runMessage="Preparing",
+                             tasks=[self.status(0, "partition"),
+                                    self.status(1, "wipe sdb"), self.status(1, "wipe sdc"),
+                                    self.status(2, "sync")]).model_dump(mode="json")
+    delta = OperationProgress(report="task_progress", device="/dev/sdb", runStatus=RunState.Running, runMessage="",
+                              step=1, delta=True,
+                              tasks=[self.status(1, "wipe sdb", "running"), self.status(1, "wipe sdc", "running")])
+    merged = merge_progress(plan, delta)
+    self.assertFalse(merged["delta"])
+    self.assertEqual(merged["runStatus"], "Running")
+    self.assertEqual([(row["taskCategory"], row["taskStatus"]) for row in merged["tasks"]],
+                     [("partition", "waiting"), ("wipe sdb", "running"), ("wipe sdc", "running"), ("sync", "waiting")])
+    pass
+  pass
+
+
+class task_nothing(op_task_python_simple):
+  def run_python(self):
+    pass
+  pass
+
+
+class Test_json_ui_delta(unittest.TestCase):
+
+  def run_reports(self, delta):
+    ui = json_ui(wock_event="test", message_catalog={}, delta=delta)
+    runner = Runner(ui, "test")
+    runner.prepare()
+    runner.tasks = [task_nothing("step %d" % i, time_estimate=1) for i in range(30)]
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+      runner.preflight()
+      runner.explain()
+      runner.run()
+      pass
+    return [OperationProgress.model_validate(json.loads(line)["message"]) for line in output.getvalue().splitlines()]
+
+  def test_deltas_add_up_to_the_whole_report(self):
+    reports = self.run_reports(delta=True)
+    self.assertFalse(reports[0].delta)
+    self.assertEqual(len(reports[0].tasks), 30)
+    snapshot = {}
+    for report in reports:
+      self.assertLessEqual(len(report.tasks), 30)
+      snapshot = merge_progress(snapshot, report)
+      pass
+    # Each tick carries a step or two, not all 30.
+    self.assertLess(sum(len(report.tasks) for report in reports[1:]), 30 * 5)
+
+    whole = self.run_reports(delta=False)[-1].model_dump(mode="json")
+    strip = lambda rows: [dict(row, taskElapse=0, taskEstimate=0) for row in rows]
+    self.assertEqual(strip(snapshot["tasks"]), strip(whole["tasks"]))
+    self.assertEqual(snapshot["runStatus"], "Success")
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
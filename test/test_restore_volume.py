@@ -0,0 +1,132 @@
+import fcntl
+import gzip
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from wce_triage.bin import restore_volume
+from wce_triage.bin.restore_volume import StreamFeeder, make_big_pipe, PIPE_SIZE, get_pipe_max_size
+from wce_triage.lib.util import get_file_decompression_app
+
+
+class Test_stream_feeder(unittest.TestCase):
+
+  def setUp(self):
+    self.tempdir = tempfile.TemporaryDirectory()
+    pass
+
+  def tearDown(self):
+    self.tempdir.cleanup()
+    pass
+
+  def feed(self, path, gunzip):
+    read_fd, write_fd = make_big_pipe()
+    feeder = StreamFeeder(path, write_fd, gunzip=gunzip)
+    received = []
+    def drain():
+      with os.fdopen(read_fd, "rb") as pipe:
+        received.append(pipe.read())
+        pass
+      pass
+    reader = threading.Thread(target=drain)
+    reader.start()
+    feeder.start()
+    returncode = feeder.wait()
+    reader.join()
+    feeder.stderr.close()
+    return returncode, received[0]
+
+  def test_plain_source(self):
+    payload = os.urandom(2**22 + 12345)
+    path = os.path.join(self.tempdir.name, "image.partclone")
+    with open(path, "wb") as image:
+      image.write(payload)
+      pass
+    self.assertEqual(self.feed(path, False), (0, payload))
+    pass
+
+  def test_gunzip_in_process_with_several_members(self):
+    first = os.urandom(100000)
+    second = b"partclone" * 500000
+    path = os.path.join(self.tempdir.name, "image.partclone.gz")
+    with open(path, "wb") as image:
+      image.write(gzip.compress(first))
+      image.write(gzip.compress(second))
+      pass
+    self.assertEqual(self.feed(path, True), (0, first + second))
+    pass
+
+  def test_gunzip_inflates_zeros_a_bit_at_a_time(self):
+    # 32MB of zeros is a 32KB .gz - one read. It comes out INFLATE_SIZE at a time.
+    zeros = bytes(2 ** 25)
+    path = os.path.join(self.tempdir.name, "zeros.partclone.gz")
+    with open(path, "wb") as image:
+      image.write(gzip.compress(zeros) + gzip.compress(b"end"))
+      pass
+    written = []
+    write_out = StreamFeeder.write_out
+    def recording_write_out(feeder, data):
+      written.append(len(data))
+      write_out(feeder, data)
+      pass
+    with mock.patch.object(restore_volume, "INFLATE_SIZE", 2 ** 20), \
+         mock.patch.object(StreamFeeder, "write_out", recording_write_out):
+      self.assertEqual(self.feed(path, True), (0, zeros + b"end"))
+      pass
+    self.assertLessEqual(max(written), 2 ** 20)
+    pass
+
+  def test_missing_source_fails(self):
+    returncode, data = self.feed(os.path.join(self.tempdir.name, "nope.gz"), True)
+    self.assertEqual(returncode, 1)
+    self.assertEqual(data, b"")
+    pass
+
+  def test_tee_drops_the_output_that_stops_reading(self):
+    payload = os.urandom(2**24)
+    path = os.path.join(self.tempdir.name, "image.partclone")
+    with open(path, "wb") as image:
+      image.write(payload)
+      pass
+    good_read, good_write = make_big_pipe()
+    bad_read, bad_write = make_big_pipe()
+    # This reader is gone before the stream starts, like a dead partclone.
+    os.close(bad_read)
+    feeder = StreamFeeder(path, [good_write, bad_write])
+    received = []
+    def drain():
+      with os.fdopen(good_read, "rb") as pipe:
+        received.append(pipe.read())
+        pass
+      pass
+    reader = threading.Thread(target=drain)
+    reader.start()
+    feeder.start()
+    returncode = feeder.wait()
+    reader.join()
+    self.assertEqual(returncode, 0)
+    self.assertEqual(feeder.dropped, [bad_write])
+    self.assertEqual(received[0], payload)
+    self.assertIn(b"dropped", feeder.stderr.read())
+    feeder.stderr.close()
+    pass
+
+  def test_big_pipe(self):
+    read_fd, write_fd = make_big_pipe()
+    # F_GETPIPE_SZ
+    self.assertEqual(fcntl.fcntl(write_fd, 1032), min(PIPE_SIZE, get_pipe_max_size()))
+    os.close(read_fd)
+    os.close(write_fd)
+    pass
+
+  def test_zstd_is_known(self):
+    decomp = get_file_decompression_app("/tmp/image.partclone.zst")
+    self.assertEqual(decomp[0][0], "zstd")
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
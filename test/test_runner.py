@@ -0,0 +1,164 @@
+import sys
+import threading
+import time
+import unittest
+
+from wce_triage.ops.runner import Runner
+from wce_triage.ops.run_state import RunState
+from wce_triage.ops.tasks import op_task, op_task_process_simple
+
+
+class QuietUI:
+  """Stands in for json_ui - the runner's reports go nowhere."""
+
+  def __getattr__(self, name):
+    return lambda *args, **kwargs: None
+  pass
+
+
+class task_notified(op_task):
+  """Fully asynchronous: a thread does the work and says when it's done."""
+  poll_interval = None
+
+  def __init__(self, description, delay):
+    super().__init__(description, time_estimate=1)
+    self.delay = delay
+    self.done = threading.Event()
+    self.polls = 0
+    pass
+
+  def setup(self):
+    super().setup()
+    def work():
+      time.sleep(self.delay)
+      self.done.set()
+      self.notify()
+      pass
+    threading.Thread(target=work, daemon=True).start()
+    pass
+
+  def poll(self):
+    self.polls += 1
+    if self.done.is_set():
+      self.set_progress(100, "Done")
+      pass
+    pass
+
+  def _estimate_progress(self, total_seconds):
+    return 0
+
+  def explain(self):
+    return self.description
+  pass
+
+
+class task_counting(task_notified):
+  """Finishes on its own, and only poll() notices."""
+  poll_interval = 0.1
+
+  def setup(self):
+    self.started = time.monotonic()
+    pass
+
+  def poll(self):
+    self.polls += 1
+    if time.monotonic() - self.started >= self.delay:
+      self.set_progress(100, "Done")
+      pass
+    pass
+  pass
+
+
+class Test_runner(unittest.TestCase):
+
+  def run_tasks(self, tasks, max_parallel=1):
+    runner = Runner(QuietUI(), "test")
+    runner.max_parallel = max_parallel
+    runner.prepare()
+    runner.tasks = tasks
+    for task in tasks:
+      task.runner = runner
+      pass
+    runner.preflight()
+    started = time.monotonic()
+    runner.run()
+    return runner, time.monotonic() - started
+
+  def test_process_exit_ends_the_task_right_away(self):
+    tasks = [op_task_process_simple("step %d" % i, argv=[sys.executable, "-c", "import time; time.sleep(0.2); print('hi')"],
+                                    time_estimate=1) for i in range(3)]
+    runner, elapsed = self.run_tasks(tasks)
+    self.assertEqual(runner.state, RunState.Success)
+    self.assertEqual([task.out for task in tasks], ["hi\n"] * 3)
+    # Used to take a whole select() timeout, a second, for each.
+    self.assertLess(elapsed, 2.5)
+    pass
+
+  def test_asynchronous_task_wakes_the_runner(self):
+    task = task_notified("async", 0.3)
+    runner, elapsed = self.run_tasks([task])
+    self.assertEqual(runner.state, RunState.Success)
+    # Woken up by notify(), well before the next progress report is due.
+    self.assertLess(elapsed, 0.6)
+    self.assertLessEqual(task.polls, 3)
+    pass
+
+  def test_unfinished_python_task_does_not_spin(self):
+    task = task_counting("counting", 0.5)
+    runner, elapsed = self.run_tasks([task])
+    self.assertEqual(runner.state, RunState.Success)
+    self.assertLess(task.polls, 10)
+    pass
+
+  def sleeper(self, description, delay):
+    return op_task_process_simple(description, argv=[sys.executable, "-c", "import time; time.sleep(%g)" % delay],
+                                  time_estimate=1)
+
+  def test_independent_tasks_run_side_by_side(self):
+    first = self.sleeper("first", 0.5)
+    second = self.sleeper("second", 0.5)
+    second.set_dependencies([])
+    last = task_counting("last", 0)
+    runner, elapsed = self.run_tasks([first, second, last], max_parallel=2)
+    self.assertEqual(runner.state, RunState.Success)
+    self.assertLess(elapsed, 0.9)
+    # By default, a task waits for everything before it.
+    self.assertGreaterEqual(last.start_time, max(first.end_time, second.end_time))
+    pass
+
+  def test_shared_resource_is_held_by_one_task(self):
+    first = self.sleeper("first", 0.3)
+    second = self.sleeper("second", 0.3)
+    second.set_dependencies([])
+    first.add_resources("/dev/sdb")
+    second.add_resources("/dev/sdb")
+    runner, elapsed = self.run_tasks([first, second], max_parallel=2)
+    self.assertEqual(runner.state, RunState.Success)
+    self.assertGreaterEqual(second.start_time, first.end_time)
+    pass
+
+  def test_failure_leaves_only_teardown(self):
+    failing = op_task_process_simple("fail", argv=[sys.executable, "-c", "import sys; sys.exit(1)"], time_estimate=1)
+    after = task_counting("after", 0)
+    after.set_dependencies([failing])
+    teardown = task_counting("teardown", 0)
+    teardown.set_teardown_task()
+    runner, elapsed = self.run_tasks([failing, after, teardown], max_parallel=2)
+    self.assertEqual(runner.state, RunState.Failed)
+    self.assertEqual(after.polls, 0)
+    self.assertEqual(teardown.progress, 100)
+    pass
+
+  def test_dependency_must_come_first(self):
+    first = task_counting("first", 0)
+    second = task_counting("second", 0)
+    first.set_dependencies([second])
+    with self.assertRaises(Exception):
+      self.run_tasks([first, second], max_parallel=2)
+      pass
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
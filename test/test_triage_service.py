@@ -0,0 +1,93 @@
+import asyncio
+import socket
+import struct
+import threading
+import unittest
+
+from wce_triage.api.triage_service import TriageService, parse_uevent
+
+
+class FakeServer:
+  """What TriageService calls on TriageServer."""
+
+  def __init__(self, delay=0):
+    self.triage_timestamp = None
+    self.delay = delay
+    self.updates = 0
+    self.concurrent = 0
+    self.max_concurrent = 0
+    self.lock = threading.Lock()
+    pass
+
+  def initial_triage(self):
+    self.triage_timestamp = 1
+    pass
+
+  def update_triage(self):
+    with self.lock:
+      self.concurrent += 1
+      self.max_concurrent = max(self.max_concurrent, self.concurrent)
+      pass
+    threading.Event().wait(self.delay)
+    with self.lock:
+      self.concurrent -= 1
+      self.updates += 1
+      pass
+    pass
+
+  def check_autoload(self):
+    pass
+  pass
+
+
+class Test_triage_service(unittest.TestCase):
+
+  def run_service(self, server, events, settle=0.5):
+    async def main():
+      service = TriageService(server, debounce=0.05)
+      service.start()
+      await asyncio.sleep(0.1)
+      for _ in range(events):
+        service.request_update()
+        await asyncio.sleep(0.001)
+        pass
+      await asyncio.sleep(settle)
+      service.stop()
+      return service
+    return asyncio.run(main())
+
+  def test_burst_is_one_update(self):
+    server = FakeServer()
+    self.run_service(server, 20)
+    # The initial triage, then the burst.
+    self.assertEqual(server.triage_timestamp, 1)
+    self.assertLessEqual(server.updates, 3)
+    self.assertGreaterEqual(server.updates, 2)
+    pass
+
+  def test_updates_dont_overlap(self):
+    server = FakeServer(delay=0.1)
+    self.run_service(server, 50, settle=0.6)
+    self.assertEqual(server.max_concurrent, 1)
+    pass
+
+  def test_parse_uevent(self):
+    datagram = b"add@/devices/pci0000:00/ata1/host0/block/sdb\0ACTION=add\0DEVPATH=/devices/x\0SUBSYSTEM=block\0MAJOR=8\0MINOR=16\0"
+    fields = parse_uevent(datagram)
+    self.assertEqual(fields["SUBSYSTEM"], "block")
+    self.assertEqual((fields["MAJOR"], fields["MINOR"]), ("8", "16"))
+    self.assertIsNone(parse_uevent(b"libudev\0garbage").get("SUBSYSTEM"))
+    pass
+
+  def test_parse_udev_event(self):
+    properties = b"ACTION=add\0SUBSYSTEM=block\0DEVTYPE=disk\0MAJOR=8\0MINOR=16\0ID_BUS=ata\0"
+    header = struct.pack("=8sIIIIIIII", b"libudev\0", socket.htonl(0xfeedcafe), 40, 40, len(properties), 0, 0, 0, 0)
+    fields = parse_uevent(header + properties)
+    self.assertEqual((fields["ACTION"], fields["DEVTYPE"], fields["ID_BUS"]), ("add", "disk", "ata"))
+    self.assertEqual(parse_uevent(b"libudev\0" + bytes(32)), {})
+    pass
+  pass
+
+
+if __name__ == '__main__':
+  unittest.main()
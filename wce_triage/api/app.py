@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import os
 import socketio
@@ -28,8 +29,17 @@ tlog.setLevel(logging.DEBUG)
 # file logger, untouched. See wce_triage/lib/log_store.py's module docstring.
 install_sqlite_log_handler(tlog)
 
+@contextlib.asynccontextmanager
+async def lifespan(_app: FastAPI):
+  # Triage follows hot plug, cable and mount events from uvicorn's loop.
+  from .server import server
+  server.start_service()
+  yield
+  server.stop_service()
+
+
 # Create a FastAPI instance
-app = FastAPI(docs_url="/docs")
+app = FastAPI(docs_url="/docs", lifespan=lifespan)
 app.mount("/wce", StaticFiles(directory=wcedir), name="wce")
 
 from .config import DevConfig
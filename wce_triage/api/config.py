@@ -41,6 +41,12 @@ class Config(object):
   LIVE_TRIAGE = False
   PAYLOAD = None
   LOAD_DISK_OPTIONS = None
+  # Seconds between samples of a runner's progress in the log store
+  PROGRESS_SAMPLE_INTERVAL = 5
+  # Log store rows waiting for its writer, and what happens to rows past
+  # that ("drop-newest" or "drop-oldest") - DEBUG rows go at half of it.
+  LOG_RING_SIZE = 65536
+  LOG_OVERFLOW = "drop-newest"
 
   @staticmethod
   def cmdline():
@@ -1,13 +1,101 @@
 import asyncio
+import collections
 import threading
-import queue
 import socketio
 
+from pydantic import BaseModel
+
+# Events delivered one by one, in order - the log lines. Anything else is a
+# whole snapshot (a runner's OperationProgress, the disk list, the triage
+# decisions), so only the latest one of each is worth sending.
+ORDERED_EVENTS = ("message",)
+
+# Ordered events waiting at most. Past this, the oldest goes.
+MAX_ORDERED = 1000
+
+
+class EmitterMetrics(BaseModel):
+    depth: int            # waiting to be emitted, both kinds
+    ordered_depth: int
+    latest_depth: int     # events with a snapshot waiting
+    max_depth: int
+    put: int
+    coalesced: int        # snapshots replaced by a newer one before going out
+    dropped: int          # ordered events dropped past MAX_ORDERED
+    emitted: int
+    batches: int
+
+
+class EmitQueue:
+    """What TriageServer.send_to_ui() puts and EmitterThread emits. Keeps the
+    ordered events in order, and only the latest message of any other event.
+    A slow browser or many clients then cost skipped progress ticks, not a
+    queue that grows for as long as a runner keeps reporting."""
+
+    def __init__(self, ordered_events=ORDERED_EVENTS, max_ordered=MAX_ORDERED):
+        self.ordered_events = frozenset(ordered_events)
+        self.max_ordered = max_ordered
+        self.cond = threading.Condition()
+        self.ordered = collections.deque()
+        # event -> latest message. dict keeps the order events first came in.
+        self.latest = {}
+        self.max_depth = 0
+        self.put_count = 0
+        self.coalesced_count = 0
+        self.dropped_count = 0
+        self.emitted_count = 0
+        self.batch_count = 0
+
+    def put(self, item):
+        event, message = item
+        with self.cond:
+            self.put_count += 1
+            if event in self.ordered_events:
+                if len(self.ordered) >= self.max_ordered:
+                    self.ordered.popleft()
+                    self.dropped_count += 1
+                self.ordered.append((event, message))
+            else:
+                if event in self.latest:
+                    self.coalesced_count += 1
+                self.latest[event] = message
+            self.max_depth = max(self.max_depth, self.qsize())
+            self.cond.notify()
+
+    def get_batch(self, timeout=None):
+        """Waits for something to emit and takes everything there is - the
+        ordered events first, then the latest message of each other event.
+        Returns [] on timeout."""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.ordered or self.latest, timeout):
+                return []
+            batch = list(self.ordered) + list(self.latest.items())
+            self.ordered.clear()
+            self.latest = {}
+            self.batch_count += 1
+            self.emitted_count += len(batch)
+            return batch
+
+    def qsize(self):
+        return len(self.ordered) + len(self.latest)
+
+    def metrics(self) -> EmitterMetrics:
+        with self.cond:
+            return EmitterMetrics(depth=self.qsize(),
+                                  ordered_depth=len(self.ordered),
+                                  latest_depth=len(self.latest),
+                                  max_depth=self.max_depth,
+                                  put=self.put_count,
+                                  coalesced=self.coalesced_count,
+                                  dropped=self.dropped_count,
+                                  emitted=self.emitted_count,
+                                  batches=self.batch_count)
+
 
 class EmitterThread(threading.Thread):
     """Bridge between the therad and socketio world"""
 
-    def __init__(self, emit_queue: queue.Queue, sockio: socketio.AsyncServer):
+    def __init__(self, emit_queue: EmitQueue, sockio: socketio.AsyncServer):
         self.emit_queue = emit_queue
         self.sockio = sockio
         super().__init__(name="EmitterThread")
@@ -20,16 +108,21 @@ class EmitterThread(threading.Thread):
         # Define the async function to be called
         async def sock_emit():
             while True:
-                event, message = self.emit_queue.get()
-                await self.sockio.emit(event, message)
+                batch = self.emit_queue.get_batch()
+                ordered = [item for item in batch if item[0] in self.emit_queue.ordered_events]
+                latest = [item for item in batch if item[0] not in self.emit_queue.ordered_events]
+                for event, message in ordered:
+                    await self.sockio.emit(event, message)
+                # One of each event - the order among them doesn't matter.
+                await asyncio.gather(*[self.sockio.emit(event, message) for event, message in latest])
 
         # Run the async function in the event loop
         loop.run_until_complete(sock_emit())
         loop.close()
 
 
-def start_emitter_thread(sockio: socketio.AsyncServer) -> queue.SimpleQueue:
-    emit_queue = queue.SimpleQueue()
+def start_emitter_thread(sockio: socketio.AsyncServer) -> EmitQueue:
+    emit_queue = EmitQueue()
     emitter = EmitterThread(emit_queue, sockio)
     emitter.start()
     return emit_queue
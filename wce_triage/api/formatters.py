@@ -43,6 +43,7 @@ class DiskImageInfo(BaseModel):
   size: int
   subdir: str
   index: int
+  codec: Optional[str] = None
   pass
 
 
@@ -85,6 +86,7 @@ class DiskImageType(BaseModel):
   hostname: Optional[str] = None
   randomize_hostname: Optional[bool] = None
   cmdline: Optional[Dict[str, Any]] = None
+  compression: Optional[Dict[str, Any]] = None
   pass
 
 
@@ -56,18 +56,15 @@ class LoadCommandRunner(SimpleProcessRunner):
         break
       pass
 
-    target = None
-    for disk in server.disk_portal.disks:
-      if disk.device_name == devname:
-        target = disk
-        break
+    # devname is comma separated for a batch load.
+    known_disks = [disk.device_name for disk in server.disk_portal.disks]
+    for target in devname.split(","):
+      if target not in known_disks:
+        message = "No such disk " + target
+        tlog.info(message)
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
       pass
 
-    if target is None:
-      message = "No such disk " + devname
-      tlog.info(message)
-      raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=message)
-
     #disk = server.disk_portal.find_disk_by_device_name(devname)
 
     # loadType is a single word coming back from read_disk_image_types()
@@ -93,6 +90,10 @@ class LoadCommandRunner(SimpleProcessRunner):
     self.queue(args, {"args": args, "devname": devname, "imagefile": imagefile, "wipe": wipe, "newhostname": newhostname, "grow": image_type.get("grow", "no") })
     return OperationProgress(**server._load_image.model.data)
 
+  def queue_batch_load(self, devnames: list[str], load_type: str, imagefile: str, image_size: str | None, wipe_request: str, newhostname: str) -> OperationProgress:
+    """Loads the image to all of devnames with one restore_image_runner, which reads and decompresses it once."""
+    return self.queue_load(",".join(devnames), load_type, imagefile, image_size, wipe_request, newhostname)
+
   pass
 
 
@@ -85,7 +85,8 @@ class ProcessPipeReader(threading.Thread):
 
   def handle_line(self, line):
     tlog = get_triage_logger()
-    tlog.debug("handle_line(%s): %s" % (self.tag, line))
+    # Formatted later, if at all - this is every line of every pipe.
+    tlog.debug("handle_line(%s): %s", self.tag, line)
     if self.dispatch:
       self.dispatch.dispatch(line)
     else:
@@ -12,7 +12,7 @@ from ..models import ModelDispatch, Model
 from ..messages import UserMessages, ErrorMessages
 from ...lib import get_triage_logger
 from ...lib.log_store import get_log_store, LogEventType
-from ...ops.protocol import OperationProgress
+from ...ops.protocol import OperationProgress, merge_progress
 import json
 
 
@@ -169,10 +169,11 @@ class SimpleProcessRunner(ProcessRunner):
 
 
 class RunnerOutputDispatch(ModelDispatch):
-  """ops/runner + json_ui output dispatch. Every report is a complete,
-  self-sufficient OperationProgress (report/device/runStatus/runMessage/
-  runEstimate/runTime/tasks) - there's no delta to reconstruct, unlike the
-  old per-step "task" + "step" patching this used to need."""
+  """ops/runner + json_ui output dispatch. json_ui sends the whole plan once
+  and then deltas - only the steps that changed. This puts the whole
+  OperationProgress (report/device/runStatus/runMessage/runEstimate/runTime/
+  tasks) back together, so the model, the status routes and the view only
+  ever see complete, self-sufficient reports."""
   def dispatch(self, update):
     try:
       json_data = json.loads(update)
@@ -187,7 +188,7 @@ class RunnerOutputDispatch(ModelDispatch):
       UserMessages.note(json_data["message"]["message"])
       return
     message = OperationProgress.model_validate(json_data["message"])
-    super().dispatch(message.model_dump(mode="json"))
+    super().dispatch(merge_progress(self.model.data, message))
     pass
   pass
 
@@ -27,6 +27,7 @@ from ..server import server
 from ..operations import WIPE_TYPES
 from ...components import network as _network
 from ..socket_protocol import DisksEvent, LogMessageEvent
+from ..emitter import EmitterMetrics
 
 router = APIRouter()
 
@@ -171,7 +172,7 @@ class DisksResponse(BaseModel):
 def route_disks() -> DisksResponse:
   """Handles getting the list of disks"""
   tlog = get_triage_logger()
-  server.disk_portal.detect_disks()
+  # The triage service keeps the disks up to date as they come and go.
   disks = [disk_info(disk) for disk in server.disk_portal.disks]
   tlog.debug(str(disks))
   return DisksResponse(diskPages=1, disks=disks)
@@ -212,6 +213,7 @@ def route_load_image(
   image_size: str | None = Query(alias="size", default=None, description="Image file size, if known"),
   restore_type: str = Query(alias="restoretype", description="Disk restore type"),
   wipe_request: str = Query(default="nowipe", description="Wipe request"),
+  batch: bool = Query(default=False, description="Load all disks from one read of the image"),
 ) -> OperationProgress:
   # WIPE_TYPES = [{"id": "nowipe", "name": "No Wipe", "arg": ""},
   #               {"id": "wipe", "name": "Full wipe", "arg": "-w"},
@@ -223,6 +225,9 @@ def route_load_image(
 
   load_command_runner = server.get_runner(LoadCommandRunner)
 
+  if batch and len(target_disks) > 1:
+    return load_command_runner.queue_batch_load(target_disks, restore_type, imagefile, image_size, wipe_request, newhostname)
+
   for target_disk in target_disks:
     load_command_runner.queue_load(target_disk, restore_type, imagefile, image_size, wipe_request, newhostname)
     pass
@@ -410,6 +415,11 @@ def route_network_device_status() -> List[NetworkDeviceStatus]:
     pass
   return netstat
 
+@router.get("/emitter-status")
+def route_emitter_status() -> EmitterMetrics:
+  """socket.io emit queue depth and counters"""
+  return server.emit_queue.metrics()
+
 @router.post("/unmount")
 def route_unmount(
   devnames: str = Query(alias="deviceNames"),
@@ -24,6 +24,40 @@ class LogsResponse(BaseModel):
   count: int
   total: int
   logs: List[LogEntry]
+  # Pass back as cursor for the page after this one. None on the last page.
+  next_cursor: Optional[int] = None
+  pass
+
+
+class ProgressSample(BaseModel):
+  """One step of a runner at one point in time."""
+  timestamp: str
+  device: Optional[str] = None
+  step: Optional[int] = None
+  status: Optional[str] = None
+  progress: Optional[float] = None
+  elapse: Optional[float] = None
+  runTime: Optional[float] = None
+  runEstimate: Optional[float] = None
+  bytes: Optional[int] = None
+  pass
+
+
+class ProgressSeries(BaseModel):
+  run: int
+  samples: List[ProgressSample]
+  pass
+
+
+class LogStats(BaseModel):
+  """How the log store's writer keeps up. lag is how many seconds the
+  oldest row waiting has waited. dropped is rows dropped because too many
+  were waiting, by level (or by table, for rows without one)."""
+  waiting: int
+  capacity: int
+  lag: float
+  written: int
+  dropped: Dict[str, int]
   pass
 
 
@@ -43,16 +77,32 @@ def route_logs(
     type_: List[LogEventType] = Query(default=[], alias="type"),
     level: List[str] = Query(default=[]),
     source: List[str] = Query(default=[]),
-    q: Optional[str] = Query(default=None, description="substring filter on message text"),
+    q: Optional[str] = Query(default=None, description="substring filter on message and data text"),
     sort: str = Query(default="desc", pattern="^(asc|desc)$"),
+    cursor: Optional[int] = Query(default=None, description="next_cursor of the previous page; start is ignored"),
 ) -> LogsResponse:
   """Browse the sqlite-backed operational log: generic log lines, user
   messages/errors, progress reports, task plans, and command start/end."""
   rows, total = get_log_store().query(
     start=start, count=count,
     event_types=type_ or None, levels=level or None, sources=source or None,
-    q=q, sort_desc=(sort == "desc"))
-  return LogsResponse(start=start, count=count, total=total, logs=[LogEntry(**row) for row in rows])
+    q=q, sort_desc=(sort == "desc"), cursor=cursor)
+  next_cursor = rows[-1]["id"] if len(rows) == count else None
+  return LogsResponse(start=start, count=count, total=total, logs=[LogEntry(**row) for row in rows],
+                      next_cursor=next_cursor)
+
+
+@router.get("/logs/runs/{run}/progress", operation_id="route_logs_run_progress")
+def route_logs_run_progress(run: int) -> ProgressSeries:
+  """A run's progress over time, e.g. for a throughput graph. The runs are
+  the PLAN rows of /logs - run is the PLAN row's id."""
+  samples = get_log_store().progress_series(run)
+  return ProgressSeries(run=run, samples=[ProgressSample(**sample) for sample in samples])
+
+
+@router.get("/logs/stats", operation_id="route_logs_stats")
+def route_logs_stats() -> LogStats:
+  return LogStats(**get_log_store().stats())
 
 
 @router.get("/logs/facets", operation_id="route_logs_facets")
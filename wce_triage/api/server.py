@@ -7,9 +7,7 @@ server data storage
 """
 import logging
 import os, re
-import queue
 import sys
-import time
 from typing import Optional, cast
 import itertools
 import datetime
@@ -21,6 +19,8 @@ import traceback
 
 from . import op_load, op_save, op_sync, op_wipe, op_unmount, op_opticaldrive
 from .config import Config
+from .emitter import EmitQueue
+from .triage_service import TriageService
 from .formatters import jsoned_disk, CpuInfo
 from .messages import UserMessages, ErrorMessages
 from .models import Model, ModelDispatch, ModelMeta
@@ -35,14 +35,14 @@ from ..const import const
 from ..ops.protocol import idle_operation_progress
 from .socket_protocol import ComponentDecision, TriageUpdateEvent
 from ..lib import get_triage_logger
-from ..lib.log_store import get_log_store, LogEventType
+from ..lib.log_store import get_log_store, LogEventType, ProgressRecorder
 
 wce_share_re = re.compile(const.wce_share + r'=([\w/.+\-_:?=@#*&\\%]+)')
 wce_payload_re = re.compile(const.wce_payload + r'=([\w.+\-_:?=@#*&\\%]+)')
 
-class TriageServer(threading.Thread):
+class TriageServer(object):
   config: Config
-  emit_queue: queue.SimpleQueue
+  emit_queue: EmitQueue
   _disks: ModelDispatch
   _loading: ModelDispatch
   _save_image: ModelDispatch
@@ -58,11 +58,12 @@ class TriageServer(threading.Thread):
   triage_timestamp: Optional[datetime.datetime]
   overall_decision: list
   target_disks: list
+  service: TriageService
+  progress_recorder: ProgressRecorder
   dispatches : dict
   locks: dict
 
   def __init__(self):
-    super().__init__(name="TriageServer")
     self.tlog = get_triage_logger()
     self._socketio_view = SocketIOView()
     self._disks = ModelDispatch(DiskModel(default = {"disks": []}), view=self._socketio_view)
@@ -92,6 +93,8 @@ class TriageServer(threading.Thread):
     self._triage = ModelDispatch(Model(meta=ModelMeta(tag="triageupdate"), default={"components": []}), view=self._socketio_view)
     self.triage_timestamp = None
     self.target_disks = []
+    self.service = TriageService(self)
+    self.progress_recorder = ProgressRecorder()
     self.locks = {}
     for lock_name in ["cpu_info"] :
       self.locks[lock_name] = threading.Lock()
@@ -101,6 +104,10 @@ class TriageServer(threading.Thread):
 
   def setup(self, config: Config):
     self.config = config
+    self.progress_recorder.interval = config.PROGRESS_SAMPLE_INTERVAL
+    log_store = get_log_store()
+    log_store.ring_size = config.LOG_RING_SIZE
+    log_store.overflow = config.LOG_OVERFLOW
 
     payload = self.config.PAYLOAD
     if payload:
@@ -129,10 +136,7 @@ class TriageServer(threading.Thread):
       pass
     pass
 
-  def set_config(self, emit_queue: queue.SimpleQueue, config):
-    if self.is_alive():
-      return
-
+  def set_config(self, emit_queue: EmitQueue, config):
     # self.app = app
     self.emit_queue = emit_queue
     message_socketio_view = MessageSocketIOView("message")
@@ -142,27 +146,18 @@ class TriageServer(threading.Thread):
     ErrorMessages.set_view(view)
 
     self.setup(config)
-    try:
-      self.start()
-    except RuntimeError:
-      pass
     pass
 
   def get_lock(self, lock_name) -> threading.Lock:
     return self.locks.get(lock_name)
 
-  def run(self):
-    def periodic_task():
-      while True:
-        if self.triage_timestamp is None:
-          self.initial_triage()
-          pass
-        self.update_triage()
-        self.check_autoload()
-        time.sleep(2)
-        pass
-      pass
-    periodic_task()
+  def start_service(self):
+    """Starts re-evaluating triage as things change. Call in the event loop."""
+    self.service.start()
+    pass
+
+  def stop_service(self):
+    self.service.stop()
     pass
 
   def overall_changed(self, new_decision):
@@ -258,6 +253,12 @@ class TriageServer(threading.Thread):
       pass
     return self._disk_portal
 
+  def note_disk_uevent(self, action: str, devnum: str) -> None:
+    if self._disk_portal is not None:
+      self._disk_portal.note_uevent(action, devnum)
+      pass
+    pass
+
   @property
   def emit_count(self) -> int:
     # a bit of a hack but convenient
@@ -295,17 +296,18 @@ class TriageServer(threading.Thread):
   def send_to_ui(self, event: str, message: dict):
     if isinstance(message, dict):
       message['_sequence_'] = self.emit_count
+      # The log store turns data into JSON later, on its writer thread, and
+      # the same dict goes on to emit_queue and socket.io. Nothing past
+      # this point may change message - that would change the stored row.
       if event == "message":
         etype = LogEventType.ERROR if message.get("severity") == 2 else LogEventType.MESSAGE
-        log_message = message.get("message", "")
-      elif message.get("report") == "tasks":
-        etype = LogEventType.PLAN
-        log_message = event
+        get_log_store().log(etype, message.get("message", ""), source=event, data=message)
+      elif message.get("report"):
+        # A runner's OperationProgress - the plan, then samples.
+        self.progress_recorder.record(event, message)
       else:
-        etype = LogEventType.PROGRESS
-        log_message = event
+        get_log_store().log(LogEventType.PROGRESS, event, source=event, data=message)
         pass
-      get_log_store().log(etype, log_message, source=event, data=message)
       pass
     self.emit_queue.put((event, message))
     # asyncio.run_coroutine_threadsafe(self.socketio.emit(event, message), asyncio.get_event_loop())
@@ -0,0 +1,262 @@
+"""
+Re-evaluates triage when something changes, instead of every 2 seconds.
+
+Runs in uvicorn's event loop. The kernel says when something changed:
+  - a block device came or went (uevent netlink, NETLINK_KOBJECT_UEVENT -
+    the kernel's event, and udevd's once its rules have run),
+  - a network link went up or down (rtnetlink, RTMGRP_LINK),
+  - the mount table changed (/proc/self/mounts turns POLLPRI).
+A burst of events - a disk and its partitions are a dozen uevents - is
+folded into one re-evaluation, DEBOUNCE seconds after the first one. The
+re-evaluation (TriageServer.update_triage() and check_autoload()) runs
+subprocesses and reads sysfs, so it runs on a worker thread, one at a time.
+
+When one of the sources can't be opened, it polls every POLL_INTERVAL like
+it used to. Otherwise it only looks every SAFETY_INTERVAL, for anything the
+kernel doesn't announce.
+"""
+import asyncio
+import select
+import socket
+import struct
+import typing
+
+from ..lib import get_triage_logger
+
+if typing.TYPE_CHECKING:
+  from .server import TriageServer
+
+NETLINK_KOBJECT_UEVENT = 15
+# The kernel's own uevent multicast group, and udevd's. udevd's event comes
+# after udev has run its rules and written its database (DiskPortal waits
+# for that), but only when udevd is running. Both, as a bitmask.
+UEVENT_KERNEL_GROUP = 1
+UEVENT_UDEV_GROUP = 2
+# udevd's events: "libudev\0", then struct udev_monitor_netlink_header.
+UDEV_MONITOR_MAGIC = 0xfeedcafe
+udev_monitor_header = struct.Struct("=8sIIII")
+RTMGRP_LINK = 1
+
+DEBOUNCE = 0.3
+POLL_INTERVAL = 2
+SAFETY_INTERVAL = 60
+
+# uevent subsystems triage cares about
+UEVENT_SUBSYSTEMS = ("block", "net")
+
+tlog = get_triage_logger()
+
+
+def _open_uevent_socket() -> socket.socket:
+  sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC,
+                       NETLINK_KOBJECT_UEVENT)
+  sock.bind((0, UEVENT_KERNEL_GROUP | UEVENT_UDEV_GROUP))
+  return sock
+
+
+def _open_link_socket() -> socket.socket:
+  sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC,
+                       socket.NETLINK_ROUTE)
+  sock.bind((0, RTMGRP_LINK))
+  return sock
+
+
+class _MountWatch:
+  """/proc/self/mounts is always readable, and turns POLLPRI when the mount
+  table changes. The event loop only waits for readable, so a private epoll
+  waits for POLLPRI - its own fd is readable when that happens."""
+
+  def __init__(self):
+    self.mounts = open("/proc/self/mounts")
+    self.epoll = select.epoll()
+    self.epoll.register(self.mounts.fileno(), select.EPOLLPRI | select.EPOLLERR)
+    pass
+
+  def fileno(self):
+    return self.epoll.fileno()
+
+  def drain(self):
+    # Polling /proc/self/mounts is what clears its POLLPRI. The event loop
+    # checking this epoll may have cleared it already, so whatever this
+    # returns, the mount table did change.
+    self.epoll.poll(0)
+    pass
+
+  def close(self):
+    self.epoll.close()
+    self.mounts.close()
+    pass
+  pass
+
+
+def parse_uevent(datagram: bytes) -> typing.Dict[str, str]:
+  """The KEY=value fields of a kernel uevent: "action@devpath\\0KEY=value\\0...",
+  or of udevd's, whose KEY=value\\0... come after a binary header."""
+  if datagram.startswith(b"libudev\0"):
+    if len(datagram) < udev_monitor_header.size:
+      return {}
+    _prefix, magic, _header_size, properties_off, properties_len = udev_monitor_header.unpack_from(datagram)
+    if socket.ntohl(magic) != UDEV_MONITOR_MAGIC:
+      return {}
+    datagram = b"\0" + datagram[properties_off:properties_off + properties_len]
+    pass
+  fields = {}
+  for field in datagram.split(b"\0")[1:]:
+    key, sep, value = field.partition(b"=")
+    if sep:
+      fields[key.decode("ascii", "replace")] = value.decode("utf-8", "replace")
+      pass
+    pass
+  return fields
+
+
+class TriageService:
+  server: "TriageServer"
+
+  def __init__(self, server, debounce=DEBOUNCE):
+    self.server = server
+    self.debounce = debounce
+    self.loop = None
+    self.sources = []
+    self.interval = SAFETY_INTERVAL
+    self._pending = None
+    self._running = False
+    self._again = False
+    self._ticker = None
+    self.update_count = 0
+    pass
+
+  def start(self):
+    """Starts watching, and runs the initial triage. Call in the event loop."""
+    self.loop = asyncio.get_running_loop()
+    for description, opener, handler in [("uevent netlink", _open_uevent_socket, self._on_uevent),
+                                         ("rtnetlink", _open_link_socket, self._on_link),
+                                         ("mount table", _MountWatch, self._on_mounts)]:
+      try:
+        source = opener()
+      except OSError as exc:
+        tlog.info("Can't watch %s (%s) - polling every %d seconds." % (description, exc, POLL_INTERVAL))
+        self.interval = POLL_INTERVAL
+        continue
+      self.loop.add_reader(source.fileno(), handler, source)
+      self.sources.append(source)
+      pass
+    self._ticker = self.loop.create_task(self._tick())
+    self.request_update(now=True)
+    pass
+
+  def stop(self):
+    if self._ticker:
+      self._ticker.cancel()
+      self._ticker = None
+      pass
+    if self._pending:
+      self._pending.cancel()
+      self._pending = None
+      pass
+    for source in self.sources:
+      self.loop.remove_reader(source.fileno())
+      source.close()
+      pass
+    self.sources = []
+    pass
+
+  def request_update(self, now=False):
+    """Has triage re-evaluated soon. Safe to call from any thread."""
+    if self.loop is None:
+      return
+    self.loop.call_soon_threadsafe(self._schedule, 0 if now else self.debounce)
+    pass
+
+  def _schedule(self, delay):
+    # Already scheduled: this event goes with the one coming up.
+    if self._pending is None:
+      self._pending = self.loop.call_later(delay, self._fire)
+      pass
+    pass
+
+  def _fire(self):
+    self._pending = None
+    if self._running:
+      # Once more after this one, with what came in meanwhile.
+      self._again = True
+      return
+    self._running = True
+    self.loop.create_task(self._evaluate())
+    pass
+
+  async def _evaluate(self):
+    try:
+      await self.loop.run_in_executor(None, self._update)
+    except Exception as exc:
+      tlog.info("Triage update failed: %s" % exc)
+      pass
+    finally:
+      self._running = False
+      if self._again:
+        self._again = False
+        self._schedule(0)
+        pass
+      pass
+    pass
+
+  def _update(self):
+    self.update_count += 1
+    if self.server.triage_timestamp is None:
+      self.server.initial_triage()
+      pass
+    self.server.update_triage()
+    self.server.check_autoload()
+    pass
+
+  async def _tick(self):
+    while True:
+      await asyncio.sleep(self.interval)
+      self._schedule(0)
+      pass
+    pass
+
+  def _on_uevent(self, sock):
+    changed = False
+    while True:
+      try:
+        datagram = sock.recv(2 ** 16)
+      except BlockingIOError:
+        break
+      except OSError as exc:
+        # ENOBUFS - we fell behind and lost some. Look anyway.
+        tlog.debug("uevent: %s" % exc)
+        changed = True
+        break
+      fields = parse_uevent(datagram)
+      subsystem = fields.get("SUBSYSTEM")
+      if subsystem in UEVENT_SUBSYSTEMS:
+        changed = True
+        if subsystem == "block" and fields.get("DEVTYPE") == "disk":
+          self.server.note_disk_uevent(fields.get("ACTION"), "%s:%s" % (fields.get("MAJOR"), fields.get("MINOR")))
+          pass
+        pass
+      pass
+    if changed:
+      self._schedule(self.debounce)
+      pass
+    pass
+
+  def _on_link(self, sock):
+    while True:
+      try:
+        sock.recv(2 ** 16)
+      except BlockingIOError:
+        break
+      except OSError as exc:
+        tlog.debug("rtnetlink: %s" % exc)
+        break
+      pass
+    self._schedule(self.debounce)
+    pass
+
+  def _on_mounts(self, watch):
+    watch.drain()
+    self._schedule(self.debounce)
+    pass
+  pass
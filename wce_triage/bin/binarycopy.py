@@ -3,12 +3,19 @@
 
 This reads the partition map using parted and figures out the size of copy.
 If there is no partition, then this is no go.
+
+With -s (sparse), only the blocks the file systems use are copied, and the
+rest of the destination is left alone.
 """
 
-import os, sys, datetime
+import os, sys, datetime, stat, errno, fcntl
 import typing
 
 from ..lib.timeutil import in_seconds
+from ..lib.io_tuner import WriteSizeTuner, DEFAULT_WRITE_SIZES
+from ..lib.verify import new_hash, drop_cached_pages, readback_digest
+from ..lib.fs_extents import disk_used_extents
+from ..lib.util import get_triage_logger
 from ..components.disk import DiskPortal, PartitionLister
 from ..ops.run_state import RunState
 from ..ops.protocol import ProgressReport, ProgressEnvelope
@@ -17,25 +24,87 @@ import io
 import queue
 import mmap
 
+tlog = get_triage_logger()
+
 def handler_stop_signals(signum: int, _frame: typing.Any) -> None:
   global running
   running = False
   pass
 
+def open_destination(destpath):
+  """Opens destpath for writing with O_DIRECT, so that what the tuner times
+is the device, not a copy into the page cache. Returns the file, and whether
+it is O_DIRECT - not when the file system doesn't do it."""
+  flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+  if hasattr(os, "O_DIRECT"):
+    try:
+      return io.FileIO(os.open(destpath, flags | os.O_DIRECT, 0o666), "w"), True
+    except OSError as exc:
+      tlog.info("O_DIRECT open of %s failed. (%s) Using buffered write." % (destpath, exc))
+      pass
+    pass
+  return io.FileIO(os.open(destpath, flags, 0o666), "w"), False
+
+
 class RawWriter(threading.Thread):
 
-  def __init__(self, destpath, queue_size, verbose=False):
+  def __init__(self, destpath, queue_size, verbose=False, write_sizes=None, verify_extents=None, total_size=None):
     super().__init__()
     self.destpath = destpath
     self.dest = None
+    # Whether O_DIRECT is on right now, and whether the destination takes it
+    # at all. It's off for the pieces O_DIRECT can't take.
+    self.direct = False
+    self.can_direct = False
     self.queue = queue.Queue(maxsize=queue_size)
     self.size_written = 0
+    self.position = 0
+    self.total_size = total_size
     self.verbose = False
+    # Each destination writes the shared buffer in pieces of its own best size
+    self.tuner = WriteSizeTuner(candidates=write_sizes)
+    # When set, read back these extents after the copy and keep the digest.
+    self.verify_extents = verify_extents
+    self.digest = None
+    pass
+
+  def write_payload(self, payload):
+    if self.can_direct and not self.direct:
+      self.set_direct(True)
+      pass
+    view = memoryview(payload)
+    offset = 0
+    while offset < len(view):
+      was_locked = self.tuner.locked
+      started = self.tuner.start()
+      try:
+        written = self.dest.write(view[offset:offset + self.tuner.next_size()])
+      except OSError as exc:
+        if exc.errno != errno.EINVAL or not self.direct:
+          raise
+        # O_DIRECT takes only whole logical blocks. The tail of the source,
+        # or a sparse copy's extent that isn't aligned, goes the buffered way.
+        self.set_direct(False)
+        continue
+      self.tuner.record(written, started)
+      offset += written
+      if self.tuner.locked and not was_locked:
+        tlog.info("%s: %s" % (self.destpath, self.tuner.describe()))
+        pass
+      pass
+    view.release()
+    pass
+
+  def set_direct(self, direct):
+    flags = fcntl.fcntl(self.dest.fileno(), fcntl.F_GETFL)
+    fcntl.fcntl(self.dest.fileno(), fcntl.F_SETFL, (flags | os.O_DIRECT) if direct else (flags & ~os.O_DIRECT))
+    self.direct = direct
     pass
 
   def start(self):
+    self.dest, self.can_direct = open_destination(self.destpath)
+    self.direct = self.can_direct
     super().start()
-    self.dest = io.FileIO(self.destpath, "w")
     pass
   
   def run(self):
@@ -44,10 +113,16 @@ class RawWriter(threading.Thread):
     global running
     while running:
       try:
-        payload = self.queue.get()
-        if payload is None:
+        item = self.queue.get()
+        if item is None:
           break
-        self.dest.write(payload)
+        offset, payload = item
+        if offset != self.position:
+          # Skipping over what a sparse copy leaves out.
+          self.dest.seek(offset)
+          pass
+        self.write_payload(payload)
+        self.position = offset + len(payload)
         self.size_written += len(payload)
         if self.verbose:
           print("writer: written {}, payload {}".format(self.size_written, len(payload)))
@@ -57,7 +132,21 @@ class RawWriter(threading.Thread):
         self.queue.task_done()
         pass
       pass
+    # A file destination still has to come out as big as the source.
+    if self.total_size and self.position < self.total_size and stat.S_ISREG(os.fstat(self.dest.fileno()).st_mode):
+      self.dest.truncate(self.total_size)
+      pass
+    if self.verify_extents is not None:
+      drop_cached_pages(self.dest.fileno())
+      pass
     self.dest.close()
+    if self.verify_extents is not None:
+      try:
+        self.digest = readback_digest(self.destpath, None, extents=self.verify_extents)
+      except Exception as exc:
+        tlog.info("%s: read back failed. %s" % (self.destpath, str(exc)))
+        pass
+      pass
     pass
   pass
 
@@ -99,6 +188,25 @@ class ProgressReporter:
     envelope = ProgressEnvelope(event="binarycopy", message=report)
     print(envelope.model_dump_json(exclude_none=True), file=self.output, flush=True)
     pass
+
+  def report_verdict(self, destination, verified):
+    self.current_time = datetime.datetime.now()
+    dt_elapsed = in_seconds(self.current_time - self.start_time)
+    verdict = "Verified" if verified else "Verify failed. Destination differs from the source."
+    report = ProgressReport(key=destination,
+                             runStatus=RunState.Success if verified else RunState.Failed,
+                             runMessage=verdict,
+                             progress=100 if verified else 999,
+                             runTime=round(dt_elapsed),
+                             totalBytes=self.total_size,
+                             remainingBytes=0,
+                             destination=destination,
+                             startTime=self.start_time,
+                             currentTime=self.current_time,
+                             verdict=verdict)
+    envelope = ProgressEnvelope(event="binarycopy", message=report)
+    print(envelope.model_dump_json(exclude_none=True), file=self.output, flush=True)
+    pass
   pass
 
 
@@ -109,21 +217,47 @@ def get_min_written_size(size_written, writers):
   return size_written
 
 
-def binary_copy(source, total_size, dests, output=sys.stderr):
+def split_extents(extents, buffer_size):
+  """(offset, length) pieces of the extents, none bigger than the buffer."""
+  for offset, length in extents:
+    end = offset + length
+    while offset < end:
+      yield offset, min(buffer_size, end - offset)
+      offset += buffer_size
+      pass
+    pass
+  pass
+
+
+def binary_copy(source, total_size, dests, output=sys.stderr, verify=False, extents=None):
   """Binary copy bits to disk
 source: file handle
 total_size: size to copy
 dest_dev: Device file eg. /dev/sdc
+verify: read back each destination and compare it with the source's hash.
+extents: (offset, length) of the parts to copy. Everything else is skipped
+  on both sides. Default is the whole total_size.
+Returns the list of destinations that failed verification.
 """
   global running
   running = True
   
-  buffer_size = 2**20
-  n_buffers = 100
+  # The buffer has to hold the biggest write size the tuner tries.
+  buffer_size = 2**22
+  n_buffers = 25
   buffers = []
+  write_sizes = [ size for size in DEFAULT_WRITE_SIZES if size <= buffer_size ]
+
+  if extents is None:
+    extents = [(0, total_size)]
+    pass
+  copy_size = sum(length for offset, length in extents)
 
   buffers = [ mmap.mmap(-1, buffer_size) for i in range(n_buffers) ]
-  writers = [ RawWriter(dst, n_buffers/2, verbose=dst == dests[0]) for dst in dests ]
+  writers = [ RawWriter(dst, n_buffers // 2, verbose=dst == dests[0], write_sizes=write_sizes,
+                        verify_extents=extents if verify else None, total_size=total_size) for dst in dests ]
+  # The source is hashed as it is read, while the writers are busy.
+  hasher = new_hash() if verify else None
   for writer in writers: writer.start()
 
   loop_count = 0
@@ -132,36 +266,39 @@ dest_dev: Device file eg. /dev/sdc
   #signal.signal(signal.SIGINT, handler_stop_signals)
   #signal.signal(signal.SIGTERM, handler_stop_signals)
 
-  progress_reporter = ProgressReporter(total_size, output=output)
+  progress_reporter = ProgressReporter(copy_size, output=output)
+  position = 0
 
-  while running and (size_done < total_size):
+  for offset, chunk_size in split_extents(extents, buffer_size):
+    if not running:
+      break
     buffer = buffers[loop_count % n_buffers]
 
-    size_read = source.readinto(buffer)
-    if size_read == None:
+    if offset != position:
+      source.seek(offset)
+      pass
+    view = memoryview(buffer)[:chunk_size]
+    size_read = source.readinto(view)
+    view.release()
+    if not size_read:
       break
+    position = offset + size_read
 
     # So, what's hapenning here is that, the queue length is same as
     # the number of buffer, so when the queue is full, the producer has
     # to wait for queue.
     # In the end, all writes are done when the slowest one is done.
     
-    if size_read == len(buffer):
-      payload = buffer
-    else:
-      payload = buffer[:size_read]
-      pass
+    # Not buffer[:size_read] - that's a copy, and not page aligned for O_DIRECT.
+    payload = buffer if size_read == len(buffer) else memoryview(buffer)[:size_read]
 
     size_done += size_read
-
-    for writer in writers:
-      writer.queue.put( payload )
+    if hasher:
+      hasher.update(payload)
       pass
 
-    if size_done >= total_size:
-      for writer in writers:
-        writer.queue.put( None )
-        pass
+    for writer in writers:
+      writer.queue.put( (offset, payload) )
       pass
 
     loop_count += 1
@@ -171,6 +308,10 @@ dest_dev: Device file eg. /dev/sdc
     progress_reporter.maybe_report(size_written)
     pass
 
+  for writer in writers:
+    writer.queue.put( None )
+    pass
+
   for writer in writers:
     writer.queue.join()
     writer.join()
@@ -180,20 +321,44 @@ dest_dev: Device file eg. /dev/sdc
 
   size_written = get_min_written_size(size_done, writers)
   progress_reporter.report(size_written)
-  pass
+
+  failed = []
+  if hasher:
+    source_digest = hasher.digest() if size_done >= copy_size else None
+    for writer in writers:
+      verified = source_digest is not None and writer.digest == source_digest
+      progress_reporter.report_verdict(writer.destpath, verified)
+      if not verified:
+        failed.append(writer.destpath)
+        pass
+      pass
+    pass
+  return failed
 
 
 if __name__ == "__main__":
-  if len(sys.argv) < 2:
-    sys.stderr.write('binarycopy.py master [clones...]\n')
+  args = sys.argv[1:]
+  verify = False
+  sparse = False
+  while args and args[0] in ['-v', '-s']:
+    if args[0] == '-v':
+      verify = True
+    else:
+      sparse = True
+      pass
+    args = args[1:]
+    pass
+  if len(args) < 1:
+    sys.stderr.write('binarycopy.py [-v] [-s] master [clones...]\n')
     sys.exit(1)
     pass
     
   disk_portal = DiskPortal()
   (added, changed, removed) = disk_portal.detect_disks()
 
-  master = sys.argv[1]
-  clones = sys.argv[2:]
+  master = args[0]
+  clones = args[1:]
+  extents = None
 
   masterdisk = None
   for disk in disk_portal.disks:
@@ -214,6 +379,10 @@ if __name__ == "__main__":
     lastpart = masterdisk.partitions[-1]
     total_size = (lastpart.end_sector + 1)*512
     source = io.FileIO(master)
+    if sparse:
+      extents = disk_used_extents(masterdisk.partitions, total_size)
+      print("sparse copy: {} of {} bytes".format(sum(length for offset, length in extents), total_size))
+      pass
     pass
   else:
     if os.path.exists(master):
@@ -228,6 +397,7 @@ if __name__ == "__main__":
     pass
   
   print("total_size = {}".format(total_size))
-  binary_copy(source, total_size, clones)
+  failed = binary_copy(source, total_size, clones, verify=verify, extents=extents)
+  sys.exit(1 if failed else 0)
   pass
     
@@ -6,9 +6,10 @@ from ..lib.util import get_triage_logger
 from ..lib.timeutil import in_seconds
 from ..ops.run_state import RunState
 from ..ops.protocol import ProgressReport, ProgressEnvelope
-import queue
+from ..lib.verify import new_hash, drop_cached_pages, readback_digest, DIGEST_SIZE
 import time
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import typing
 
 start_time = datetime.datetime.now()
@@ -27,45 +28,269 @@ def debuglog(msg):
     pass
   pass
 
+# Writer states, kept in SharedRing.states
+WRITER_RUNNING = 0
+WRITER_DONE = 1
+WRITER_FAILED = 2
+WRITER_DETACHED = 3
+WRITER_VERIFYING = 4
+
+
+class SharedRing:
+  '''Ring of fixed size chunks in shared memory.
+
+The reader (parent) fills a slot and publishes it by bumping "produced".
+Each writer process keeps its own cursor (the number of chunks it has
+written), and reads the slot straight out of the shared memory, so a chunk
+is never pickled or copied per destination. A slot is reusable once every
+live writer's cursor has moved past it.
+
+A writer that falls lag_window chunks behind the fastest writer detaches
+itself from the ring and reads the rest from the source file on its own,
+so one slow destination holds up the others by at most one chunk write.
+
+With verification, the reader hashes the source as it goes and leaves the
+digest in source_digest before closing the stream. Writers read their
+destination back and compare against it.
+'''
+
+  def __init__(self, n_writers, lag_window, slot_size):
+    self.n_writers = n_writers
+    self.lag_window = lag_window
+    # One more slot than the window so the lagging writer can finish the
+    # chunk it's writing while the reader fills the rest.
+    n_slots = lag_window + 1
+    self.n_slots = n_slots
+    self.slot_size = slot_size
+    self.shm = shared_memory.SharedMemory(create=True, size=n_slots * slot_size)
+    self.cond = mp.Condition()
+    # Everything below is guarded by self.cond
+    self.produced = mp.Value('q', 0, lock=False)
+    self.eof = mp.Value('b', 0, lock=False)
+    self.lengths = mp.Array('q', n_slots, lock=False)
+    self.cursors = mp.Array('q', n_writers, lock=False)
+    self.written = mp.Array('q', n_writers, lock=False)
+    self.states = mp.Array('b', n_writers, lock=False)
+    self.source_digest = mp.Array('c', DIGEST_SIZE, lock=False)
+    self.digest_ready = mp.Value('b', 0, lock=False)
+    # Per writer verification progress and result - written by the writer only.
+    self.verified = mp.Array('q', n_writers, lock=False)
+    self.verify_failed = mp.Array('b', n_writers, lock=False)
+    pass
+
+  def slot_view(self, chunk):
+    slot = chunk % self.n_slots
+    offset = slot * self.slot_size
+    return self.shm.buf[offset:offset + self.slot_size]
+
+  def _attached_cursors(self):
+    return [self.cursors[idx] for idx in range(self.n_writers) if self.states[idx] == WRITER_RUNNING]
+
+  def _slowest_cursor(self):
+    cursors = self._attached_cursors()
+    return min(cursors) if cursors else None
+
+  #
+  # Reader side
+  #
+  def wait_for_free_slot(self, timeout=1):
+    '''Returns True when the next slot can be filled. False on timeout, so
+the caller gets to check whether writers died under it.'''
+    with self.cond:
+      slowest = self._slowest_cursor()
+      if slowest is None or self.produced.value - slowest < self.n_slots:
+        return True
+      self.cond.wait(timeout)
+      slowest = self._slowest_cursor()
+      return slowest is None or self.produced.value - slowest < self.n_slots
+    pass
+
+  def publish(self, length):
+    with self.cond:
+      self.lengths[self.produced.value % self.n_slots] = length
+      self.produced.value += 1
+      self.cond.notify_all()
+      pass
+    pass
+
+  def close_stream(self, digest=None):
+    with self.cond:
+      if digest is not None:
+        self.source_digest.raw = digest
+        self.digest_ready.value = 1
+        pass
+      self.eof.value = 1
+      self.cond.notify_all()
+      pass
+    pass
+
+  def n_running(self):
+    '''Number of writers still reading from the ring.'''
+    with self.cond:
+      return len([idx for idx in range(self.n_writers) if self.states[idx] == WRITER_RUNNING])
+    pass
+
+  def mark_failed(self, idx):
+    with self.cond:
+      if self.states[idx] in (WRITER_RUNNING, WRITER_DETACHED, WRITER_VERIFYING):
+        self.states[idx] = WRITER_FAILED
+        pass
+      self.cond.notify_all()
+      pass
+    pass
+
+  #
+  # Writer side
+  #
+  def next_chunk(self, idx):
+    '''Blocks until the writer idx has a chunk to write. Returns the chunk
+number and its length, None at the end of stream, or WRITER_DETACHED when
+the writer is too far behind and has to read the source on its own.'''
+    with self.cond:
+      while self.cursors[idx] >= self.produced.value:
+        if self.eof.value:
+          return None
+        self.cond.wait()
+        pass
+      chunk = self.cursors[idx]
+      if not self.eof.value and max(self._attached_cursors()) - chunk >= self.lag_window:
+        self.states[idx] = WRITER_DETACHED
+        self.cond.notify_all()
+        return WRITER_DETACHED
+      return chunk, self.lengths[chunk % self.n_slots]
+    pass
+
+  def chunk_written(self, idx, length):
+    with self.cond:
+      self.cursors[idx] += 1
+      self.written[idx] += length
+      self.cond.notify_all()
+      pass
+    pass
+
+  def start_verify(self, idx):
+    with self.cond:
+      self.states[idx] = WRITER_VERIFYING
+      self.cond.notify_all()
+      pass
+    pass
+
+  def wait_for_source_digest(self):
+    '''The source digest, once the reader got through the whole source.
+None if the reader never did.'''
+    with self.cond:
+      while not self.eof.value:
+        self.cond.wait()
+        pass
+      return self.source_digest.raw if self.digest_ready.value else None
+    pass
+
+  def writer_finished(self, idx, success):
+    with self.cond:
+      self.states[idx] = WRITER_DONE if success else WRITER_FAILED
+      self.cond.notify_all()
+      pass
+    pass
+
+  def release(self):
+    self.shm.close()
+    try:
+      self.shm.unlink()
+    except FileNotFoundError:
+      pass
+    pass
+  pass
+
+
+def copy_rest_of_source(idx, out, source_file, source_size, ring):
+  '''Detached writer: reads from where it left off straight from the source.'''
+  offset = ring.cursors[idx] * ring.slot_size
+  buffer = bytearray(ring.slot_size)
+  view = memoryview(buffer)
+  with open(source_file, "rb", buffering=0) as source:
+    source.seek(offset)
+    while offset < source_size:
+      length = source.readinto(view)
+      if not length:
+        raise IOError("Source file %s is shorter than expected." % source_file)
+      written = 0
+      while written < length:
+        written += out.write(view[written:length])
+        pass
+      offset += length
+      ring.chunk_written(idx, length)
+      pass
+    pass
+  pass
+
+
 #
 # Write aka consumer process
 #
-def writer(key, filename, pipe):
+def verify_destination(idx, filename, ring, source_size):
+  '''Reads the destination back and compares it with the source digest.'''
+  ring.start_verify(idx)
+  def progress(nbytes):
+    ring.verified[idx] = nbytes
+    pass
+  digest = readback_digest(filename, source_size, buffer_size=ring.slot_size, progress=progress)
+  source_digest = ring.wait_for_source_digest()
+  if source_digest is None or source_digest != digest:
+    debuglog("Writer {} verification failed.".format(idx))
+    ring.verify_failed[idx] = 1
+    return False
+  return True
+
+
+def writer(idx, key, filename, ring, source_file, source_size, verify=False):
   debuglog("start {}\n".format(filename))
   try:
     os.unlink(filename)
   except:
     pass
 
-  with open(filename, "wb") as out:
-    size_written = 0
-    while True:
-      try:
-        data = pipe.recv()
-      except EOFError:
-        pipe.send(None)
-        break
-
-      try:
-        out.write(data)
-        size_written += len(data)
-        pipe.send(size_written)
+  success = False
+  try:
+    with open(filename, "wb", buffering=0) as out:
+      while True:
+        chunk = ring.next_chunk(idx)
+        if chunk is None:
+          break
+        if chunk == WRITER_DETACHED:
+          debuglog("Writer {} detached at chunk {}".format(idx, ring.cursors[idx]))
+          copy_rest_of_source(idx, out, source_file, source_size, ring)
+          break
+        chunk_no, length = chunk
+        view = ring.slot_view(chunk_no)
+        try:
+          written = 0
+          while written < length:
+            written += out.write(view[written:length])
+            pass
+          pass
+        finally:
+          view.release()
+          pass
+        ring.chunk_written(idx, length)
+        pass
+      if verify:
+        drop_cached_pages(out.fileno())
         pass
-      except:
-        pipe.send(None)
-        pipe.close()
-        break
       pass
+    success = verify_destination(idx, filename, ring, source_size) if verify else True
+  except:
+    debuglog("Writer {} got an exception. ".format(idx) + traceback.format_exc())
     pass
+  ring.writer_finished(idx, success)
   pass
 
 
 class fanout_copy:
   '''Copy a file to multiple locations. (aka duplication)
 '''
-  # downstreams: typing.List[ typing.Tuple(Optional[str], str, mp.connection.Connection, mp.Process) ]
+  # downstreams: typing.List[ typing.Tuple(int, Optional[str], str, mp.Process) ]
 
-  def __init__(self, source_file, destinations, output=sys.stderr):
+  def __init__(self, source_file, destinations, output=sys.stderr, lag_window=3, verify=False):
     self.source_file_size = None
     self.source_file = source_file
     self.destination_specs = destinations
@@ -88,19 +313,18 @@ class fanout_copy:
 
     self.source_file_size = source_file_size
     self.copybuf_size = 32 * 1024 * 1024
-    self.readbufs = queue.Queue()
-
-    for dummy in range(4):
-      self.readbufs.put(bytearray(self.copybuf_size))
-      pass
-
-    self.writebufs = queue.Queue()
+    # How many chunks a fast destination may get ahead of the slowest one.
+    self.lag_window = max(1, lag_window)
+    self.verify = verify
+    self.ring = None
 
     self.sofar = 0
     self.progress = 0
     self.report_time = None
 
     self.dead_child = {}
+    self.dead_child_lock = threading.Lock()
+    self.final_reported = set()
     pass
 
 
@@ -110,7 +334,7 @@ class fanout_copy:
     self.copy()
     self.teardown()
     pass
-  
+
 
   def open_source(self):
     try:
@@ -123,13 +347,13 @@ class fanout_copy:
 
   def open_destinations(self):
     self.downstreams = []
+    self.ring = SharedRing(len(self.destination_specs), self.lag_window, self.copybuf_size)
     for idx, destination in enumerate(self.destination_specs):
       dest = destination.split(':')
       key, filename = (None, dest[0]) if len(dest) == 1 else (dest[0], dest[1])
-      mine, kid = mp.Pipe()
-      child = mp.Process(target=writer, args=(key, filename, kid))
+      child = mp.Process(target=writer, args=(idx, key, filename, self.ring, self.source_file, self.source_file_size, self.verify))
       child.start()
-      self.downstreams.append((idx, key, filename, mine, child))
+      self.downstreams.append((idx, key, filename, child))
       pass
     pass
 
@@ -155,118 +379,105 @@ class fanout_copy:
 
   def report_read_error(self, **kwargs):
     run_message = "Read failed. %d of %d bytes copied." % (self.sofar, self.source_file_size)
-    for idx, key, filename, pipe, child in self.downstreams:
+    for idx, key, filename, child in self.downstreams:
       self._report_error(key, filename, run_message, **kwargs)
       pass
     pass
 
 
-  def report_write_error(self, key, filename, **kwargs):
-    run_message = "Write failed. %d of %d bytes copied." % (self.sofar, self.source_file_size)
+  def report_write_error(self, key, filename, size_written, **kwargs):
+    run_message = "Write failed. %d of %d bytes copied." % (size_written, self.source_file_size)
     self._report_error(key, filename, run_message, **kwargs)
     pass
 
 
+  def check_writers(self):
+    '''Notices the writer processes that failed or died.'''
+    with self.dead_child_lock:
+      self._check_writers()
+      pass
+    pass
+
+  def _check_writers(self):
+    for idx, key, filename, child in self.downstreams:
+      if idx in self.dead_child:
+        continue
+      state = self.ring.states[idx]
+      if state in (WRITER_RUNNING, WRITER_DETACHED, WRITER_VERIFYING) and not child.is_alive():
+        debuglog("child %d died" % idx)
+        self.ring.mark_failed(idx)
+        state = WRITER_FAILED
+        pass
+      if state == WRITER_FAILED:
+        size_written = self.ring.written[idx]
+        if self.ring.verify_failed[idx]:
+          self.dead_child[idx] = ("Verify failed", size_written)
+          self._report_error(key, filename, "Verify failed. %s differs from the source." % filename)
+        else:
+          self.dead_child[idx] = ("Write failed", size_written)
+          self.report_write_error(key, filename, size_written)
+          pass
+        pass
+      pass
+    pass
+
+
   def reader(self):
     read_remaining = self.source_file_size
     copybuf_size = self.copybuf_size
+    chunk = 0
+    # Hashing here overlaps with the writer processes' I/O, and the source
+    # is read only once.
+    hasher = new_hash() if self.verify else None
     while self.running and read_remaining > 0:
-      copy_size = copybuf_size if read_remaining >= copybuf_size else read_remaining
+      if not self.ring.wait_for_free_slot():
+        self.check_writers()
+        if self.ring.n_running() == 0 and hasher is None:
+          break
+        continue
 
-      copybuf = self.readbufs.get()
+      view = self.ring.slot_view(chunk)
       try:
-        bytesread = self.source_fd.readinto(copybuf)
+        bytesread = self.source_fd.readinto(view[:min(copybuf_size, read_remaining)])
+        if not bytesread:
+          raise IOError("Source file %s is shorter than expected." % self.source_file)
         read_remaining -= bytesread
-        if copy_size == copybuf_size:
-          valid_data = copybuf
-        else:
-          # This must be the last read
-          valid_data = copybuf[:bytesread]
-          self.readbufs.put(copybuf)
+        if hasher:
+          hasher.update(view[:bytesread])
           pass
-        self.writebufs.put(valid_data)
+        self.ring.publish(bytesread)
+        chunk += 1
+        self.sofar += bytesread
+        # Nobody reads from the ring anymore. Detached writers carry on.
+        # (Still need the whole source for the digest, though.)
+        if self.ring.n_running() == 0 and hasher is None:
+          break
       except Exception as exc:
         debuglog("Reader got an exception. " + traceback.format_exc())
         self.running = False
         self.report_read_error()
         continue
+      finally:
+        view.release()
+        pass
       pass
-    self.writebufs.put(None)
+    digest = hasher.digest() if hasher and read_remaining == 0 else None
+    self.ring.close_stream(digest=digest)
     debuglog("Reader sent EOF.")
     self.source_fd.close()
     pass
 
 
-  def writer(self):
-    self.sofar = 0
-    self.write_start_time = datetime.datetime.now()
-    
-    while self.running and self.source_file_size > self.sofar:
-      buf = self.writebufs.get()
-      if buf is None:
-        break
-
-      n_alive = 0
-
-      for idx, key, filename, pipe, child in self.downstreams:
-        if self.dead_child.get(idx):
-          debuglog("1: child %d dead" % idx)
-          continue
-        if not child.is_alive():
-          debuglog("2: child %d dead" % idx)
-          continue
-
-        try:
-          pipe.send(buf)
-          n_alive += 1
-        except:
-          debuglog("Writer got an exception. " + traceback.format_exc())
-          try:
-            debuglog("killing %d" % idx)
-            child.kill()
-          except:
-            debuglog("killing %d failed" % idx)
-            pass
-          self.dead_child[idx] = (traceback.format_exc(), self.sofar)
-          self.report_write_error(key, filename)
-          pass
-        pass
-
-      self.sofar += len(buf)
-
-      for idx, key, filename, pipe, child in self.downstreams:
-        if self.dead_child.get(idx):
-          continue
-        if not child.is_alive():
-          continue
-
-        try:
-          child_sofar = pipe.recv()
-          debuglog("{} ack {}".format(idx, child_sofar))
-          pass
-        except Exception as exc:
-          self.dead_child[idx] = (traceback.format_exc(), self.sofar)
-          debuglog("Writer got an exception. " + traceback.format_exc())
-          debuglog(self.dead_child)
-          try:
-            debuglog("killing %d" % idx)
-            child.kill()
-          except:
-            debuglog("killing %d failed" % idx)
-            pass
-          self.report_write_error(key, filename)
+  def wait_for_writers(self):
+    for idx, key, filename, child in self.downstreams:
+      while child.is_alive():
+        child.join(timeout=1)
+        if not self.running:
+          self._kill_all()
           pass
         pass
-
-      if len(buf) == self.copybuf_size:
-        # If this is a real buffer, return this to the queue.
-        self.readbufs.put(buf)
-        pass
-
-      self.running = (n_alive > 0)
       pass
-
-    self._kill_all()
+    self.check_writers()
     pass
 
 
@@ -276,40 +487,67 @@ class fanout_copy:
       pass
     dt_elapsed = in_seconds(current_time - start_time)
 
-    idx, key, dest_path, pipe, child = dest
+    idx, key, dest_path, child = dest
 
-    run_state = RunState.Failed if idx in self.dead_child else (RunState.Running if self.running else RunState.Success)
+    # Each destination finishes at its own pace.
+    writer_state = self.ring.states[idx]
+    if idx in self.dead_child or writer_state == WRITER_FAILED:
+      run_state = RunState.Failed
+    elif writer_state == WRITER_DONE:
+      run_state = RunState.Success
+    else:
+      run_state = RunState.Running
+      pass
     debuglog("{} {}".format(idx, run_state))
 
-    speed = self.sofar / dt_elapsed
+    size_written = self.ring.written[idx]
+    # Verification reads everything back, so count the work as twice the size.
+    size_verified = self.ring.verified[idx]
+    total_work = self.source_file_size * (2 if self.verify else 1)
+    work_done = size_written + size_verified
+    speed = work_done / dt_elapsed
     if speed == 0:
       speed = 2 ** 24
       pass
     bytesCopied = 0
+    verdict = None
 
     if run_state is RunState.Running:
-      bytesCopied = self.sofar
-      run_message = "Copied %d of %d bytes. (%dMB/sec)" % (self.sofar, self.source_file_size, round(speed/(2**20), 1))
-      percentage_done = float(self.sofar) / float(self.source_file_size)
+      bytesCopied = size_written
+      if writer_state == WRITER_VERIFYING:
+        run_message = "Verifying %d of %d bytes. (%dMB/sec)" % (size_verified, self.source_file_size, round(speed/(2**20), 1))
+      else:
+        run_message = "Copied %d of %d bytes. (%dMB/sec)" % (size_written, self.source_file_size, round(speed/(2**20), 1))
+        pass
+      percentage_done = float(work_done) / float(max(1, total_work))
       progress = min(99, max(1, round(100*percentage_done)))
-      remaining_bytes = self.source_file_size - self.sofar
-      time_remaining = remaining_bytes / speed
+      remaining_bytes = self.source_file_size - size_written
+      time_remaining = (total_work - work_done) / speed
     elif run_state is RunState.Success:
       bytesCopied = self.source_file_size
       run_message = "Copying completed (%d bytes copied.)" % (self.source_file_size)
+      if self.verify:
+        verdict = "Verified"
+        pass
       progress = 100
       remaining_bytes = 0
       time_remaining = 0
     else:
-      msg, size_failed = self.dead_child.get(idx, ("FOO", "-1"))
+      msg, size_failed = self.dead_child.get(idx, ("Write failed", self.ring.written[idx]))
       bytesCopied = size_failed
-      run_message = "Copying failed at %d." % size_failed
+      if self.ring.verify_failed[idx]:
+        run_message = "Verify failed. Destination differs from the source."
+        verdict = run_message
+      else:
+        run_message = "Copying failed at %d." % size_failed
+        pass
       progress = 999
       remaining_bytes = 0
       time_remaining = 0
       pass
 
     return ProgressReport(key=key,
+                           verdict=verdict,
                            totalBytes=bytesCopied,
                            destination=dest_path,
                            runStatus=run_state,
@@ -317,13 +555,27 @@ class fanout_copy:
                            progress=progress,
                            remainingBytes=remaining_bytes,
                            runEstimate=round(time_remaining+in_seconds(dt_elapsed)))
-  
-    
+
+
+  def report_destination(self, downstream, current_time=None):
+    '''Reports the destination's progress. Success is reported only once
+so that a destination that finishes early isn't counted again every tick.'''
+    idx = downstream[0]
+    if idx in self.final_reported:
+      return
+    report = self.make_running_report(downstream, current_time=current_time)
+    if report.runStatus == RunState.Success:
+      self.final_reported.add(idx)
+      pass
+    self._report(report, current_time=current_time)
+    pass
+
+
   def reporter(self):
     while self.running:
+      self.check_writers()
       for downstream in self.downstreams:
-        report = self.make_running_report(downstream)
-        self._report(report)
+        self.report_destination(downstream)
         pass
       time.sleep(1)
       pass
@@ -335,10 +587,6 @@ class fanout_copy:
     signal.signal(signal.SIGINT, handler_stop_signals)
     # signal.signal(signal.SIGTERM, handler_stop_signals)
 
-    self.writer = threading.Thread(target=self.writer, args=())
-    self.writer.start()
-    debuglog("Writer started.")
-
     self.reader = threading.Thread(target=self.reader, args=())
     self.reader.start()
     debuglog("Reader started.")
@@ -346,27 +594,20 @@ class fanout_copy:
     self.reporter = threading.Thread(target=self.reporter, args=())
     self.reporter.start()
     debuglog("Reporter started.")
-    
+
     self.reader.join()
     debuglog("Reader finished.")
 
-    self.writer.join()
-    debuglog("Writer finished.")
+    self.wait_for_writers()
+    debuglog("Writers finished.")
 
     self.running = False
     self.reporter.join()
     pass
-  
+
   def _kill_all(self):
     for downstream in self.downstreams:
-      idx, key, filename, pipe, child = downstream
-      try:
-        pipe.close()
-        pass
-      except Exception as exc:
-        pass
-      pass
-
+      idx, key, filename, child = downstream
       try:
         child.kill()
         pass
@@ -380,31 +621,44 @@ class fanout_copy:
     self._kill_all()
 
     for downstream in self.downstreams:
-      report = self.make_running_report(downstream)
-      idx, key, filename, pipe, child = downstream
-      if idx in self.dead_child:
-        verdict, size_copied = self.dead_child[idx]
-        pass
-      self._report(report, current_time=current_time)
+      self.report_destination(downstream, current_time=current_time)
       pass
+    self.ring.release()
     pass
   pass
-  
-  
+
+
 if __name__ == "__main__":
   if len(sys.argv) < 2:
-    usage = '''fanout_copy.py source_file destination[,destination...]
+    usage = '''fanout_copy.py [-v] [-k lag_window] source_file destination[,destination...]
+  -v:
+    verify - read each destination back and compare its hash with the source's.
+  lag_window:
+    number of 32MB chunks a destination can fall behind the fastest one
+    before it stops holding the others up and reads the source by itself.
   desination:
     key:destination file path
     key is used to ID the copying file.'''
     sys.stderr.write(usage)
     sys.exit(1)
     pass
-    
 
-  source = sys.argv[1]
-  dests = sys.argv[2:]
-  copier = fanout_copy(source, dests)
+  args = sys.argv[1:]
+  lag_window = 3
+  verify = False
+  while args and args[0] in ['-k', '-v']:
+    if args[0] == '-k':
+      lag_window = int(args[1])
+      args = args[2:]
+    else:
+      verify = True
+      args = args[1:]
+      pass
+    pass
+
+  source = args[0]
+  dests = args[1:]
+  copier = fanout_copy(source, dests, lag_window=lag_window, verify=verify)
 
   mp.set_start_method('fork')
 
@@ -415,4 +669,3 @@ if __name__ == "__main__":
     sys.exit(1)
     pass
   pass
-    
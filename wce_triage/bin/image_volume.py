@@ -14,7 +14,7 @@ from ..lib.util import is_block_device, get_file_compression_app
 
 from ..bin.process_driver import drive_process, PipeInfo
 
-def save_disk(source, dest, filesystem=None, encoding='iso-8859-1'):
+def save_disk(source, dest, filesystem=None, encoding='iso-8859-1', level=None, long_window=None):
   if not is_block_device(source):
     return 1
 
@@ -23,8 +23,8 @@ def save_disk(source, dest, filesystem=None, encoding='iso-8859-1'):
     print(partclone_path + " does not exist.")
     return 1
 
-  # compressor to use (gzip!)
-  comp = get_file_compression_app(dest)
+  # compressor to use (gzip, or zstd for .zst)
+  comp = get_file_compression_app(urllib.parse.urlsplit(dest).path or dest, level=level, long_window=long_window)
 
   # curl
   parsed = urllib.parse.urlsplit(dest)
@@ -123,14 +123,25 @@ def save_disk(source, dest, filesystem=None, encoding='iso-8859-1'):
 
 
 if __name__ == "__main__":
-  if len(sys.argv) != 4:
-    sys.stderr.write('''image_volume.py <source> [ext4|fat32] <dest>\n  source: device file\n  dest: URL [?user=<usename>&password=<password>] or '-' for stdout\n''')
+  args = sys.argv[1:]
+  level = None
+  long_window = None
+  while len(args) > 3 and args[0] in ['-l', '-w']:
+    if args[0] == '-l':
+      level = int(args[1])
+    else:
+      long_window = int(args[1])
+      pass
+    args = args[2:]
+    pass
+  if len(args) != 3:
+    sys.stderr.write('''image_volume.py [-l level] [-w window_log] <source> [ext4|fat32] <dest>\n  source: device file\n  dest: URL [?user=<usename>&password=<password>] or '-' for stdout\n  dest ending with .zst is compressed with zstd, the rest with pigz.\n''')
     sys.exit(1)
     pass
     
-  if not is_block_device(sys.argv[1]):
-    sys.stderr.write("%s is not a block device.\n" % sys.argv[1])
+  if not is_block_device(args[0]):
+    sys.stderr.write("%s is not a block device.\n" % args[0])
     sys.exit(1)
     pass
-  sys.exit(save_disk(sys.argv[1], sys.argv[3], filesystem=sys.argv[2]))
+  sys.exit(save_disk(args[0], args[2], filesystem=args[1], level=level, long_window=long_window))
   
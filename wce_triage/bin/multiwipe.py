@@ -1,9 +1,14 @@
 #!/usr/bin/python3
 
-import os, sys, datetime, traceback, signal, subprocess
+import os, sys, datetime, traceback, signal, subprocess, stat
 import threading
+import mmap
+import errno
+import fcntl
+import struct
 from ..lib.util import get_triage_logger
 from ..lib.timeutil import in_seconds
+from ..lib.io_tuner import WriteSizeTuner, DEFAULT_WRITE_SIZES
 from ..ops.run_state import RunState
 from ..ops.protocol import ProgressReport, ProgressEnvelope
 import time
@@ -12,8 +17,31 @@ start_time = datetime.datetime.now()
 tlog = get_triage_logger()
 debugging = False
 
-zeros_size = 2 ** 22
-zeros = bytearray(zeros_size)
+# Big enough for the largest write size the tuner tries.
+zeros_size = max(DEFAULT_WRITE_SIZES)
+# Anonymous mmap is page aligned (and zero filled), which O_DIRECT needs.
+zeros = mmap.mmap(-1, zeros_size)
+zeros_view = memoryview(zeros)
+
+# Wiper phases, reported as ProgressReport.phase
+PHASE_WRITE = "write"
+PHASE_SECURE_DISCARD = "secure-discard"
+PHASE_ZEROOUT = "zeroout"
+PHASE_SYNC = "sync"
+
+# Wipe methods, given per destination as key:dest:method
+WIPE_ZERO = "zero"          # stream zeros through write()
+WIPE_DISCARD = "discard"    # secure discard if the device does it, else the kernel zero-out
+WIPE_ZEROOUT = "zeroout"    # kernel zero-out - NVMe Write Zeroes / SCSI WRITE SAME when offloaded
+WIPE_METHODS = [WIPE_ZERO, WIPE_DISCARD, WIPE_ZEROOUT]
+
+# linux/fs.h
+BLKGETSIZE64 = 0x80081272
+BLKSECDISCARD = 0x127d
+BLKZEROOUT = 0x127f
+
+# The block ioctls are issued in slices this big so there is some progress to report.
+ioctl_range_size = 2 ** 30
 
 wipers = []
 global wiping
@@ -46,10 +74,17 @@ n_sectors: number of sectors.
   
     self.device = fd
     self.dest = dest
+    self.key = dest
     self.n_sectors = int(n_sectors)
     if int(n_sectors) != self.n_sectors:
       raise Exception("n_sectors is not int.")
     self.n_written = 0
+    # What n_written counts, in bytes - a short write can end in the middle
+    # of a sector.
+    self.bytes_written = 0
+    self.phase = PHASE_WRITE
+    self.synced = False
+    self.tuner = WriteSizeTuner()
 
     self.report_time = start_time
     self.loop_count = 0
@@ -60,23 +95,20 @@ n_sectors: number of sectors.
   def run(self):
     debuglog("%s is starting. %d/%d" % (self.dest, self.n_written, self.n_sectors))
 
-    while self.running:
-      remaining = self.n_sectors - self.n_written
-      write_size = min(remaining * 512, len(zeros))
+    self.wipe()
+
+    # Written is not wiped until it's on the disk. Without O_DIRECT, most of
+    # the last few GB are still sitting in the page cache at this point.
+    if self.running:
+      self.phase = PHASE_SYNC
       try:
-        if write_size < len(zeros):
-          self.device.write(zeros[:write_size])
-          self.running = False
-          pass
-        else:
-          self.device.write(zeros)
-          pass
-        self.n_written += int(write_size / 512)
+        os.fdatasync(self.device.fileno())
+        self.synced = True
       except Exception as exc:
-        debuglog("Error writing to %s\n%s" % (self.dest, traceback.format_exc()))
-        self.running = False
+        debuglog("Error syncing %s\n%s" % (self.dest, traceback.format_exc()))
         pass
       pass
+    self.running = False
     self.device.close()
     self.end_time = datetime.datetime.now()
 
@@ -86,6 +118,32 @@ n_sectors: number of sectors.
     #  pass
     pass
 
+  def wipe(self):
+    tuner = self.tuner
+    while self.running and self.n_written < self.n_sectors:
+      remaining = self.n_sectors * 512 - self.bytes_written
+      write_size = min(remaining, tuner.next_size())
+      try:
+        started = tuner.start()
+        # Only what the device took is wiped - O_DIRECT and raw devices
+        # can take less than asked.
+        written = self.device.write(zeros_view[:write_size])
+        if not written:
+          raise OSError(errno.ENOSPC, "%s took no more." % self.dest)
+        self.bytes_written += written
+        self.n_written = self.bytes_written // 512
+        was_locked = tuner.locked
+        tuner.record(written, started)
+        if tuner.locked and not was_locked:
+          tlog.info("%s: %s" % (self.dest, tuner.describe()))
+          pass
+      except Exception as exc:
+        debuglog("Error writing to %s\n%s" % (self.dest, traceback.format_exc()))
+        self.running = False
+        pass
+      pass
+    pass
+
   def stop_request(self):
     self.running = False
     pass
@@ -93,6 +151,54 @@ n_sectors: number of sectors.
   pass
 
 
+class BlockWiper(Wiper):
+  '''Wipes a block device with the block layer ioctls instead of writing
+zeros, so the device does the work. SSD/NVMe finish in seconds.
+
+WIPE_DISCARD tries BLKSECDISCARD, then BLKZEROOUT, and WIPE_ZEROOUT uses
+BLKZEROOUT. When the device turns down an ioctl, the rest of the disk is
+done with the next one in that order - BLKZEROOUT always works since the
+kernel writes the zeros itself if the device can't.
+
+Plain BLKDISCARD is never used. TRIM is a hint - the drive may keep the
+data, and reading it back may not give zeros. The kernel doesn't say when
+it does (discard_zeroes_data is always 0 since 4.12), so a discard that
+isn't secure doesn't count as wiped.
+'''
+  def __init__(self, n_sectors, fd, dest, method=WIPE_ZEROOUT, output=sys.stderr):
+    super().__init__(n_sectors, fd, dest, output=output)
+    if method == WIPE_DISCARD:
+      self.ioctls = [(BLKSECDISCARD, PHASE_SECURE_DISCARD), (BLKZEROOUT, PHASE_ZEROOUT)]
+    else:
+      self.ioctls = [(BLKZEROOUT, PHASE_ZEROOUT)]
+      pass
+    self.phase = self.ioctls[0][1]
+    pass
+
+  def wipe(self):
+    fileno = self.device.fileno()
+    while self.running and self.n_written < self.n_sectors:
+      start = self.n_written * 512
+      length = min((self.n_sectors - self.n_written) * 512, ioctl_range_size)
+      request, phase = self.ioctls[0]
+      self.phase = phase
+      try:
+        fcntl.ioctl(fileno, request, struct.pack("QQ", start, length))
+        self.n_written += length // 512
+      except OSError as exc:
+        if exc.errno in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY) and len(self.ioctls) > 1:
+          debuglog("%s does not do %s (%s). Trying %s." % (self.dest, phase, exc, self.ioctls[1][1]))
+          self.ioctls = self.ioctls[1:]
+          continue
+        debuglog("Error wiping %s\n%s" % (self.dest, traceback.format_exc()))
+        self.running = False
+        pass
+      pass
+    pass
+
+  pass
+
+
 class Reporter(threading.Thread):
 
   def __init__(self, wipers, output=sys.stderr):
@@ -119,14 +225,20 @@ class Reporter(threading.Thread):
           n_running += 1
           percentage_done = float(n_written) / float(n_sectors)
           progress = min(99, max(1, round(100*percentage_done)))
-          run_message = "%d of %d sectors wiped." % (n_written, n_sectors)
+          if wiper.phase == PHASE_SYNC:
+            run_message = "%d of %d sectors written. Flushing to disk." % (n_written, n_sectors)
+          elif wiper.phase == PHASE_WRITE:
+            run_message = "%d of %d sectors wiped." % (n_written, n_sectors)
+          else:
+            run_message = "%d of %d sectors wiped. (%s)" % (n_written, n_sectors, wiper.phase)
+            pass
           run_status = RunState.Running
           speed = float(n_written) / dt_duration
           time_remaining = float(n_sectors - n_written) / max(4096, speed)
           remaining_sectors = n_sectors - n_written
           run_estimate = round(dt_duration + time_remaining, 1)
         else:
-          if n_written == n_sectors:
+          if n_written == n_sectors and wiper.synced:
             run_status = RunState.Success
             progress = 100
             run_message = "Wipe completed. (%d of %d sectors)" % (n_written, n_sectors)
@@ -139,7 +251,7 @@ class Reporter(threading.Thread):
           run_estimate = round(dt_duration, 1)
           pass
 
-        report = ProgressReport(key=wiper.dest, runStatus=run_status, runMessage=run_message,
+        report = ProgressReport(key=wiper.key, runStatus=run_status, runMessage=run_message, phase=wiper.phase,
                                  progress=progress, runTime=round(dt_duration, 1), runEstimate=run_estimate,
                                  totalSectors=n_sectors, writtenSectors=n_written, remainingSectors=remaining_sectors,
                                  startTime=start_time, currentTime=current_time)
@@ -179,7 +291,36 @@ def get_disk_total_sectors(device):
   return n_sectors
 
 
-def zero_wipe(short_wipe, destination_specs):
+def get_device_total_sectors(fd, dest):
+  '''Size of the device from the kernel (BLKGETSIZE64) - no need to run parted.'''
+  st = os.fstat(fd.fileno())
+  if stat.S_ISREG(st.st_mode):
+    return st.st_size // 512
+  try:
+    buf = fcntl.ioctl(fd.fileno(), BLKGETSIZE64, struct.pack("Q", 0))
+    return struct.unpack("Q", buf)[0] // 512
+  except OSError:
+    debuglog("BLKGETSIZE64 on %s failed. Asking parted." % dest)
+    pass
+  return get_disk_total_sectors(dest)
+
+
+def open_destination(dest, direct_io):
+  '''Opens the device for writing. With direct_io, writes bypass the page
+cache (O_DIRECT) so the progress is what's actually on the disk. Falls back
+to the buffered write if the device/file system doesn't do O_DIRECT.'''
+  if direct_io and hasattr(os, "O_DIRECT"):
+    try:
+      return open(os.open(dest, os.O_WRONLY | os.O_DIRECT), 'wb', buffering=0)
+    except OSError as exc:
+      debuglog("O_DIRECT open of %s failed. (%s) Using buffered write." % (dest, exc))
+      pass
+    pass
+  # No O_TRUNC - a disk image file is wiped over its current size, like a disk.
+  return open(os.open(dest, os.O_WRONLY), 'wb', buffering=0)
+
+
+def zero_wipe(short_wipe, destination_specs, direct_io=False):
   '''Wipe disks
 '''
   if short_wipe:
@@ -190,29 +331,45 @@ def zero_wipe(short_wipe, destination_specs):
 
   destinations = []
 
-  for key, dest in [ (d[0], d[1]) if len(d) == 2 else (d[0], d[0]) for d in [dest.split(':') for dest in destination_specs] ]:
+  specs = [dest.split(':') for dest in destination_specs]
+  for key, dest, method in [ (d[0], d[1], d[2]) if len(d) == 3 else ((d[0], d[1], WIPE_ZERO) if len(d) == 2 else (d[0], d[0], WIPE_ZERO)) for d in specs ]:
+    if method not in WIPE_METHODS:
+      tlog.info("Unknown wipe method %s for %s." % (method, dest))
+      sys.exit(1)
+      pass
+    # Short wipe is only the first 1MB. Not worth it. And the block
+    # ioctls are only for block devices.
+    if short_wipe or not os.path.exists(dest) or not stat.S_ISBLK(os.stat(dest).st_mode):
+      method = WIPE_ZERO
+      pass
     # This is for cleaning up when something goes wrong.
     try:
-      destinations.append((open(dest, 'wb', buffering=0), dest, key))
+      # The block ioctls don't go through the page cache.
+      destinations.append((open_destination(dest, direct_io and method == WIPE_ZERO), dest, key, method))
       debuglog("Dest %s " % (key))
     except Exception as exc:
       # Clean up the mess if I can.
-      tlog.info("Opening desination file %s failed with following error.\%s" (dest, traceback.format_exc()))
+      tlog.info("Opening desination file %s failed with following error.\n%s" % (dest, traceback.format_exc()))
       sys.exit(1)
       pass
     pass
 
   signal.signal(signal.SIGINT, handler_stop_signals)
   
-  for fd, dest, key in destinations:
+  for fd, dest, key, method in destinations:
     if short_wipe:
       # wipe first 1Mb
       n_sectors = 2048
     else:
-      n_sectors = get_disk_total_sectors(dest)
+      n_sectors = get_device_total_sectors(fd, dest)
       pass
 
-    wiper = Wiper(n_sectors, fd, dest)
+    if method == WIPE_ZERO:
+      wiper = Wiper(n_sectors, fd, dest)
+    else:
+      wiper = BlockWiper(n_sectors, fd, dest, method=method)
+      pass
+    wiper.key = key
     wiper.start()
     wipers.append(wiper)
     debuglog("Wiper thread for %s start() called." % dest)
@@ -260,19 +417,24 @@ def zero_wipe(short_wipe, destination_specs):
   
 if __name__ == "__main__":
   if len(sys.argv) < 2:
-    sys.stderr.write('zerowipe.py [-s] <wiped...>\n')
+    sys.stderr.write('zerowipe.py [-s] [-d] <wiped...>\n  -s: short wipe (first 1MB)\n  -d: direct I/O (O_DIRECT)\n  wiped: device, or key:device[:method]\n  method: zero (default), discard or zeroout\n')
     sys.exit(1)
     pass
     
   args = sys.argv[1:]
   short_wipe = False
-  if args[0] == '-s':
-    short_wipe = True
+  direct_io = False
+  while args and args[0] in ['-s', '-d']:
+    if args[0] == '-s':
+      short_wipe = True
+    else:
+      direct_io = True
+      pass
     args = args[1:]
     pass
 
   try:
-    zero_wipe(short_wipe, args)
+    zero_wipe(short_wipe, args, direct_io=direct_io)
   except Exception as exc:
     sys.stdout.write(traceback.format_exc())
     sys.exit(1)
@@ -3,6 +3,8 @@
 #
 import os, sys, traceback, datetime
 import queue
+import selectors
+import subprocess
 import threading
 
 if __name__ == "__main__":
@@ -11,7 +13,8 @@ if __name__ == "__main__":
 
 from ..lib.util import get_triage_logger
 from ..lib.pipereader import PipeReader
-from ..ops.protocol import DriverEvent, DriverEventType, emit_line
+from ..ops.protocol import (DriverEvent, DriverEventType, emit_line, encode_driver_frame, driver_framing_requested,
+                            DRIVER_PARTIAL_FAILURE)
 import signal
 
 
@@ -42,13 +45,24 @@ class DriverEmitter:
   key - if the writer thread falls behind, only the latest value for a key
   survives, which is safe because progress lines are monotonic snapshots
   (confirmed by every consumer of this stream treating a "line" event as an
-  overwrite, never an accumulation).
+  overwrite, never an accumulation). A line event is only made into a
+  DriverEvent once it's actually written, so the ones coalesced away cost
+  no pydantic validation.
+
+  framed writes length-prefixed struct frames (protocol.encode_driver_frame)
+  to a binary stream instead, each drain in one write, and lines never
+  become DriverEvents at all. By default, it's what the parent asked for
+  with WCE_DRIVER_FRAMING.
   """
 
   WRITER_POLL_INTERVAL = 0.1
 
-  def __init__(self, stream=None):
-    self._stream = stream if stream is not None else sys.stderr
+  def __init__(self, stream=None, framed=None):
+    self._framed = driver_framing_requested() if framed is None else framed
+    if stream is None:
+      stream = sys.stderr.buffer if self._framed else sys.stderr
+      pass
+    self._stream = stream
     self._important = queue.Queue()
     self._latest_lines = {}
     self._lines_lock = threading.Lock()
@@ -67,10 +81,9 @@ class DriverEmitter:
     text = text.strip()
     if not text:
       return
-    tlog.debug("%s.%s: %s" % (proc, stream, text))
-    event = DriverEvent(type=DriverEventType.line, proc=proc, stream=stream, line=text)
+    tlog.debug("%s.%s: %s", proc, stream, text)
     with self._lines_lock:
-      self._latest_lines[proc + "." + stream] = event
+      self._latest_lines[(proc, stream)] = text
       pass
     self._wake.set()
     pass
@@ -122,6 +135,9 @@ class DriverEmitter:
     pass
 
   def _drain(self):
+    if self._framed:
+      self._drain_framed()
+      return
     while True:
       try:
         event = self._important.get_nowait()
@@ -133,27 +149,54 @@ class DriverEmitter:
     with self._lines_lock:
       pending, self._latest_lines = self._latest_lines, {}
       pass
-    for event in pending.values():
-      emit_line(event, stream=self._stream)
+    for (proc, stream), text in pending.items():
+      emit_line(DriverEvent(type=DriverEventType.line, proc=proc, stream=stream, line=text), stream=self._stream)
+      pass
+    pass
+
+  def _drain_framed(self):
+    frames = []
+    while True:
+      try:
+        event = self._important.get_nowait()
+      except queue.Empty:
+        break
+      frames.append(encode_driver_frame(event.type, event.proc, stream=event.stream, pid=event.pid,
+                                        line=event.line, returncode=event.returncode))
+      pass
+
+    with self._lines_lock:
+      pending, self._latest_lines = self._latest_lines, {}
+      pass
+    for (proc, stream), text in pending.items():
+      frames.append(encode_driver_frame(DriverEventType.line, proc, stream=stream, line=text))
+      pass
+    if frames:
+      self._stream.write(b"".join(frames))
+      self._stream.flush()
       pass
     pass
   pass
 
 
 class _DriverState:
-  """Coordinates the still-running process list across reader/waiter threads.
+  """Keeps the still-running process list, decides whether a bad exit should
+  trigger _terminate_all() on the rest, and notices when the last process
+  is gone.
 
-  Reader threads only ever call printer.line()/error(); waiter threads are
-  the ones that need to remove their process from the running set, decide
-  whether a bad exit should trigger _terminate_all() on the rest, and notice
-  when the last process is gone - all of which touch this shared list from
-  multiple threads at once, hence the lock.
+  Only drive_process()'s loop calls process_exited(), but the signal
+  handler calls terminate_all() on the same thread at any point, possibly
+  in the middle of process_exited() - hence the reentrant lock.
   """
 
-  def __init__(self, processes):
-    self._lock = threading.Lock()
+  def __init__(self, processes, independent=()):
+    self._lock = threading.RLock()
     self._processes = list(processes)
     self.retcode = 0
+    # Processes whose failure is their own business - e.g. one of several
+    # partclones fed from the same stream. The rest carry on without them.
+    self._independent = set(independent)
+    self.independent_failures = {}
     self.all_done = threading.Event()
     # Only set once someone actually asks the pipeline to stop (a signal, or
     # one process failing and taking the rest down with it) - this is what
@@ -176,7 +219,14 @@ class _DriverState:
       # failed. Processes torn down afterwards by _terminate_all() below
       # exit with their own (e.g. -15) code, which would otherwise overwrite
       # it depending on reap order.
-      if returncode != 0 and self.retcode == 0:
+      if returncode != 0 and proc_name in self._independent and not self.terminate_requested.is_set():
+        self.independent_failures[proc_name] = returncode
+        # Only when every one of them is gone, there's nothing left to do.
+        if len(self.independent_failures) == len(self._independent):
+          self.retcode = returncode
+          pass
+        pass
+      elif returncode != 0 and self.retcode == 0:
         self.retcode = returncode
         self.terminate_requested.set()
         _terminate_all(self._processes)
@@ -197,83 +247,86 @@ class _DriverState:
   pass
 
 
-class _PipeReaderThread(threading.Thread):
-  """Reads one child pipe to completion on its own thread.
-
-  PipeReader.readline() blocks on a real 1-byte read() syscall (see
-  lib/pipereader.py - do not change that to a chunked read, it breaks live
-  progress reporting for partclone/wget's \\r-terminated status lines), so
-  there is no polling here: the thread just blocks until a line is ready or
-  the pipe closes, exactly like the old select.poll()-driven loop did, minus
-  the fd bookkeeping needed to multiplex several pipes on one thread.
-  """
-
-  def __init__(self, proc_name, pipetag, pipe, printer):
-    super().__init__(daemon=True, name="PipeReader-%s.%s" % (proc_name, pipetag))
-    self._proc_name = proc_name
-    self._pipetag = pipetag
-    self._pipe = pipe
-    self._printer = printer
-    pass
-
-  def run(self):
-    reader = PipeReader(self._pipe, tag=self._proc_name + "." + self._pipetag)
-    try:
-      while True:
-        line = reader.readline()
-        if line == b'':
-          break
-        if line is not None:
-          self._printer.line(self._proc_name, self._pipetag, line)
-          pass
-        pass
-      pass
-    except Exception:
-      self._printer.error(self._proc_name, "pipe reader failed: %s" % traceback.format_exc())
-    finally:
-      try:
-        self._pipe.close()
-      except OSError:
-        pass
-      pass
-    pass
+def _open_pidfd(process):
+  """A pidfd that turns readable when the child exits, so the exit can be
+  selected on like a pipe. None when the kernel/Python has no pidfd_open(),
+  or for a "process" that is a thread of ours (StreamFeeder) - its pid is
+  our own."""
+  if not hasattr(os, "pidfd_open") or not isinstance(process, subprocess.Popen):
+    return None
+  try:
+    return os.pidfd_open(process.pid)
+  except OSError:
+    # Already reaped, or no pidfd support in the kernel.
+    return None
   pass
 
 
 class _ProcessWaiterThread(threading.Thread):
-  """Blocks on one child's exit via process.wait() - a real blocking wait,
-  not a poll. This also retires a whole class of bug the old poll()-based
-  loop needed a workaround for: process.wait() cannot "miss" an exit the way
-  a periodic process.poll() call could, so the old os.kill(pid, 0) fallback
-  check (for an exit poll() failed to notice) is no longer needed."""
+  """Blocks on one process's exit via process.wait(), for the processes
+  that have no pidfd. It only reports back - the exit is queued and the
+  selector loop woken up through wake_fd, so that all of the bookkeeping
+  stays on the loop's thread."""
 
-  def __init__(self, proc_name, process, printer, state):
+  def __init__(self, proc_name, process, exits, wake_fd):
     super().__init__(daemon=True, name="ProcessWaiter-%s" % proc_name)
     self._proc_name = proc_name
     self._process = process
-    self._printer = printer
-    self._state = state
+    self._exits = exits
+    self._wake_fd = wake_fd
     pass
 
   def run(self):
     try:
       returncode = self._process.wait()
+      failure = None
     except Exception:
-      self._printer.error(self._proc_name, "wait() failed: %s" % traceback.format_exc(), pid=self._process.pid)
-      self._state.process_exited(self._proc_name, self._process, -1)
-      return
-    self._printer.exit(self._proc_name, self._process.pid, returncode)
-    self._state.process_exited(self._proc_name, self._process, returncode)
+      returncode = -1
+      failure = "wait() failed: %s" % traceback.format_exc()
+      pass
+    self._exits.put((self._proc_name, self._process, returncode, failure))
+    try:
+      os.write(self._wake_fd, b'x')
+    except OSError:
+      # drive_process() gave up and closed it.
+      pass
     pass
   pass
 
 
+def _relay_pipe(selector, printer, pipeinfo, reader):
+  """Relays what's in a readable pipe. Returns False once it's closed."""
+  try:
+    for line in reader.readlines():
+      printer.line(pipeinfo.app, pipeinfo.pipetag, line)
+      pass
+  except Exception:
+    printer.error(pipeinfo.app, "pipe reader failed: %s" % traceback.format_exc())
+    reader.alive = False
+    pass
+  if reader.alive:
+    return True
+  selector.unregister(reader.fd)
+  try:
+    pipeinfo.pipe.close()
+  except OSError:
+    pass
+  return False
+
+
 #
 # Probably it's better to make this to a class...
 #
-def drive_process(name, processes, pipes):
+def drive_process(name, processes, pipes, independent=()):
+  """Runs the processes to the end, relaying their pipes as DriverEvents.
+A process failing takes the rest down, unless its name is in independent.
+Returns the first failure's return code, or 0.
+
+Everything - every pipe and every child's exit (through its pidfd) - is
+multiplexed on one selector on this thread, so a wide fanout doesn't cost
+threads per child. Only the processes without a pidfd get a waiter thread."""
   printer = DriverEmitter()
-  state = _DriverState(processes)
+  state = _DriverState(processes, independent=independent)
 
   def handler_stop_signals(signum, frame):
     '''propagate terminate signal to children'''
@@ -283,29 +336,84 @@ def drive_process(name, processes, pipes):
   signal.signal(signal.SIGINT, handler_stop_signals)
   signal.signal(signal.SIGTERM, handler_stop_signals)
 
-  reader_threads = [_PipeReaderThread(pipeinfo.app, pipeinfo.pipetag, pipeinfo.pipe, printer)
-                     for pipeinfo in pipes]
+  selector = selectors.DefaultSelector()
+  exits = queue.Queue()
+  wake_read, wake_write = os.pipe()
+  selector.register(wake_read, selectors.EVENT_READ, ("wake", None, None))
+
+  open_pipes = 0
+  for pipeinfo in pipes:
+    reader = PipeReader(pipeinfo.pipe, tag=pipeinfo.app + "." + pipeinfo.pipetag)
+    selector.register(reader.fd, selectors.EVENT_READ, ("pipe", pipeinfo, reader))
+    open_pipes += 1
+    pass
 
   waiter_threads = []
   for proc_name, process in processes:
     printer.start(proc_name, process.pid)
-    waiter_threads.append(_ProcessWaiterThread(proc_name, process, printer, state))
+    pidfd = _open_pidfd(process)
+    if pidfd is None:
+      waiter_threads.append(_ProcessWaiterThread(proc_name, process, exits, wake_write))
+      waiter_threads[-1].start()
+    else:
+      selector.register(pidfd, selectors.EVENT_READ, ("exit", proc_name, process))
+      pass
     pass
 
-  for thread in reader_threads + waiter_threads:
-    thread.start()
+  def process_exited(proc_name, process, returncode, failure=None):
+    if failure:
+      printer.error(proc_name, failure, pid=process.pid)
+      pass
+    else:
+      printer.exit(proc_name, process.pid, returncode)
+      pass
+    state.process_exited(proc_name, process, returncode)
     pass
 
-  # Wait for every process to be reaped. This is unbounded as long as things
+  # Run until every process is reaped. This is unbounded as long as things
   # are running normally - a multi-minute partclone/rsync copy is not a hang
   # - only once terminate_requested fires (a signal, or one process's failure
   # cascading to the rest) do we start a bounded grace period, matching the
   # old code's 10 second window after a stop request for children to unwind
-  # (e.g. partclone flushing its cache) before we give up on them.
+  # (e.g. partclone flushing its cache) before we give up on them. Once they
+  # are all gone, the pipes get a few seconds to hit EOF - a grandchild can
+  # hold one open.
   grace_period = 10
+  pipe_grace_period = 5
   terminate_deadline = None
-  while not state.all_done.wait(timeout=1):
-    if state.terminate_requested.is_set():
+  pipe_deadline = None
+  while True:
+    if state.all_done.is_set():
+      if open_pipes == 0:
+        break
+      if pipe_deadline is None:
+        pipe_deadline = datetime.datetime.now() + datetime.timedelta(seconds=pipe_grace_period)
+      elif datetime.datetime.now() >= pipe_deadline:
+        break
+      pass
+
+    for key, _mask in selector.select(timeout=1):
+      kind, what, other = key.data
+      if kind == "pipe":
+        if not _relay_pipe(selector, printer, what, other):
+          open_pipes -= 1
+          pass
+        pass
+      elif kind == "exit":
+        selector.unregister(key.fd)
+        os.close(key.fd)
+        # The child is a zombie by now, so this doesn't block.
+        process_exited(what, other, other.wait())
+        pass
+      else:
+        os.read(wake_read, 4096)
+        while not exits.empty():
+          process_exited(*exits.get_nowait())
+          pass
+        pass
+      pass
+
+    if state.terminate_requested.is_set() and not state.all_done.is_set():
       if terminate_deadline is None:
         terminate_deadline = datetime.datetime.now() + datetime.timedelta(seconds=grace_period)
       elif datetime.datetime.now() >= terminate_deadline:
@@ -315,14 +423,22 @@ def drive_process(name, processes, pipes):
       pass
     pass
 
-  for thread in waiter_threads:
-    thread.join(timeout=5)
+  for key in list(selector.get_map().values()):
+    if key.data[0] == "exit":
+      os.close(key.fd)
+      pass
     pass
-  for thread in reader_threads:
-    thread.join(timeout=5)
+  selector.close()
+  if not [thread for thread in waiter_threads if thread.is_alive()]:
+    # Leaked otherwise, so that a late waiter never writes to a reused fd.
+    os.close(wake_read)
+    os.close(wake_write)
     pass
 
   # Guarantee buffered exit/error events actually reach the parent before we
   # exit - that's the whole point of this tool.
   printer.close()
+  if state.retcode == 0 and state.independent_failures:
+    # Some made it. Each one's exit event tells which.
+    return DRIVER_PARTIAL_FAILURE
   return state.retcode
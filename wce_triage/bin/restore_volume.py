@@ -2,12 +2,287 @@
 # 
 #
 import os, sys, subprocess
+import fcntl, shutil, threading, traceback, urllib.request, zlib
 
-from ..lib.util import is_block_device, get_transport_scheme, get_file_decompression_app
+from ..lib.util import is_block_device, get_transport_scheme, get_file_decompression_app, fast_decomps, get_triage_logger
 from .process_driver import drive_process, PipeInfo
 
+tlog = get_triage_logger()
 
-def load_disk(source, dest_dev, filesystem=None):
+# Engines
+#  pipeline: wget | decompressor | partclone, each a process on 64KB pipes.
+#  inprocess: fetch here with big reads, decompress here or with a
+#    multi-threaded decompressor, and feed partclone through one big pipe.
+ENGINE_PIPELINE = "pipeline"
+ENGINE_INPROCESS = "inprocess"
+
+# F_SETPIPE_SZ is only in fcntl from Python 3.10.
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+PIPE_SIZE = 2 ** 20
+FEED_BUFFER_SIZE = 2 ** 22
+# Most of a partition image is zeros - a 4MB read of it can inflate to
+# gigabytes. zlib hands out this much at a time.
+INFLATE_SIZE = 2 ** 22
+
+
+def get_pipe_max_size():
+  try:
+    with open("/proc/sys/fs/pipe-max-size") as pipe_max_size:
+      return int(pipe_max_size.read())
+  except (OSError, ValueError):
+    return PIPE_SIZE
+  pass
+
+
+def make_big_pipe():
+  """os.pipe() with the pipe buffer grown from 64KB, as far as the kernel
+allows, so partclone and the decompressor don't ping-pong on it."""
+  read_fd, write_fd = os.pipe()
+  try:
+    fcntl.fcntl(write_fd, F_SETPIPE_SZ, min(PIPE_SIZE, get_pipe_max_size()))
+  except OSError as exc:
+    tlog.info("F_SETPIPE_SZ failed. %s" % str(exc))
+    pass
+  return read_fd, write_fd
+
+
+def get_fast_decompression_app(path):
+  """Multi-threaded decompressor for path if one is installed, else the usual."""
+  ext = os.path.splitext(path)[1]
+  decomp = fast_decomps.get(ext)
+  if decomp and shutil.which(decomp[0][0]):
+    return decomp
+  decomp = get_file_decompression_app(path)
+  if decomp and ext != ".gz" and shutil.which(decomp[0][0]) is None:
+    raise Exception("%s is needed to decompress %s." % (decomp[0][0], path))
+  # gunzip is slower than zlib in-process.
+  return None if ext == ".gz" else decomp
+
+
+class StreamFeeder(threading.Thread):
+  """Fetches the source and writes it to a pipe, decompressing gzip in the
+process when there is no pigz. zlib and the socket/file reads drop the GIL,
+so the big buffers do the work.
+
+source: file path, URL, or the fd of an upstream pipe.
+out_fd: a pipe fd, or a list of them to tee the stream into. A tee output
+  that stops reading (its partclone died) is dropped and the rest go on.
+
+drive_process() takes this as one of its processes (pid, wait(), terminate())
+and reads its error pipe like a child's stderr.
+"""
+
+  def __init__(self, source, out_fd, gunzip=False):
+    super().__init__(daemon=True, name="StreamFeeder")
+    self.source = source
+    self.out_fds = list(out_fd) if isinstance(out_fd, (list, tuple)) else [out_fd]
+    self.tee = isinstance(out_fd, (list, tuple))
+    self.dropped = []
+    self.gunzip = gunzip
+    self.pid = os.getpid()
+    self.returncode = None
+    self.running = True
+    self.err_read, self.err_write = os.pipe()
+    self.stderr = os.fdopen(self.err_read, "rb", buffering=0)
+    pass
+
+  def open_source(self):
+    if isinstance(self.source, int):
+      return os.fdopen(self.source, "rb", buffering=0)
+    if get_transport_scheme(self.source):
+      return urllib.request.urlopen(self.source)
+    return open(self.source, "rb", buffering=0)
+
+  def report(self, message):
+    os.write(self.err_write, (message + "\n").encode("iso-8859-1", "replace"))
+    pass
+
+  def write_out(self, data):
+    for out_fd in list(self.out_fds):
+      view = memoryview(data)
+      try:
+        while len(view) > 0:
+          view = view[os.write(out_fd, view):]
+          pass
+        pass
+      except OSError as exc:
+        if not self.tee:
+          raise
+        self.report("Output %d dropped. %s" % (out_fd, str(exc)))
+        self.out_fds.remove(out_fd)
+        self.dropped.append(out_fd)
+        os.close(out_fd)
+        if not self.out_fds:
+          raise Exception("Every output is gone.")
+        pass
+      pass
+    pass
+
+  def run(self):
+    buffer = bytearray(FEED_BUFFER_SIZE)
+    view = memoryview(buffer)
+    decomp = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16) if self.gunzip else None
+    try:
+      with self.open_source() as source:
+        while self.running:
+          nread = source.readinto(view)
+          if not nread:
+            break
+          if decomp is None:
+            self.write_out(view[:nread])
+            continue
+          data = view[:nread]
+          while True:
+            inflated = decomp.decompress(data, INFLATE_SIZE)
+            self.write_out(inflated)
+            if decomp.eof:
+              # A .gz can be several gzip members back to back.
+              data = decomp.unused_data
+              decomp = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+              if not data:
+                break
+              continue
+            data = decomp.unconsumed_tail
+            # A full INFLATE_SIZE may have more behind it even with no
+            # input left.
+            if not data and len(inflated) < INFLATE_SIZE:
+              break
+            pass
+          pass
+        pass
+      self.returncode = 0 if self.running else -15
+    except Exception:
+      self.report(traceback.format_exc())
+      self.returncode = 1
+    finally:
+      view.release()
+      for out_fd in self.out_fds:
+        os.close(out_fd)
+        pass
+      os.close(self.err_write)
+      pass
+    pass
+
+  def wait(self):
+    self.join()
+    return self.returncode
+
+  def terminate(self):
+    self.running = False
+    pass
+  pass
+
+
+def partclone_proc_name(dest_dev, dest_devs):
+  """partclone's name in the DriverEvents. With several destinations, it
+carries the destination so the progress can be told apart."""
+  return "partclone" if len(dest_devs) == 1 else "partclone:%s" % dest_dev
+
+
+def load_disk_inprocess(source, dest_devs, partclone_path, bin_name="LOADER"):
+  """source -> (decompressor) -> partclone with one big pipe into partclone.
+With more than one destination, the stream is decompressed once and teed
+into a partclone per destination. One of them failing doesn't stop the rest.
+"""
+  transport_scheme = get_transport_scheme(source)
+  decomp = get_fast_decompression_app(source)
+  gunzip = decomp is None and os.path.splitext(source)[1] == ".gz"
+  print("%s decomp %s" % (bin_name, str(decomp) if decomp else ("zlib" if gunzip else "none")))
+
+  processes = []
+  pipes = []
+  feeders = []
+
+  partclone_stdins = []
+  partclone_feeds = []
+  for dest_dev in dest_devs:
+    partclone_stdin, partclone_feed = make_big_pipe()
+    partclone_stdins.append(partclone_stdin)
+    partclone_feeds.append(partclone_feed)
+    pass
+
+  # With one partclone, whoever decodes writes to it straight. With more,
+  # the decoded stream comes back here to be teed.
+  if len(dest_devs) == 1:
+    upstream_out = partclone_feeds[0]
+    tee_in = None
+  else:
+    tee_in, upstream_out = make_big_pipe()
+    pass
+
+  if decomp:
+    argv_decomp = decomp[0] + decomp[1]
+    if transport_scheme:
+      decomp_stdin, feeder_out = make_big_pipe()
+    else:
+      # The decompressor reads the file itself.
+      argv_decomp.append(source)
+      decomp_stdin = subprocess.DEVNULL
+      feeder_out = None
+      pass
+    decompressor = subprocess.Popen(argv_decomp, stdin=decomp_stdin, stdout=upstream_out, stderr=subprocess.PIPE)
+    processes.append((argv_decomp[0], decompressor))
+    pipes.append(PipeInfo(argv_decomp[0], decompressor, "stderr", decompressor.stderr))
+    os.close(upstream_out)
+    if feeder_out is not None:
+      os.close(decomp_stdin)
+      feeders.append(("feeder", StreamFeeder(source, feeder_out)))
+      pass
+    if tee_in is not None:
+      feeders.append(("tee", StreamFeeder(tee_in, partclone_feeds)))
+      pass
+    pass
+  elif tee_in is not None:
+    # Nothing in between. The feeder tees.
+    os.close(tee_in)
+    os.close(upstream_out)
+    feeders.append(("feeder", StreamFeeder(source, partclone_feeds, gunzip=gunzip)))
+  else:
+    feeders.append(("feeder", StreamFeeder(source, upstream_out, gunzip=gunzip)))
+    pass
+
+  for feeder_name, feeder in feeders:
+    processes.append((feeder_name, feeder))
+    pipes.append(PipeInfo(feeder_name, feeder, "stderr", feeder.stderr))
+    pass
+
+  partclone_names = []
+  for dest_dev, partclone_stdin in zip(dest_devs, partclone_stdins):
+    proc_name = partclone_proc_name(dest_dev, dest_devs)
+    argv_partclone = [ partclone_path, "-f", "2", "-r", "-L", "/dev/null", "-s", "-", "-o", dest_dev ]
+    partclone = subprocess.Popen(argv_partclone, stdin=partclone_stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    os.close(partclone_stdin)
+    processes.append((proc_name, partclone))
+    pipes.append(PipeInfo(proc_name, partclone, "stdout", partclone.stdout))
+    pipes.append(PipeInfo(proc_name, partclone, "stderr", partclone.stderr))
+    partclone_names.append(proc_name)
+    pass
+
+  for feeder_name, feeder in feeders:
+    feeder.start()
+    pass
+  # A lone partclone failing is the whole restore failing.
+  return drive_process(bin_name, processes, pipes, independent=partclone_names if len(dest_devs) > 1 else ())
+
+
+def load_disks(source, dest_devs, filesystem=None, engine=ENGINE_PIPELINE):
+  """Restores the source to every one of dest_devs with one fetch and one
+decompression. Always the in-process engine - the stream has to be teed."""
+  if len(dest_devs) == 1:
+    return load_disk(source, dest_devs[0], filesystem=filesystem, engine=engine)
+
+  for dest_dev in dest_devs:
+    if not is_block_device(dest_dev):
+      return 1
+    pass
+
+  partclone_path = os.path.join('/', 'usr', 'sbin', 'partclone.%s' % filesystem)
+  if not os.path.exists(partclone_path):
+    return 1
+  return load_disk_inprocess(source, dest_devs, partclone_path)
+
+
+def load_disk(source, dest_dev, filesystem=None, engine=ENGINE_PIPELINE):
   if not is_block_device(dest_dev):
     return 1
 
@@ -15,6 +290,9 @@ def load_disk(source, dest_dev, filesystem=None):
   if not os.path.exists(partclone_path):
     return 1
 
+  if engine == ENGINE_INPROCESS:
+    return load_disk_inprocess(source, [dest_dev], partclone_path)
+
   bin_name = "LOADER"
 
   transport_scheme = get_transport_scheme(source)
@@ -96,16 +374,24 @@ def load_disk(source, dest_dev, filesystem=None):
 
 
 if __name__ == "__main__":
-  if len(sys.argv) != 4:
-    sys.stderr.write('restore_volume.py <source> [ext4|fat32] <destdev>\n  source: URL\n  destdev: device file\n')
+  args = sys.argv[1:]
+  engine = ENGINE_PIPELINE
+  if len(args) >= 5 and args[0] == "-e":
+    engine = args[1]
+    args = args[2:]
+    pass
+  if len(args) < 3 or engine not in [ENGINE_PIPELINE, ENGINE_INPROCESS]:
+    sys.stderr.write('restore_volume.py [-e pipeline|inprocess] <source> [ext4|fat32] <destdev> [<destdev>...]\n  source: URL\n  destdev: device file. With more than one, the image is decompressed once for all.\n')
     sys.exit(1)
     pass
     
-  device = sys.argv[3]
-  if not is_block_device(device):
-    sys.stderr.write("%s is not a block device.\n" % device)
-    sys.exit(1)
+  devices = args[2:]
+  for device in devices:
+    if not is_block_device(device):
+      sys.stderr.write("%s is not a block device.\n" % device)
+      sys.exit(1)
+      pass
     pass
 
-  sys.exit(load_disk(sys.argv[1], device, filesystem=sys.argv[2]))
+  sys.exit(load_disks(args[0], devices, filesystem=args[1], engine=engine))
   pass
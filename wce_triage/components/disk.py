@@ -3,8 +3,7 @@
 # MIT license - see LICENSE
 from __future__ import annotations
 
-import re, subprocess, traceback, time, os
-import json
+import re, subprocess, threading, traceback, time, os
 import typing
 from enum import Enum
 
@@ -182,6 +181,65 @@ def _read_sysfs_line(path):
   pass
 
 
+# Where the whole disks are, and where udev keeps each device's properties
+# (the E: lines of b<major>:<minor> are what `udevadm info --query=property`
+# prints, less what comes from sysfs).
+SYSFS_ROOT = '/sys'
+UDEV_DATA_DIR = '/run/udev/data'
+# A new disk is left out until udev has written its properties down - its
+# rules run after the kernel's uevent that set off the pass. Past this many
+# seconds, the disk goes in with what sysfs says.
+UDEV_SETTLE_SECONDS = 10
+
+# Whole disks in /sys/block. Partitions are below them, not next to them.
+disk_name_re = re.compile(r'(sd[a-z]+|nvme\d+n\d+)$')
+
+
+def _read_devnum(name):
+  """"major:minor" of /sys/block/<name>, or None when it's gone."""
+  return _read_sysfs_line(os.path.join(SYSFS_ROOT, 'block', name, 'dev'))
+
+
+def _read_device_properties(name, devnum):
+  """udev properties of a block device, read from udev's database and sysfs
+  instead of running udevadm. None when the device isn't there."""
+  block_dir = os.path.join(SYSFS_ROOT, 'block', name)
+  if not os.path.exists(block_dir):
+    return None
+  props = {'DEVPATH': os.path.realpath(block_dir)[len(SYSFS_ROOT):]}
+  try:
+    with open(os.path.join(UDEV_DATA_DIR, 'b' + devnum)) as udev_data:
+      for line in udev_data.read().splitlines():
+        if line.startswith('E:'):
+          tag, _, value = line[2:].partition('=')
+          props[tag] = value
+          pass
+        pass
+      pass
+    pass
+  except OSError:
+    # No udev. What the device itself says then.
+    for tag, attribute in [('ID_VENDOR', 'vendor'), ('ID_MODEL', 'model'), ('ID_SERIAL', 'serial')]:
+      value = _read_sysfs_line(os.path.join(block_dir, 'device', attribute))
+      if value:
+        props[tag] = value.replace(' ', '_')
+        pass
+      pass
+    pass
+  return props
+
+
+def _read_nvme_properties(name):
+  """The `nvme list -o json` entry of an NVMe namespace, from sysfs."""
+  block_dir = os.path.join(SYSFS_ROOT, 'block', name)
+  size = _read_sysfs_line(os.path.join(block_dir, 'size'))
+  return {"DevicePath": "/dev/" + name,
+          "Firmware": _read_sysfs_line(os.path.join(block_dir, 'device', 'firmware_rev')) or "",
+          "ModelNumber": _read_sysfs_line(os.path.join(block_dir, 'device', 'model')) or "",
+          "SerialNumber": _read_sysfs_line(os.path.join(block_dir, 'device', 'serial')) or "",
+          "PhysicalSize": 512 * int(size) if size else 0}
+
+
 def _detect_usb_speed_mbps(devpath):
   """USB link speed in Mbps, read from the ancestor USB device node's
   `speed` sysfs attribute (e.g. 480 for USB2 High Speed, 5000/10000/20000
@@ -270,6 +328,7 @@ class Disk:
   byte_size: int | None
   sectors: int | None
   mounted: bool
+  devnum: str | None
   is_disk: bool | None
   bus_type: BusType | None
   vendor: str
@@ -286,9 +345,10 @@ class Disk:
   storage_property: StorageProperty | None
 
 
-  def __init__(self, device_name=None, mounted=False):
+  def __init__(self, device_name=None, mounted=False, devnum=None):
     self.verdict = False  # True if this is valid disk
     self.device_name = device_name
+    self.devnum = devnum  # "major:minor"
     self.partitions = []
     self.byte_size = None
     self.sectors = None
@@ -427,10 +487,29 @@ class Disk:
     return installed
   
   
+  def _queue_attribute(self, name):
+    return _read_sysfs_line(os.path.join(SYSFS_ROOT, 'block', os.path.basename(self.device_name), 'queue', name))
+
+  def is_rotational(self) -> bool | None:
+    """True for spinning disks, False for SSDs. None if the kernel doesn't say."""
+    value = self._queue_attribute("rotational")
+    if value is None:
+      return None
+    return value == "1"
+
+  def supports_discard(self) -> bool:
+    """The block layer takes discard (TRIM/deallocate) requests for this disk."""
+    value = self._queue_attribute("discard_max_bytes")
+    try:
+      return int(value) > 0
+    except (TypeError, ValueError):
+      return False
+    pass
+
   def get_byte_size(self):
     if self.byte_size is not None:
       return self.byte_size
-    size_fd = open("/sys/block/%s/size" % os.path.split(self.device_name)[1])
+    size_fd = open(os.path.join(SYSFS_ROOT, 'block', os.path.basename(self.device_name), 'size'))
     self.byte_size = 512*int(size_fd.read())
     size_fd.close()
     return self.byte_size
@@ -459,39 +538,14 @@ class Disk:
     self.is_disk = False
     self.bus_type = None
 
-    out = ""
-    err = ""
-    cmd = ['udevadm', 'info', '--query=property', '--name=' + self.device_name]
-    try:
-      udevadm = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='iso-8859-1', timeout=5)
-      out = udevadm.stdout
-      err = udevadm.stderr
-    except Exception as exc:
-      tlog.debug(traceback.format_exc())
-      pass
-      
-    err = err.strip()
-    if err:
-      tlog.info(" ".join(cmd) + ":\n" + err)
-      pass
-
-    if err == "device node not found":
-      # The disk has a bad partition map and udevadm doesn't produce
-      # any info.
+    name = os.path.basename(self.device_name)
+    if self.devnum is None:
+      self.devnum = _read_devnum(name)
       pass
+    props = _read_device_properties(name, self.devnum) if self.devnum else None
 
-    if out:
+    if props:
       self.is_disk = True
-      props = {}
-      for line in out.splitlines():
-        try:
-          elems = line.split('=')
-          tag = elems[0].strip()
-          value = elems[1].strip()
-          props[tag] = value
-        except:
-          pass
-        pass
 
       for tag in ["ID_BUS", "DEVPATH", "ID_VENDOR", "ID_MODEL", "ID_SERIAL", "ID_USB_DRIVER", "ID_ATA_FEATURE_SET_SMART", "ID_ATA_FEATURE_SET_SMART_ENABLED"]:
         value = props.get(tag)
@@ -557,15 +611,10 @@ class Disk:
         pass
       pass
     else:
+      tlog.info("detect_disk: %s is not in %s" % (self.device_name, os.path.join(SYSFS_ROOT, 'block')))
       self.is_disk = False
       pass
 
-
-
-    if err.strip():
-      tlog.info(" ".join(cmd) + ":\n" + err)
-      pass
-
     if self.bus_type == BusType.USB:
       tlog.debug("detect_disk: %s uses '%s' usb driver" % (self.device_name, str(self.usb_driver)))
       pass
@@ -593,8 +642,8 @@ class Disk:
 # nvme class represents nvme ssd
 #
 class Nvme(Disk):
-  def __init__(self, prop=None, device_name=None, mounted=False):
-    # So prop comes back from nvme list.
+  def __init__(self, prop=None, device_name=None, mounted=False, devnum=None):
+    # So prop comes back from nvme list, or _read_nvme_properties().
     #
     #  "DevicePath" : "/dev/nvme0n1",
     #  "Firmware" : "6L7QCXY7",
@@ -612,7 +661,7 @@ class Nvme(Disk):
     if device_name is None and prop:
       device_name = prop.get("DevicePath")
       pass
-    super().__init__(device_name=device_name, mounted=mounted)
+    super().__init__(device_name=device_name, mounted=mounted, devnum=devnum)
 
     # Since it's coming back from nvme list command,
     # it must be a nvme disk, and detected.
@@ -627,6 +676,11 @@ class Nvme(Disk):
     if prop:
       self.is_disk = True
       self.is_detected = True
+      self.model_name = prop.get("ModelNumber", "")
+      self.serial_no = prop.get("SerialNumber", "")
+      if prop.get("PhysicalSize"):
+        self.byte_size = prop["PhysicalSize"]
+        pass
     else:
       self.is_disk = False
       self.is_detected = False
@@ -718,10 +772,32 @@ def create_storage_instance(device_name):
 # 
 #
 #
+mount_re = re.compile(r"(/dev/[a-z]+|/dev/nvme[0-9]+n[0-9]+)(p[0-9]*) ([a-z0-9/\.\-_\+\=,]+) ([a-z0-9]+) (.*)")
+
+
+def _disk_order(name):
+  # sda .. sdz, sdaa .., then the NVMe ones - the kernel's order.
+  return (name.startswith("nvme"), len(name), name)
+
+
 class DiskPortal(Component):
+  """The disks, kept up to date by detect_disks(). Known disks are indexed by
+  their device number, so a pass only lists /sys/block and reads each disk's
+  dev attribute - a disk is looked at closely once, when it shows up, or
+  again after a uevent says it changed (note_uevent())."""
 
   def __init__(self, live_system=False):
     self.disks = []
+    # "major:minor" -> Disk, mounted ones too
+    self.index = {}
+    self.by_device_name = {}
+    # Device numbers a uevent said changed. Set from the event loop.
+    self.stale = set()
+    self.stale_lock = threading.Lock()
+    # "major:minor" -> when a new disk was first seen without udev's data
+    self.udev_pending = {}
+    self.mounted_devices = {}
+    self.mounted_partitions = {}
     self.detect_disks(live_system=live_system)
     pass
 
@@ -732,29 +808,74 @@ class DiskPortal(Component):
   # Find out the mounted partitions
   #
   def detect_mounts(self):
-    self.mounted_devices = {}
-    self.mounted_partitions = {}
+    mounted_devices = {}
+    mounted_partitions = {}
 
     # Known mounted disks. 
     # These cannot be the target
-    mount_re = re.compile(r"(/dev/[a-z]+|/dev/nvme[0-9]+n[0-9]+)(p[0-9]*) ([a-z0-9/\.\-_\+\=,]+) ([a-z0-9]+) (.*)")
     with open('/proc/mounts') as mount_f:
       for one_mount in mount_f.readlines():
         m = mount_re.match(one_mount)
         if m:
           device_name = m.group(1)
-          if device_name in self.mounted_devices:
-            self.mounted_devices[device_name] = self.mounted_devices[device_name] + ", " + m.group(3)
+          if device_name in mounted_devices:
+            mounted_devices[device_name] = mounted_devices[device_name] + ", " + m.group(3)
           else:
-            self.mounted_devices[device_name] = m.group(3)
+            mounted_devices[device_name] = m.group(3)
             pass
           partition_name = m.group(1) + m.group(2)
-          self.mounted_partitions[partition_name] = m.group(3)
+          mounted_partitions[partition_name] = m.group(3)
           pass
         pass
       pass
+    self.mounted_devices = mounted_devices
+    self.mounted_partitions = mounted_partitions
     pass
-  
+
+  def note_uevent(self, action, devnum):
+    """A block device uevent. A disk that changed (new media, new partition
+    table) is looked at again on the next detect_disks()."""
+    if action in ("change", "remove") and devnum in self.index:
+      with self.stale_lock:
+        self.stale.add(devnum)
+        pass
+      pass
+    pass
+
+  def _scan_block_devices(self):
+    """{ "major:minor": name } of the whole disks in /sys/block."""
+    found = {}
+    try:
+      names = os.listdir(os.path.join(SYSFS_ROOT, 'block'))
+    except OSError:
+      return found
+    for name in names:
+      if not disk_name_re.match(name):
+        continue
+      devnum = _read_devnum(name)
+      if devnum:
+        found[devnum] = name
+        pass
+      pass
+    return found
+
+  def _udev_pending(self, name, devnum):
+    """True while udev is yet to write down a new disk's properties."""
+    if (name.startswith("nvme") or not os.path.isdir(UDEV_DATA_DIR)
+        or os.path.exists(os.path.join(UDEV_DATA_DIR, 'b' + devnum))):
+      self.udev_pending.pop(devnum, None)
+      return False
+    first_seen = self.udev_pending.setdefault(devnum, time.monotonic())
+    if time.monotonic() - first_seen < UDEV_SETTLE_SECONDS:
+      return True
+    tlog.info("udev has nothing on /dev/%s. Going with what sysfs says." % name)
+    return False
+
+  def _detect_new_disk(self, name, devnum):
+    if name.startswith("nvme"):
+      return Nvme(_read_nvme_properties(name), devnum=devnum)
+    disk = Disk('/dev/' + name, devnum=devnum)
+    return disk if disk.detect_disk() else None
 
   # live_system is true for live-triage
   # live_system is false for loading and imaging disk
@@ -762,138 +883,67 @@ class DiskPortal(Component):
     # Know what's mounted already
     self.detect_mounts()
 
-    disk_entry_re = re.compile(r'\s+(\d+)\s+(\d+)\s+([\w\d]+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)\s+(\d+)')
+    with self.stale_lock:
+      stale = self.stale
+      self.stale = set()
+      pass
 
-    # Marked first to see it's redetected.
-    existing_disks = {}
-    for disk in self.disks:
-      existing_disks[disk.device_name] = disk
+    found = self._scan_block_devices()
+    self.udev_pending = { devnum: first_seen for devnum, first_seen in self.udev_pending.items() if devnum in found }
+    for devnum in list(self.index):
+      disk = self.index[devnum]
+      if found.get(devnum) != os.path.basename(disk.device_name) or devnum in stale:
+        # Gone, or a different disk under the number now.
+        del self.index[devnum]
+        pass
       pass
 
     added_disks = []
     updated_disks = []
     removed_disks = []
-    has_nvme = False
-
-    # Find the disks from diskstats
-    with open('/proc/diskstats') as diskstats:
-      for disk_entry in diskstats.readlines():
-        matched = disk_entry_re.match(disk_entry)
-        if matched:
-          dev_type = matched.group(1)
-          dev_node = matched.group(2)
-          dev_name = matched.group(3)
-
-          if dev_type == '259':
-            # This is nvme
-            has_nvme = True
-            continue
-
-          if dev_type != '8':
-            # This is not a disk
-            continue
-
-          node_number = int(dev_node)
-          if node_number % 16 != 0:
-            # This is not a disk node. Rather, is a partition of disk
-            continue
-
-          # device name in diskstats has no device file path, so make it up.
-          device_name = '/dev/'+dev_name
-          is_mounted = device_name in self.mounted_devices
-          if is_mounted and (not live_system):
-            # Mounted disk %s is not included in the candidate." % device_name
-            continue
-
-          disk = existing_disks.get(device_name)
-          if disk is None:
-            disk = Disk(device_name, mounted=is_mounted)
-            if disk.detect_disk():
-              self.disks.append(disk)
-              added_disks.append(disk)
-              pass
-            pass
-          else:
-            # Consume the disk entry
-            existing_disks[device_name] = None
-            if disk.mounted != is_mounted:
-              disk.mounted = is_mounted
-              updated_disks.append(disk)
-              pass
-            pass
-          pass
-        pass
-      pass
 
-    if has_nvme:
-      cmd = "nvme list -o json"
-      out = None
-      err = None
-      try:
-        nvme = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', timeout=5)
-        out = nvme.stdout
-        err = nvme.stderr
-      except Exception as exc:
-        tlog.info(cmd + ":\n" + traceback.format_exc())
+    current = {}
+    for devnum, name in sorted(found.items(), key=lambda item: _disk_order(item[1])):
+      disk = self.index.get(devnum)
+      if disk is None:
+        if self._udev_pending(name, devnum):
+          # udev's own uevent, once it's done, brings on the next pass.
+          continue
+        disk = self._detect_new_disk(name, devnum)
+        if disk is None:
+          continue
+        self.index[devnum] = disk
         pass
-
-      if err:
-        if not err.find("Permission denied") >= 0:
-          tlog.info(cmd + ":\n" + err)
+      is_mounted = disk.device_name in self.mounted_devices
+      if is_mounted and (not live_system):
+        # Mounted disk %s is not included in the candidate." % device_name
+        continue
+      if disk.mounted != is_mounted:
+        disk.mounted = is_mounted
+        if disk.device_name in self.by_device_name:
+          updated_disks.append(disk)
           pass
         pass
+      current[disk.device_name] = disk
+      pass
 
-      if not out or len(out) == 0:
-        nvme_output = {"Devices": []}
+    disks = []
+    for disk in self.disks:
+      if current.get(disk.device_name) is disk:
+        disks.append(disk)
       else:
-        nvme_output = json.loads(out)
-        pass
-
-      for device in nvme_output["Devices"]:
-        # "DevicePath" : "/dev/nvme0n1",
-        # "Firmware" : "6L7QCXY7",
-        # "Index" : 0,
-        # "ModelNumber" : "SAMSUNG MZVLW512HMJP-000L7",
-        # "ProductName" : "Unknown Device",
-        # "SerialNumber" : "S359NB0J504295",
-        # "UsedBytes" : 13095006208,
-        # "MaximiumLBA" : 1000215216,
-        # "PhysicalSize" : 512110190592,
-        # "SectorSize" : 512
-
-        device_name = device['DevicePath']
-        is_mounted = device_name in self.mounted_devices
-        if is_mounted and (not live_system):
-          # Mounted nvme %s is not included in the candidate." % device_name
-          continue
-
-        nvmessd = existing_disks.get(device_name)
-        if nvmessd is None:
-          nvmessd = Nvme(device, mounted=is_mounted)
-          self.disks.append(nvmessd)
-          added_disks.append(nvmessd)
-          pass
-        else:
-          # Consume the disk entry
-          existing_disks[device_name] = None
-          if nvmessd.mounted != is_mounted:
-            nvmessd.mounted = is_mounted
-            updated_disks.append(nvmessd)
-            pass
-          pass
+        # Gone, or re-detected as a new Disk.
+        removed_disks.append(disk)
         pass
       pass
-
-    for device_name, disk in existing_disks.items():
-      if disk is not None:
-        removed_disks.append(disk)
-        try:
-          self.disks.remove(disk)
-        except ValueError:
-          # Ignore non-existing disk
-          pass
+    for device_name, disk in current.items():
+      if disk not in disks:
+        disks.append(disk)
+        added_disks.append(disk)
         pass
       pass
+    self.disks = disks
+    self.by_device_name = current
     return (added_disks, updated_disks, removed_disks)
 
   def count(self):
@@ -901,11 +951,7 @@ class DiskPortal(Component):
 
 
   def find_disk_by_device_name(self, device_name):
-    for disk in self.disks:
-      if disk.device_name == device_name:
-        return disk
-      pass
-    return None
+    return self.by_device_name.get(device_name)
 
 
   def decision(self, live_system=False, **kwargs):
@@ -2,7 +2,7 @@
 # MIT license - see LICENSE
 """disk_image scans the disk image candidate directories and returns availabe disk images for loading.
 """
-import os, datetime, json, traceback
+import os, copy, datetime, json, stat, threading, time, traceback
 from ..lib.util import get_triage_logger
 
 tlog = get_triage_logger()
@@ -12,6 +12,246 @@ WCE_IMAGES = "/usr/local/share/wce/wce-disk-images"
 
 IMAGE_META_JSON_FILE = ".disk_image_type.json"
 
+#
+# Disk image codecs. The catalog's .disk_image_type.json picks the codec for
+# new images with "compression", e.g.
+#   "compression": { "codec": "zstd", "level": 15, "long": 27 }
+# gzip is the default. zstd decodes several times faster than gzip and we
+# restore the same image far more often than we make it.
+#
+CODEC_GZIP = "gzip"
+CODEC_ZSTD = "zstd"
+
+IMAGE_SUFFIXES = { CODEC_GZIP: ".partclone.gz",
+                   CODEC_ZSTD: ".partclone.zst" }
+
+DEFAULT_ZSTD_LEVEL = 15
+# 128MB window. zstd decodes up to this without being told --long.
+DEFAULT_ZSTD_LONG = 27
+
+
+def get_image_codec(filename):
+  """Codec of a disk image file by its suffix, None if it's not a disk image."""
+  for codec, suffix in IMAGE_SUFFIXES.items():
+    if filename.endswith(suffix):
+      return codec
+    pass
+  return None
+
+
+def get_image_compression(image_meta):
+  """The compression settings for new images in the catalog."""
+  compression = { "codec": CODEC_GZIP }
+  if image_meta and isinstance(image_meta.get("compression"), dict):
+    compression.update(image_meta["compression"])
+    pass
+  if compression["codec"] not in IMAGE_SUFFIXES:
+    raise Exception("Unknown disk image codec %s." % compression["codec"])
+  if compression["codec"] == CODEC_ZSTD:
+    compression.setdefault("level", DEFAULT_ZSTD_LEVEL)
+    compression.setdefault("long", DEFAULT_ZSTD_LONG)
+    pass
+  return compression
+
+#
+# The catalog index. Listing WCE_IMAGES is a listdir of it and of every
+# catalog, a stat of every image and a read of every .disk_image_type.json
+# - on an NFS share, a round trip each. The index keeps what they said and
+# looks again only at what changed: a directory whose mtime changed (a file
+# was added, removed or renamed in it), a .disk_image_type.json or
+# .list-order whose own stat changed. It is saved as JSON, so that a new
+# process - the server starting, a runner - starts from it, not a scan.
+#
+# A change in the same mtime tick as the one seen doesn't show (on some
+# filesystems the tick is a second). What was modified this recently is
+# looked at again next time.
+MTIME_SETTLE_SECONDS = 2
+# An image modified this recently may still be being written - its size is
+# looked at every time.
+IMAGE_SETTLE_SECONDS = 60
+CATALOG_INDEX_VERSION = 1
+
+
+def _default_catalog_index_path():
+  # Mirrors lib/util.py's setup_triage_logger() root-vs-non-root convention.
+  if os.getuid() == 0:
+    return '/tmp/triage-disk-images.json'
+  return '/tmp/development-disk-images.json'
+
+
+def _stat_signature(path):
+  """What tells a file or directory changed, or None when it isn't there."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return [st.st_mtime_ns, st.st_size, st.st_ino, stat.S_ISDIR(st.st_mode)]
+
+
+def _settled(signature):
+  """signature, or one that matches nothing when it was modified too recently
+  to be sure it won't change again unseen."""
+  if signature is not None and time.time() - signature[0] / 1e9 < MTIME_SETTLE_SECONDS:
+    return []
+  return signature
+
+
+class DiskImageCatalog:
+  """The catalog index of one images directory (WCE_IMAGES), brought up to
+  date by refresh()."""
+
+  def __init__(self, index_path=None):
+    self.index_path = index_path or _default_catalog_index_path()
+    self.index = None
+    self.lock = threading.Lock()
+    # listdir()s done, for seeing what the index saves.
+    self.listdirs = 0
+    pass
+
+  def refresh(self, root):
+    """Brings the index of root up to date, and returns a copy of it -
+    callers are free to change theirs."""
+    with self.lock:
+      if self.index is None or self.index["root"] != root:
+        self.index = self._load(root)
+        pass
+      if self._update(self.index):
+        self._save(self.index)
+        pass
+      return copy.deepcopy(self.index)
+    pass
+
+  def _empty(self, root):
+    return { "version": CATALOG_INDEX_VERSION, "root": root, "signature": [], "entries": [],
+             "list_order_signature": [], "list_order": {}, "catalogs": {} }
+
+  def _load(self, root):
+    try:
+      with open(self.index_path) as index_file:
+        index = json.load(index_file)
+        pass
+      if index.get("version") == CATALOG_INDEX_VERSION and index.get("root") == root:
+        return index
+      pass
+    except (OSError, ValueError):
+      pass
+    return self._empty(root)
+
+  def _save(self, index):
+    tmp_path = "%s.%d" % (self.index_path, os.getpid())
+    try:
+      with open(tmp_path, "w") as index_file:
+        json.dump(index, index_file)
+        pass
+      os.replace(tmp_path, self.index_path)
+    except OSError as exc:
+      tlog.debug("Can't save the disk image catalog index %s: %s" % (self.index_path, exc))
+      pass
+    pass
+
+  def _listdir(self, path):
+    self.listdirs += 1
+    return os.listdir(path)
+
+  def _update(self, index):
+    """Looks at what may have changed. True when something did."""
+    root = index["root"]
+    changed = False
+    signature = _stat_signature(root)
+    if signature is None or signature != index["signature"]:
+      index["entries"] = self._listdir(root) if signature else []
+      index["signature"] = _settled(signature)
+      index["catalogs"] = { name: catalog for name, catalog in index["catalogs"].items() if name in index["entries"] }
+      changed = True
+      pass
+
+    signature = _stat_signature(os.path.join(root, ".list-order"))
+    if signature != index["list_order_signature"]:
+      index["list_order"] = get_disk_image_list_order()
+      index["list_order_signature"] = _settled(signature)
+      changed = True
+      pass
+
+    for name in index["entries"]:
+      catalog = index["catalogs"].get(name)
+      if catalog is None:
+        catalog = { "signature": [], "meta_signature": [], "has_meta": False, "meta": None, "images": {} }
+        index["catalogs"][name] = catalog
+        pass
+      if self._update_catalog(os.path.join(root, name), catalog):
+        changed = True
+        pass
+      pass
+    return changed
+
+  def _update_catalog(self, catalog_dir, catalog):
+    changed = False
+    signature = _stat_signature(os.path.join(catalog_dir, IMAGE_META_JSON_FILE))
+    if signature != catalog["meta_signature"]:
+      catalog["meta"] = read_disk_image_type(catalog_dir)
+      catalog["has_meta"] = signature is not None and not signature[3]
+      catalog["meta_signature"] = _settled(signature)
+      changed = True
+      pass
+
+    signature = _stat_signature(catalog_dir)
+    if signature != catalog["signature"]:
+      images = {}
+      if signature and signature[3]:
+        for direntry in self._listdir(catalog_dir):
+          # Anything starting with "." is ignored
+          if direntry[0:1] != '.' and get_image_codec(direntry):
+            images[direntry] = None
+            pass
+          pass
+        pass
+      catalog["images"] = images
+      catalog["signature"] = _settled(signature)
+      changed = True
+      pass
+
+    now = time.time()
+    for filename, image in catalog["images"].items():
+      if image is not None and now - image["mtime"] >= IMAGE_SETTLE_SECONDS:
+        continue
+      try:
+        filestat = os.stat(os.path.join(catalog_dir, filename))
+      except OSError:
+        # Gone since the listdir - the directory's mtime says so next time.
+        continue
+      update = { "size": filestat.st_size, "mtime": filestat.st_mtime }
+      if update != image:
+        catalog["images"][filename] = update
+        changed = True
+        pass
+      pass
+    return changed
+  pass
+
+
+_catalog_ = None
+_catalog_lock = threading.Lock()
+
+def get_disk_image_catalog():
+  global _catalog_
+  if _catalog_ is None:
+    with _catalog_lock:
+      if _catalog_ is None:
+        _catalog_ = DiskImageCatalog()
+        pass
+      pass
+    pass
+  return _catalog_
+
+
+def _get_catalog_index():
+  """The up to date catalog index of WCE_IMAGES, None when there's no such directory."""
+  dirs = get_maybe_disk_image_directories()
+  if not dirs:
+    return None
+  return get_disk_image_catalog().refresh(dirs[0])
+
+
 def set_wce_disk_image_dir(dir):
   global WCE_IMAGES
   WCE_IMAGES = dir
@@ -76,7 +316,7 @@ def list_image_files(dirs):
       image_meta_file = os.path.join(catalog_dir, IMAGE_META_JSON_FILE)
       if not os.path.exists(image_meta_file) or not os.path.isfile(image_meta_file):
         continue
-      if direntry.endswith(".partclone.gz"):
+      if get_image_codec(direntry):
         images.append( (direntry, "", catalog_dir) )
         pass
       if os.path.isdir(catalog_dir):
@@ -84,7 +324,7 @@ def list_image_files(dirs):
           # Anything starting with "." is ignored
           if direntryinsubdir[0:1] == '.':
             continue
-          if direntryinsubdir.endswith(".partclone.gz"):
+          if get_image_codec(direntryinsubdir):
             images.append((direntryinsubdir, direntry, os.path.join(catalog_dir, direntryinsubdir)) )
             pass
           pass
@@ -114,23 +354,44 @@ def get_disk_images(wce_share_url=None):
     ..note the entries are deduped by the filename so if two directories
            contain the same file name, only one is pikced.
   '''
-  # gather disk image files
-  _images= list_image_files(get_maybe_disk_image_directories())
+  index = _get_catalog_index()
+  if index is None:
+    return []
+
+  # gather disk image files, as list_image_files() would, from the catalog index
+  # (fname, subdir, fullpath, size, mtime)
+  _images = []
+  for direntry in index["entries"]:
+    # Anything starting with "." is ignored
+    if direntry[0:1] == '.':
+      continue
+    catalog = index["catalogs"][direntry]
+    if not catalog["has_meta"]:
+      continue
+    catalog_dir = os.path.join(index["root"], direntry)
+    if get_image_codec(direntry):
+      filestat = os.stat(catalog_dir)
+      _images.append( (direntry, "", catalog_dir, filestat.st_size, filestat.st_mtime) )
+      pass
+    for filename, image in catalog["images"].items():
+      if image is not None:
+        _images.append( (filename, direntry, os.path.join(catalog_dir, filename), image["size"], image["mtime"]) )
+        pass
+      pass
+    pass
 
   # Dedup the same file name
   images = {}
   for image in _images:
-    fname, subdir, fullpath = image
-    images[fname] = image
+    images[image[0]] = image
     pass
 
   # Sort image listing order
   result = []
   for filename in sorted(images.keys(), reverse=True):
     image = images[filename]
-    fname, subdir, fullpath = image
-    filestat = os.stat(fullpath)
-    mtime = datetime.datetime.fromtimestamp(filestat.st_mtime)
+    fname, subdir, fullpath, size, st_mtime = image
+    mtime = datetime.datetime.fromtimestamp(st_mtime)
 
     # If wce_share_url is provided, reconstruct the fullpath. HTTP server needs to respond to the route.
     if wce_share_url:
@@ -141,13 +402,14 @@ def get_disk_images(wce_share_url=None):
               "restoreType" : subdir,
               "name": filename,
               "fullpath": fullpath,
-              "size": filestat.st_size,
+              "size": size,
               "subdir": subdir,
+              "codec": get_image_codec(filename),
               "index": len(result) }
     result.append(fattr)
     pass
 
-  list_order = get_disk_image_list_order()
+  list_order = index["list_order"]
   n = len(result)
   result.sort(key=lambda x: list_order.get(x["subdir"], len(list_order)) * n + x["index"])
   return result
@@ -177,28 +439,29 @@ def read_disk_image_types(verbose=False):
   ]
 
   '''
+  catalog_index = _get_catalog_index()
+  if catalog_index is None:
+    return []
+
   image_metas = []
-  for subdir in get_maybe_disk_image_directories():
+  if verbose:
+    print("Checking subdir " + catalog_index["root"])
+    pass
+  index = 0
+  for direntry in catalog_index["entries"]:
+    image_meta = catalog_index["catalogs"][direntry]["meta"]
     if verbose:
-      print("Checking subdir " + subdir)
+      print("Catalog dir " + os.path.join(catalog_index["root"], direntry))
+      print(image_meta)
       pass
-    index = 0
-    for direntry in os.listdir(subdir):
-      catalog_dir = os.path.join(subdir, direntry)
-      image_meta = read_disk_image_type(catalog_dir)
-      if verbose:
-        print("Catalog dir " + catalog_dir)
-        print(image_meta)
-        pass
-      if image_meta:
-        image_meta['index'] = index
-        image_metas.append(image_meta)
-        index += 1
-        pass
+    if image_meta:
+      image_meta['index'] = index
+      image_metas.append(image_meta)
+      index += 1
       pass
     pass
 
-  list_order = get_disk_image_list_order()
+  list_order = catalog_index["list_order"]
   n = len(image_metas)
 
   if list_order:
@@ -257,15 +520,16 @@ def make_disk_image_name(destdir, inname, filesystem='ext4'):
     imagename = imagename + "-" + timestamp
     pass
   # Right now, this is making ext4
-  imagename = imagename + ".%s.partclone.gz" % filesystem
+  codec = get_image_compression(image_meta)["codec"]
+  imagename = imagename + ".%s%s" % (filesystem, IMAGE_SUFFIXES[codec])
   return os.path.join(destdir, imagename)
 
 
 def get_file_system_from_source(source):
   filesystem_ext = None
-  tail = ".partclone.gz"
-  if source.endswith(tail):
-    source = source[:-len(tail)]
+  codec = get_image_codec(source)
+  if codec:
+    source = source[:-len(IMAGE_SUFFIXES[codec])]
   else:
     return None
   try:
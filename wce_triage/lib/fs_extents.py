@@ -0,0 +1,137 @@
+#
+# Used extents of a disk, for sparse copying (binarycopy -s)
+#
+# A triage stick is mostly empty file system. Everything outside the
+# partitions (partition table, gaps, backup GPT) is copied as is, and so are
+# partitions whose file system we can't read. For ext2/3/4 only the blocks
+# the block bitmap says are in use are copied - dumpe2fs prints the free
+# block ranges of every group.
+#
+# Extents are (byte offset, byte length) from the start of the disk.
+#
+import re
+import subprocess
+
+from .util import get_triage_logger
+
+tlog = get_triage_logger()
+
+SECTOR_SIZE = 512
+
+# mkswap's header lives in the first page. The rest of a swap partition is
+# never worth copying.
+SWAP_HEADER_SIZE = 2 ** 16
+
+block_size_re = re.compile(r"^Block size:\s+(\d+)")
+block_count_re = re.compile(r"^Block count:\s+(\d+)")
+free_blocks_re = re.compile(r"^\s+Free blocks:\s*(.*)$")
+
+
+def parse_dumpe2fs_output(out):
+  """Returns (block_size, block_count, free_ranges) out of dumpe2fs output.
+free_ranges is a list of (first_block, last_block), both inclusive."""
+  block_size = None
+  block_count = None
+  free_ranges = []
+  for line in out.splitlines():
+    m = block_size_re.match(line)
+    if m:
+      block_size = int(m.group(1))
+      continue
+    m = block_count_re.match(line)
+    if m:
+      block_count = int(m.group(1))
+      continue
+    m = free_blocks_re.match(line)
+    if m:
+      for blocks in m.group(1).split(","):
+        blocks = blocks.strip()
+        if not blocks:
+          continue
+        first, _, last = blocks.partition("-")
+        free_ranges.append((int(first), int(last) if last else int(first)))
+        pass
+      pass
+    pass
+  if block_size is None or block_count is None:
+    raise Exception("dumpe2fs output has no block size/count.")
+  return block_size, block_count, free_ranges
+
+
+def used_extents_from_free_ranges(block_size, block_count, free_ranges):
+  """Flips the free block ranges into used byte extents of the file system."""
+  extents = []
+  block = 0
+  for first, last in sorted(free_ranges):
+    if first > block:
+      extents.append((block * block_size, (first - block) * block_size))
+      pass
+    block = max(block, last + 1)
+    pass
+  if block < block_count:
+    extents.append((block * block_size, (block_count - block) * block_size))
+    pass
+  return extents
+
+
+def ext_used_extents(device_name):
+  """Used extents of the ext file system on device_name, relative to the
+start of the partition."""
+  dumpe2fs = subprocess.run(["dumpe2fs", device_name], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  if dumpe2fs.returncode != 0:
+    raise Exception("dumpe2fs %s failed. %s" % (device_name, dumpe2fs.stderr.decode('iso-8859-1')))
+  return used_extents_from_free_ranges(*parse_dumpe2fs_output(dumpe2fs.stdout.decode('iso-8859-1')))
+
+
+def merge_extents(extents):
+  """Sorts the extents and joins the ones that touch or overlap."""
+  merged = []
+  for offset, length in sorted(extents):
+    if length <= 0:
+      continue
+    if merged and offset <= merged[-1][0] + merged[-1][1]:
+      last_offset, last_length = merged[-1]
+      merged[-1] = (last_offset, max(last_length, offset + length - last_offset))
+    else:
+      merged.append((offset, length))
+      pass
+    pass
+  return merged
+
+
+def partition_used_extents(part, used_extents=ext_used_extents):
+  """Used extents of the partition, relative to the start of the disk.
+Anything that can't be read is copied whole."""
+  start = part.start_sector * SECTOR_SIZE
+  size = (part.end_sector - part.start_sector + 1) * SECTOR_SIZE
+  if part.file_system in ["ext2", "ext3", "ext4"]:
+    try:
+      return [(start + offset, min(length, size - offset))
+              for offset, length in used_extents(part.device_name) if offset < size]
+    except Exception as exc:
+      tlog.info("Copying all of %s. %s" % (part.device_name, str(exc)))
+      pass
+    pass
+  elif part.file_system == "swap":
+    return [(start, min(size, SWAP_HEADER_SIZE))]
+  return [(start, size)]
+
+
+def disk_used_extents(partitions, total_size, used_extents=ext_used_extents):
+  """Extents worth copying from a disk with the partitions, up to total_size.
+Gaps between partitions are kept since the partition table and boot code
+live there."""
+  extents = []
+  covered = 0
+  for part in sorted(partitions, key=lambda part: part.start_sector):
+    start = part.start_sector * SECTOR_SIZE
+    if start > covered:
+      extents.append((covered, start - covered))
+      pass
+    extents = extents + partition_used_extents(part, used_extents=used_extents)
+    covered = max(covered, (part.end_sector + 1) * SECTOR_SIZE)
+    pass
+  if covered < total_size:
+    extents.append((covered, total_size - covered))
+    pass
+  return [(offset, min(length, total_size - offset)) for offset, length in merge_extents(extents) if offset < total_size]
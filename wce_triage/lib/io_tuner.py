@@ -0,0 +1,76 @@
+#
+# Write size auto-tuning
+#
+# Old IDE disks, USB2 sticks and NVMe drives each like a different write
+# size, and one batch (multiwipe, binarycopy) can have all of them at once.
+# A WriteSizeTuner belongs to one destination. It hands out each candidate
+# size in turn for a short probe, times the writes, and then locks in the
+# size with the best throughput for the rest of the job.
+#
+import time
+
+# 64KB .. 16MB
+DEFAULT_WRITE_SIZES = [2 ** 16, 2 ** 18, 2 ** 20, 2 ** 22, 2 ** 24]
+
+
+class WriteSizeTuner:
+  """Picks the write size for one destination by measuring it.
+
+  Call next_size() for the size of the next write, then record() with how
+  many bytes went out and how long the write took. Only the time spent in
+  write() counts - waiting for the data to show up is not the device's fault.
+  """
+
+  def __init__(self, candidates=None, probe_seconds=0.5, probe_bytes=64 * 2**20, clock=time.monotonic):
+    self.candidates = sorted(candidates if candidates else DEFAULT_WRITE_SIZES)
+    self.probe_seconds = probe_seconds
+    self.probe_bytes = probe_bytes
+    self.clock = clock
+    self.throughputs = {}
+    self._probing = 0
+    self._probe_written = 0
+    self._probe_seconds = 0.0
+    self.best_size = None
+    pass
+
+  @property
+  def locked(self):
+    return self.best_size is not None
+
+  def next_size(self):
+    if self.locked:
+      return self.best_size
+    return self.candidates[self._probing]
+
+  def start(self):
+    """Returns the timestamp to hand back to record() after the write."""
+    return self.clock()
+
+  def record(self, nbytes, started):
+    """Accounts the write of nbytes that started at started (from start())."""
+    if self.locked:
+      return
+    self._probe_written += nbytes
+    self._probe_seconds += max(0.0, self.clock() - started)
+
+    # Probe each size until it's been given a fair chance - either long
+    # enough, or enough bytes for a fast device.
+    if self._probe_seconds < self.probe_seconds and self._probe_written < self.probe_bytes:
+      return
+
+    size = self.candidates[self._probing]
+    self.throughputs[size] = self._probe_written / max(self._probe_seconds, 1e-9)
+    self._probing += 1
+    self._probe_written = 0
+    self._probe_seconds = 0.0
+
+    if self._probing >= len(self.candidates):
+      self.best_size = max(self.throughputs, key=lambda size: self.throughputs[size])
+      pass
+    pass
+
+  def describe(self):
+    if not self.locked:
+      return "probing write size %d" % self.next_size()
+    return "write size %d (%s)" % (self.best_size, ", ".join(["%d: %dMB/s" % (size, round(bps / 2**20)) for size, bps in sorted(self.throughputs.items())]))
+  pass
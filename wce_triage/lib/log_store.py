@@ -1,6 +1,7 @@
 """sqlite3-backed store for operational history: generic log lines (tlog),
 user messages/errors, progress reports, task plans, and subprocess command
-start/end. Adds a second, queryable, timestamped destination alongside the
+start/end - and, in a table of their own, runners' progress samples (see
+ProgressRecorder). Adds a second, queryable, timestamped destination alongside the
 existing plain-text rotating log file and in-memory message list - tlog.*
 calls still land in the text file too, sqlite is additive, not a
 replacement.
@@ -11,12 +12,15 @@ api/server.py and api/internal/process_runner.py) - subprocess runners keep
 using their existing NDJSON-over-stdout-pipe mechanism back to the parent.
 """
 import atexit
+import collections
 import json
 import logging
 import os
-import queue
+import re
 import sqlite3
 import threading
+import time
+import urllib.parse
 from datetime import datetime, timezone
 from enum import Enum
 from typing import Any, Optional
@@ -26,7 +30,7 @@ class LogEventType(str, Enum):
   LOG = "LOG"                        # generic tlog.* call, via SQLiteLogHandler
   MESSAGE = "MESSAGE"                 # UserMessages.note()
   ERROR = "ERROR"                     # ErrorMessages.error() / severity==2 messages
-  PROGRESS = "PROGRESS"               # task_progress/task_success/task_failure/run_progress
+  PROGRESS = "PROGRESS"               # a step or a run finished/changed state (the ticks are progress samples)
   PLAN = "PLAN"                       # report=="tasks" - the one-shot flight plan at preflight
   COMMAND_START = "COMMAND_START"     # subprocess launched
   COMMAND_END = "COMMAND_END"         # subprocess exited (returncode carried in `data`)
@@ -35,10 +39,42 @@ class LogEventType(str, Enum):
 
 DEFAULT_MAX_BYTES = 512 * 1024 * 1024
 WRITER_POLL_INTERVAL = 0.2
-# Start pruning before the file actually hits the cap, since a prune cycle
+# Rows log() holds for the writer. Once the ring is full, rows are dropped
+# (and counted) rather than held up or kept in memory without end.
+RING_SIZE = 65536
+# Past this much of the ring, DEBUG rows are dropped already - the rest of
+# it is kept for everything else.
+DEBUG_RING_FILL = 0.5
+# What a full ring does with a row that isn't DEBUG: drop it, or drop the
+# oldest row waiting to make room for it. Config.LOG_OVERFLOW.
+OVERFLOW_DROP_NEWEST = "drop-newest"
+OVERFLOW_DROP_OLDEST = "drop-oldest"
+# Rows waiting that wake the writer before its next poll.
+WAKE_ROWS = 1024
+# Start pruning before the files actually hit the cap, since a prune cycle
 # doesn't happen on every drain - leaves headroom for the WAL file to grow
 # between checks without ever exceeding the cap in practice.
 PRUNE_THRESHOLD = 0.9
+# The live segment is closed and a new one started once it holds
+# SEGMENT_ROWS rows, reaches max_bytes / SEGMENTS_PER_CAP bytes, or has
+# been written to for SEGMENT_SECONDS - whichever comes first.
+SEGMENT_ROWS = 250000
+SEGMENTS_PER_CAP = 8
+SEGMENT_SECONDS = 3600
+# Oldest segments go past this many, however small, so a query never has
+# to open too many files.
+MAX_SEGMENTS = 64
+# Rows per insert and commit when draining. A backlog goes in in chunks,
+# with a look at whether the segment is full between them.
+DRAIN_CHUNK_ROWS = 5000
+# Seconds between progress samples of a runner's running steps, unless a
+# step or the run changes state. Config.PROGRESS_SAMPLE_INTERVAL.
+PROGRESS_SAMPLE_INTERVAL = 5
+# Filters whose row counts query() remembers (see LogStore._count()).
+COUNT_CACHE_SIZE = 32
+# The trigram tokenizer matches any substring of 3 characters or more, as
+# LIKE '%q%' did. Shorter search strings still go through LIKE.
+FTS_MIN_QUERY = 3
 
 
 def _default_db_path() -> str:
@@ -49,28 +85,83 @@ def _default_db_path() -> str:
   return '/tmp/development.db'
 
 
+class _Segment:
+  """One file of the log, <db_path>.<seq>. A segment's ids all come before
+  the next one's - log() hands them out in the order rows are queued - so
+  the segments in seq order are the log in id order."""
+
+  def __init__(self, seq: int, path: str):
+    self.seq = seq
+    self.path = path
+    # Rows written to it - kept by the writer, for the live segment.
+    self.rows = 0
+    # File size once it's closed. None for the live segment.
+    self.size: Optional[int] = None
+    # Its rows are in event_log_fts. Not so for the old single-file log,
+    # which q searches with LIKE.
+    self.fts = False
+    pass
+  pass
+
+
 class LogStore:
   """Owns one persistent writer connection (WAL mode) drained by a
   dedicated background thread, mirroring the writer-thread-+-queue pattern
   in bin/process_driver.py's DriverEmitter: log() never blocks the caller,
-  writes are batched (one executemany + commit per drain cycle, not one
-  commit per row), and callers should never touch the writer connection
-  directly. Reads (query()) open their own short-lived connection per call -
+  and leaves the formatting to the writer. What's waiting for the writer is
+  a bounded ring - when the writer falls behind, DEBUG rows are dropped
+  first, then whatever the overflow policy says, and the drops are counted
+  (see stats()). Writes are batched (one executemany + commit per drain
+  cycle, not one commit per row), and callers should never touch the writer
+  connection directly. Reads (query()) open their own short-lived connections per call -
   WAL mode's whole point is that readers don't block the writer and vice
   versa, so there's no need to share or lock the writer connection for reads.
+
+  The log is a series of segment files, each its own sqlite database with
+  its own indexes. The writer only ever appends to the newest one. The size
+  cap is kept by deleting the oldest segment file whole - no DELETE that
+  holds up the writer, and the space goes back to the filesystem.
   """
 
-  def __init__(self, db_path: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+  def __init__(self, db_path: Optional[str] = None, max_bytes: int = DEFAULT_MAX_BYTES,
+               segment_rows: int = SEGMENT_ROWS, segment_seconds: float = SEGMENT_SECONDS,
+               ring_size: int = RING_SIZE, overflow: str = OVERFLOW_DROP_NEWEST):
     self.db_path = db_path or _default_db_path()
     self.max_bytes = max_bytes
-    self._queue: "queue.Queue[tuple]" = queue.Queue()
+    self.segment_rows = segment_rows
+    self.segment_bytes = max_bytes // SEGMENTS_PER_CAP
+    self.segment_seconds = segment_seconds
+    self.ring_size = ring_size
+    self.overflow = overflow
+    # (table, row) - the rows as log() got them, formatted by the writer.
+    # deque's append() and popleft() are atomic, the writer takes rows off
+    # without a lock.
+    self._ring: "collections.deque[tuple]" = collections.deque()
+    # level (or table, for rows without one) -> rows dropped
+    self._dropped: "collections.Counter[str]" = collections.Counter()
+    self._written = 0
     self._wake = threading.Event()
     self._stop = threading.Event()
     self._ready = threading.Event()
     # Created inside _writer_loop(), not here - sqlite3 connections are
     # only usable from the thread that created them, and the writer thread
     # (not __init__'s caller) is the only thread ever allowed to touch it.
+    # It's the connection to the live segment, self._segments[-1].
     self._conn: Optional[sqlite3.Connection] = None
+    # Oldest first. The writer replaces the list, never changes it in place,
+    # so a reader's copy stays as it was.
+    self._segments: list[_Segment] = []
+    self._segments_lock = threading.Lock()
+    # The id of the last row log() handed out. The writer starts it off
+    # where the newest segment ends. The lock also keeps rows going into
+    # the ring in id order, and the drop counts right.
+    self._last_id = 0
+    self._id_lock = threading.Lock()
+    self._live_since = 0.0
+    # filter -> {segment seq: (count, highest id counted, segment was closed)}
+    # as of the last query() with it.
+    self._counts: "collections.OrderedDict[tuple, dict[int, tuple]]" = collections.OrderedDict()
+    self._counts_lock = threading.Lock()
 
     self._thread = threading.Thread(target=self._writer_loop, daemon=True, name="LogStore")
     self._thread.start()
@@ -101,11 +192,14 @@ class LogStore:
     conn.execute("PRAGMA busy_timeout=5000")
     pass
 
-  @staticmethod
-  def _create_schema(conn: sqlite3.Connection) -> None:
+  def _create_schema(self, conn: sqlite3.Connection) -> bool:
+    """Returns whether the segment has the full-text index - see
+    _create_fts()."""
+    # No AUTOINCREMENT - log() gives each row its id, carrying on from the
+    # previous segment.
     conn.execute("""
       CREATE TABLE IF NOT EXISTS event_log (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        id INTEGER PRIMARY KEY,
         timestamp TEXT NOT NULL,
         type TEXT NOT NULL,
         level TEXT,
@@ -114,24 +208,157 @@ class LogStore:
         data TEXT
       )
     """)
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_event_log_type ON event_log(type)")
+    # Each filter with id last, so a filtered page is a range scan in id
+    # order that stops after LIMIT rows. (type, id) supersedes the old
+    # index on type alone.
+    conn.execute("DROP INDEX IF EXISTS idx_event_log_type")
+    for column in ("type", "source", "level"):
+      conn.execute("CREATE INDEX IF NOT EXISTS idx_event_log_%s_id ON event_log(%s, id)" % (column, column))
+      pass
+    # One row per running step per sample - what a progress report's tasks
+    # entry says, as columns. run is the id of the run's PLAN row.
+    conn.execute("""
+      CREATE TABLE IF NOT EXISTS progress_sample (
+        id INTEGER PRIMARY KEY,
+        run INTEGER NOT NULL,
+        timestamp TEXT NOT NULL,
+        device TEXT,
+        step INTEGER,
+        status TEXT,
+        progress REAL,
+        elapse REAL,
+        run_time REAL,
+        run_estimate REAL,
+        bytes INTEGER
+      )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_progress_sample_run ON progress_sample(run, id)")
+    fts = self._create_fts(conn)
     conn.commit()
-    pass
+    return fts
+
+  @staticmethod
+  def _create_fts(conn: sqlite3.Connection) -> bool:
+    """Full-text index over message and data, kept in step with event_log
+    by triggers. It's an external content table - it holds the index, not
+    another copy of the text.
+
+    Only a segment that starts out empty gets one. Indexing rows already
+    there - the old single-file log - would hold up startup for as long
+    as it takes, and add to a segment that is never pruned; False, and q
+    searches it with LIKE. Also False when this sqlite has no FTS5 (or no
+    trigram tokenizer)."""
+    if not LogStore._has_fts(conn):
+      if conn.execute("SELECT 1 FROM event_log LIMIT 1").fetchone():
+        return False
+      try:
+        conn.execute("""
+          CREATE VIRTUAL TABLE event_log_fts USING fts5(
+            message, data, content='event_log', content_rowid='id', tokenize='trigram')
+        """)
+      except sqlite3.OperationalError:
+        return False
+      pass
+    conn.execute("""
+      CREATE TRIGGER IF NOT EXISTS event_log_fts_insert AFTER INSERT ON event_log BEGIN
+        INSERT INTO event_log_fts (rowid, message, data) VALUES (new.id, new.message, new.data);
+      END
+    """)
+    conn.execute("""
+      CREATE TRIGGER IF NOT EXISTS event_log_fts_delete AFTER DELETE ON event_log BEGIN
+        INSERT INTO event_log_fts (event_log_fts, rowid, message, data)
+          VALUES ('delete', old.id, old.message, old.data);
+      END
+    """)
+    return True
+
+  @staticmethod
+  def _has_fts(conn: sqlite3.Connection) -> bool:
+    return conn.execute(
+      "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'event_log_fts'").fetchone() is not None
 
   def log(self, event_type: LogEventType, message: str, level: Optional[str] = None,
-          source: Optional[str] = None, data: Optional[dict] = None) -> None:
+          source: Optional[str] = None, data: Optional[dict] = None,
+          args: Optional[tuple] = None, created: Optional[float] = None) -> int:
+    """Queues a row, and returns the id it will have - or would have had,
+    when the ring is full and the row is dropped.
+
+    Nothing is formatted here: the writer thread does message % args, the
+    timestamp (created, a time.time(), defaults to now) and data's JSON.
+    So data must not be changed after it's handed over."""
     row = (
-      datetime.now(timezone.utc).isoformat(),
+      created if created is not None else time.time(),
       event_type.value if isinstance(event_type, LogEventType) else str(event_type),
       level,
       source,
       message,
-      json.dumps(data) if data is not None else None,
+      args,
+      data,
     )
-    self._queue.put(row)
-    self._wake.set()
+    # Queued in id order, so that a segment's ids all come before the next's.
+    with self._id_lock:
+      self._last_id += 1
+      row_id = self._last_id
+      self._put("event_log", (row_id,) + row, level)
+      pass
+    return row_id
+
+  def _put(self, table: str, row: tuple, level: Optional[str]) -> None:
+    waiting = len(self._ring)
+    if waiting >= self.ring_size * DEBUG_RING_FILL and level == "DEBUG":
+      self._dropped[level] += 1
+      return
+    if waiting >= self.ring_size:
+      if self.overflow != OVERFLOW_DROP_OLDEST:
+        self._dropped[level or table] += 1
+        return
+      try:
+        dropped_table, dropped_row = self._ring.popleft()
+      except IndexError:
+        # The writer just took it.
+        pass
+      else:
+        self._dropped[(dropped_row[3] if dropped_table == "event_log" else None) or dropped_table] += 1
+        pass
+      pass
+    self._ring.append((table, row))
+    if waiting + 1 >= WAKE_ROWS and not self._wake.is_set():
+      self._wake.set()
+      pass
     pass
 
+  def log_progress(self, run: int, device: Optional[str], step: Optional[int], status: Optional[str],
+                   progress: Optional[float], elapse: Optional[float], run_time: Optional[float],
+                   run_estimate: Optional[float], bytes_done: Optional[int] = None) -> None:
+    """Queues a progress sample of one step of run (the id log() gave the
+    run's PLAN row)."""
+    row = (run, time.time(), device, step, status, progress, elapse, run_time, run_estimate, bytes_done)
+    with self._id_lock:
+      self._put("progress_sample", row, None)
+      pass
+    pass
+
+  def stats(self) -> dict[str, Any]:
+    """How the writer is keeping up: rows waiting in the ring and its size,
+    how long the oldest of them has waited (lag, in seconds), rows written
+    since start, and rows dropped by level (or by table, for rows without
+    a level)."""
+    try:
+      oldest = self._ring[0]
+    except IndexError:
+      oldest = None
+      pass
+    lag = 0.0
+    if oldest is not None:
+      table, row = oldest
+      lag = max(0.0, time.time() - row[1])
+      pass
+    with self._id_lock:
+      dropped = dict(self._dropped)
+      pass
+    return {"waiting": len(self._ring), "capacity": self.ring_size, "lag": lag,
+            "written": self._written, "dropped": dropped}
+
   def close(self) -> None:
     if self._stop.is_set():
       return
@@ -141,65 +368,250 @@ class LogStore:
     pass
 
   def _writer_loop(self) -> None:
-    self._conn = sqlite3.connect(self.db_path)
-    self._configure_writer(self._conn)
-    self._create_schema(self._conn)
+    self._open_segments()
     self._ready.set()
     while True:
       self._wake.wait(timeout=WRITER_POLL_INTERVAL)
       self._wake.clear()
       self._drain()
-      if self._stop.is_set() and self._queue.empty():
+      if self._stop.is_set() and not self._ring:
         break
       pass
     self._conn.close()
     pass
 
-  def _drain(self) -> None:
-    rows = []
-    while True:
+  def _segment_path(self, seq: int) -> str:
+    return "%s.%06d" % (self.db_path, seq)
+
+  @staticmethod
+  def _file_size(path: str) -> int:
+    size = 0
+    for suffix in ("", "-wal"):
       try:
-        rows.append(self._queue.get_nowait())
-      except queue.Empty:
-        break
+        size += os.path.getsize(path + suffix)
+      except OSError:
+        pass
+      pass
+    return size
+
+  @staticmethod
+  def _remove_files(path: str) -> None:
+    for suffix in ("", "-wal", "-shm"):
+      try:
+        os.unlink(path + suffix)
+      except FileNotFoundError:
+        pass
       pass
-    if not rows:
-      return
-    self._conn.executemany(
-      "INSERT INTO event_log (timestamp, type, level, source, message, data) VALUES (?, ?, ?, ?, ?, ?)",
-      rows)
-    self._conn.commit()
-    self._prune_if_needed()
     pass
 
-  def _current_size_bytes(self) -> int:
+  def _open_segments(self) -> None:
+    directory = os.path.dirname(os.path.abspath(self.db_path))
+    segment_re = re.compile(re.escape(os.path.basename(self.db_path)) + r"\.(\d+)(-wal|-shm)?$")
+    seqs = set()
+    orphans = set()
+    for name in os.listdir(directory):
+      matched = segment_re.match(name)
+      if matched is None:
+        continue
+      if matched.group(2) is None:
+        seqs.add(int(matched.group(1)))
+      else:
+        orphans.add(int(matched.group(1)))
+        pass
+      pass
+    for seq in orphans - seqs:
+      # -wal/-shm of a dropped segment, recreated by a reader that opened
+      # it just as it went.
+      self._remove_files(self._segment_path(seq))
+      pass
+
+    if not seqs and os.path.isfile(self.db_path):
+      # The log used to be this one file. It's the first segment now.
+      for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(self.db_path + suffix):
+          os.rename(self.db_path + suffix, self._segment_path(1) + suffix)
+          pass
+        pass
+      seqs.add(1)
+      pass
+
+    segments = []
+    for seq in sorted(seqs):
+      segment = _Segment(seq, self._segment_path(seq))
+      segment.size = self._file_size(segment.path)
+      conn = sqlite3.connect(segment.path)
+      try:
+        segment.fts = self._has_fts(conn)
+        last_id = conn.execute("SELECT MAX(id) FROM event_log").fetchone()[0]
+      except sqlite3.OperationalError:
+        last_id = None
+        pass
+      conn.close()
+      if last_id is not None:
+        self._last_id = last_id
+        pass
+      segments.append(segment)
+      pass
+
+    if segments:
+      live = segments[-1]
+      live.size = None
+      self._open_live(live)
+      live.rows = self._conn.execute("SELECT COUNT(*) FROM event_log").fetchone()[0]
+    else:
+      live = _Segment(1, self._segment_path(1))
+      self._open_live(live)
+      segments.append(live)
+      pass
+    with self._segments_lock:
+      self._segments = segments
+      pass
+    pass
+
+  def _open_live(self, segment: _Segment) -> None:
+    self._conn = sqlite3.connect(segment.path)
+    self._configure_writer(self._conn)
+    segment.fts = self._create_schema(self._conn)
+    self._live_since = time.monotonic()
+    pass
+
+  def _live_size_bytes(self, with_wal: bool = True) -> int:
     page_count = self._conn.execute("PRAGMA page_count").fetchone()[0]
     page_size = self._conn.execute("PRAGMA page_size").fetchone()[0]
     size = page_count * page_size
-    wal_path = self.db_path + "-wal"
+    if not with_wal:
+      return size
+    wal_path = self._segments[-1].path + "-wal"
     if os.path.isfile(wal_path):
       size += os.path.getsize(wal_path)
       pass
     return size
 
-  def _prune_if_needed(self) -> None:
-    if self._current_size_bytes() < self.max_bytes * PRUNE_THRESHOLD:
+  def _should_roll(self) -> bool:
+    live = self._segments[-1]
+    if live.rows == 0:
+      return False
+    return (live.rows >= self.segment_rows
+            or time.monotonic() - self._live_since >= self.segment_seconds
+            # Not the WAL - it comes and goes with checkpoints.
+            or self._live_size_bytes(with_wal=False) >= self.segment_bytes)
+
+  def _roll(self) -> None:
+    live = self._segments[-1]
+    self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    self._conn.close()
+    live.size = self._file_size(live.path)
+    segment = _Segment(live.seq + 1, self._segment_path(live.seq + 1))
+    # Schema first, then readers get to see it.
+    self._open_live(segment)
+    with self._segments_lock:
+      self._segments = self._segments + [segment]
+      pass
+    pass
+
+  @staticmethod
+  def _timestamp(created: float) -> str:
+    return datetime.fromtimestamp(created, timezone.utc).isoformat()
+
+  def _format_row(self, row: tuple) -> tuple:
+    row_id, created, event_type, level, source, message, args, data = row
+    if args:
+      try:
+        message = message % args
+      except Exception:
+        # What logging would have said, more or less.
+        message = "%s %r" % (message, args)
+        pass
+      pass
+    if data is not None:
+      try:
+        data = json.dumps(data, default=str)
+      except ValueError as exc:
+        # A circular reference. Not the writer's to die of.
+        data = json.dumps({"error": str(exc)})
+        pass
+      pass
+    return (row_id, self._timestamp(created), event_type, level, source, message, data)
+
+  def _drain(self) -> None:
+    rows = []
+    samples = []
+    # Only what's there now - anything coming in meanwhile waits for the
+    # next round.
+    for _ in range(len(self._ring)):
+      try:
+        table, row = self._ring.popleft()
+      except IndexError:
+        # log() dropped the oldest to make room.
+        break
+      if table == "event_log":
+        rows.append(self._format_row(row))
+      else:
+        samples.append(row[:1] + (self._timestamp(row[1]),) + row[2:])
+        pass
+      pass
+    if not rows and not samples:
       return
-    total = self._conn.execute("SELECT COUNT(*) FROM event_log").fetchone()[0]
-    if total == 0:
+    self._written += len(rows) + len(samples)
+    while rows:
+      if self._should_roll():
+        self._roll()
+        pass
+      live = self._segments[-1]
+      room = min(DRAIN_CHUNK_ROWS, max(1, self.segment_rows - live.rows))
+      batch, rows = rows[:room], rows[room:]
+      self._conn.executemany(
+        "INSERT INTO event_log (id, timestamp, type, level, source, message, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        batch)
+      self._conn.commit()
+      live.rows += len(batch)
+      pass
+    if samples:
+      self._conn.executemany(
+        "INSERT INTO progress_sample (run, timestamp, device, step, status, progress, elapse, run_time,"
+        " run_estimate, bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        samples)
+      self._conn.commit()
+      pass
+    self._prune_if_needed()
+    pass
+
+  def _prune_if_needed(self) -> None:
+    segments = self._segments
+    size = sum(segment.size for segment in segments[:-1]) + self._live_size_bytes()
+    dropped = []
+    while len(segments) > 1 and (size >= self.max_bytes * PRUNE_THRESHOLD or len(segments) > MAX_SEGMENTS):
+      size -= segments[0].size
+      dropped.append(segments[0])
+      segments = segments[1:]
+      pass
+    if not dropped:
       return
-    to_delete = max(1, total // 5)
-    # No VACUUM/wal_checkpoint(TRUNCATE) here - both need an exclusive lock
-    # and would stall concurrent /logs reads and the writer itself. Deleted
-    # pages go on sqlite's internal freelist and get reused by future
-    # inserts, which is all the size cap actually needs.
-    self._conn.execute(
-      "DELETE FROM event_log WHERE id IN (SELECT id FROM event_log ORDER BY id ASC LIMIT ?)",
-      (to_delete,))
-    self._conn.commit()
-    self._conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    with self._segments_lock:
+      self._segments = segments
+      pass
+    # A reader still in one of these keeps reading it - the files go away
+    # when it's done.
+    for segment in dropped:
+      self._remove_files(segment.path)
+      pass
     pass
 
+  def _segment_snapshot(self) -> list[_Segment]:
+    with self._segments_lock:
+      return self._segments
+
+  def _connect_reader(self, segment: _Segment) -> Optional[sqlite3.Connection]:
+    """Connection to a segment, or None when it has been dropped since.
+    mode=rw so that a dropped segment doesn't come back as an empty file."""
+    try:
+      conn = sqlite3.connect("file:%s?mode=rw" % urllib.parse.quote(segment.path), uri=True)
+    except sqlite3.OperationalError:
+      return None
+    self._configure_reader(conn)
+    conn.row_factory = sqlite3.Row
+    return conn
+
   @staticmethod
   def _in_clause(column: str, values: list) -> tuple[str, list]:
     placeholders = ", ".join(["?"] * len(values))
@@ -208,44 +620,65 @@ class LogStore:
   def query(self, start: int = 0, count: int = 100,
             event_types: Optional[list] = None, levels: Optional[list] = None,
             sources: Optional[list] = None, q: Optional[str] = None,
-            sort_desc: bool = True) -> tuple[list[dict[str, Any]], int]:
-    conn = sqlite3.connect(self.db_path)
-    try:
-      self._configure_reader(conn)
-      conn.row_factory = sqlite3.Row
-
-      where = []
-      params: list = []
-      if event_types:
-        clause, values = self._in_clause("type", [
-          t.value if isinstance(t, LogEventType) else str(t) for t in event_types])
-        where.append(clause)
-        params.extend(values)
-        pass
-      if levels:
-        clause, values = self._in_clause("level", list(levels))
-        where.append(clause)
-        params.extend(values)
-        pass
-      if sources:
-        clause, values = self._in_clause("source", list(sources))
-        where.append(clause)
-        params.extend(values)
-        pass
-      if q:
-        where.append("message LIKE ?")
-        params.append("%" + q + "%")
-        pass
-      where_clause = ("WHERE " + " AND ".join(where)) if where else ""
+            sort_desc: bool = True, cursor: Optional[int] = None) -> tuple[list[dict[str, Any]], int]:
+    """One page of rows, and how many rows match in all. cursor is the id
+    of the last row of the previous page: the page starts right after it,
+    found through the index instead of counting off `start` rows. start is
+    ignored when there is a cursor."""
+    where = []
+    params: list = []
+    if event_types:
+      clause, values = self._in_clause("type", [
+        t.value if isinstance(t, LogEventType) else str(t) for t in event_types])
+      where.append(clause)
+      params.extend(values)
+      pass
+    if levels:
+      clause, values = self._in_clause("level", list(levels))
+      where.append(clause)
+      params.extend(values)
+      pass
+    if sources:
+      clause, values = self._in_clause("source", list(sources))
+      where.append(clause)
+      params.extend(values)
+      pass
 
-      total = conn.execute("SELECT COUNT(*) FROM event_log " + where_clause, params).fetchone()[0]
-      cursor = conn.execute(
-        "SELECT id, timestamp, type, level, source, message, data FROM event_log "
-        + where_clause + " ORDER BY id " + ("DESC" if sort_desc else "ASC") + " LIMIT ? OFFSET ?",
-        params + [count, start])
+    segments = self._segment_snapshot()
+    counts = self._count(segments, where, params, q)
+    if cursor is not None:
+      start = 0
+      pass
 
-      results = []
-      for row in cursor.fetchall():
+    # Newest segment first for a descending page. `start` skips whole
+    # segments by their count, the rest of it is an OFFSET into one.
+    results = []
+    for segment in (reversed(segments) if sort_desc else segments):
+      if len(results) >= count:
+        break
+      if start and start >= counts.get(segment.seq, 0):
+        start -= counts.get(segment.seq, 0)
+        continue
+      tables, id_column, segment_where, segment_params = self._search(segment, where, params, q)
+      if cursor is not None:
+        segment_where = segment_where + [id_column + (" < ?" if sort_desc else " > ?")]
+        segment_params = segment_params + [cursor]
+        pass
+      where_clause = ("WHERE " + " AND ".join(segment_where)) if segment_where else ""
+      conn = self._connect_reader(segment)
+      if conn is None:
+        continue
+      try:
+        rows = conn.execute(
+          "SELECT event_log.id, event_log.timestamp, event_log.type, event_log.level, event_log.source, "
+          "event_log.message, event_log.data FROM " + tables + " "
+          + where_clause + " ORDER BY " + id_column + (" DESC" if sort_desc else " ASC") + " LIMIT ? OFFSET ?",
+          segment_params + [count - len(results), start]).fetchall()
+      finally:
+        conn.close()
+        pass
+      start = 0
+      for row in rows:
         entry = dict(row)
         if entry.get("data"):
           try:
@@ -255,23 +688,117 @@ class LogStore:
           pass
         results.append(entry)
         pass
-      return results, total
-    finally:
-      conn.close()
       pass
-    pass
+    return results, sum(counts.values())
+
+  @staticmethod
+  def _search(segment: _Segment, where: list, params: list,
+              q: Optional[str]) -> tuple[str, str, list, list]:
+    """FROM, the id column, WHERE and its parameters for the filter plus q,
+    in this segment."""
+    if not q:
+      return "event_log", "event_log.id", where, params
+    if segment.fts and len(q) >= FTS_MIN_QUERY:
+      # With a full-text search, the FTS table leads: it hands out matches
+      # in rowid order, so ORDER BY/LIMIT stop at a page's worth of them
+      # instead of collecting every match and sorting. CROSS JOIN keeps it
+      # that way - the planner likes to drive from a filter index and run
+      # the MATCH once per row. A quoted string is one phrase - with
+      # trigrams, a substring.
+      return ("event_log_fts CROSS JOIN event_log ON event_log.id = event_log_fts.rowid",
+              "event_log_fts.rowid",
+              where + ["event_log_fts MATCH ?"],
+              params + ['"' + q.replace('"', '""') + '"'])
+    return "event_log", "event_log.id", where + ["event_log.message LIKE ?"], params + ["%" + q + "%"]
+
+  def _count(self, segments: list[_Segment], where: list, params: list,
+             q: Optional[str]) -> dict[int, int]:
+    """COUNT(*) of the filter in each segment, without counting them all
+    on every page. A closed segment's count doesn't change, so it's
+    counted once. Rows only ever come in at the top of the live segment's
+    ids, so its count, remembered with the highest id it covered, is
+    brought up to date by counting the rows added since."""
+    key = (tuple(where), tuple(params), q)
+    with self._counts_lock:
+      cached = self._counts.get(key, {})
+      pass
+    counts = {}
+    remembered = {}
+    for segment in segments:
+      closed = segment.size is not None
+      total, since, was_closed = cached.get(segment.seq, (0, None, False))
+      if not was_closed:
+        conn = self._connect_reader(segment)
+        if conn is None:
+          continue
+        tables, id_column, segment_where, segment_params = self._search(segment, where, params, q)
+        try:
+          high = conn.execute("SELECT MAX(id) FROM event_log").fetchone()[0]
+          if high is not None and (since is None or since < high):
+            conditions = [id_column + " <= ?"]
+            values = [high]
+            if since is not None:
+              conditions.append(id_column + " > ?")
+              values.append(since)
+              pass
+            total += conn.execute(
+              "SELECT COUNT(*) FROM " + tables + " WHERE " + " AND ".join(segment_where + conditions),
+              segment_params + values).fetchone()[0]
+            since = high
+            pass
+        finally:
+          conn.close()
+          pass
+        pass
+      counts[segment.seq] = total
+      remembered[segment.seq] = (total, since, closed)
+      pass
+    with self._counts_lock:
+      self._counts[key] = remembered
+      self._counts.move_to_end(key)
+      while len(self._counts) > COUNT_CACHE_SIZE:
+        self._counts.popitem(last=False)
+        pass
+      pass
+    return counts
+
+  def progress_series(self, run: int) -> list[dict[str, Any]]:
+    """The progress samples of a run, oldest first."""
+    samples = []
+    for segment in self._segment_snapshot():
+      conn = self._connect_reader(segment)
+      if conn is None:
+        continue
+      try:
+        rows = conn.execute(
+          "SELECT timestamp, device, step, status, progress, elapse, run_time AS runTime,"
+          " run_estimate AS runEstimate, bytes FROM progress_sample WHERE run = ? ORDER BY id",
+          (run,)).fetchall()
+        samples.extend(dict(row) for row in rows)
+      except sqlite3.OperationalError:
+        # A segment from before there were progress samples.
+        pass
+      finally:
+        conn.close()
+        pass
+      pass
+    return samples
 
   def distinct_sources(self) -> list[str]:
-    conn = sqlite3.connect(self.db_path)
-    try:
-      self._configure_reader(conn)
-      rows = conn.execute(
-        "SELECT DISTINCT source FROM event_log WHERE source IS NOT NULL ORDER BY source").fetchall()
-      return [row[0] for row in rows]
-    finally:
-      conn.close()
+    sources = set()
+    for segment in self._segment_snapshot():
+      conn = self._connect_reader(segment)
+      if conn is None:
+        continue
+      try:
+        rows = conn.execute(
+          "SELECT DISTINCT source FROM event_log WHERE source IS NOT NULL").fetchall()
+        sources.update(row[0] for row in rows)
+      finally:
+        conn.close()
+        pass
       pass
-    pass
+    return sorted(sources)
   pass
 
 
@@ -291,18 +818,97 @@ def get_log_store() -> LogStore:
   return _log_store_
 
 
+class _Run:
+  def __init__(self, run: int):
+    self.run = run
+    self.status = None
+    self.sampled_at = 0.0
+    pass
+  pass
+
+
+class ProgressRecorder:
+  """Keeps runners' progress reports (OperationProgress dumps, as
+  TriageServer.send_to_ui() gets them) in the LogStore. The plan goes into
+  event_log once per run, as its PLAN row - the row's id is the run from
+  then on. The ticks after it become progress samples: one row per running
+  step, every `interval` seconds, of typed columns instead of the whole
+  task list as JSON. A step or the run changing state is sampled right away
+  and gets a short PROGRESS row in event_log too."""
+
+  def __init__(self, interval: float = PROGRESS_SAMPLE_INTERVAL, store: Optional[LogStore] = None):
+    self.interval = interval
+    self._store = store
+    # event -> the run going on
+    self.runs: dict[str, _Run] = {}
+    pass
+
+  @property
+  def store(self) -> LogStore:
+    return self._store if self._store is not None else get_log_store()
+
+  def record(self, event: str, message: dict) -> None:
+    report = message.get("report")
+    if report == "tasks":
+      self.runs[event] = _Run(self.store.log(LogEventType.PLAN, event, source=event, data=message))
+      return
+    run = self.runs.get(event)
+    if run is None:
+      # No plan seen (a run older than this server) - nothing to tie the
+      # samples to.
+      self.store.log(LogEventType.PROGRESS, event, source=event, data=message)
+      return
+
+    status = message.get("runStatus")
+    changed_step = message.get("step") if report in ("task_success", "task_failure") else None
+    changed = changed_step is not None or status != run.status
+    run.status = status
+    if changed:
+      self.store.log(LogEventType.PROGRESS, "%s: %s" % (event, message.get("runMessage", "")), source=event,
+                     data={"run": run.run, "report": report, "step": changed_step, "runStatus": status})
+      pass
+    now = time.monotonic()
+    if not changed and now - run.sampled_at < self.interval:
+      return
+    run.sampled_at = now
+    for task in message.get("tasks", []):
+      if task.get("taskStatus") != "running" and task.get("step") != changed_step:
+        continue
+      self.store.log_progress(run.run, message.get("device"), task.get("step"), task.get("taskStatus"),
+                              task.get("taskProgress"), task.get("taskElapse"), message.get("runTime"),
+                              message.get("runEstimate"), task.get("taskBytes"))
+      pass
+    pass
+  pass
+
+
+_IMMUTABLE_ARGS = (str, bytes, int, float, bool, type(None))
+
+
 class SQLiteLogHandler(logging.Handler):
   """logging.Handler that routes records into the LogStore as LogEventType.LOG
   rows instead of a text file."""
 
   def emit(self, record: logging.LogRecord) -> None:
     try:
+      # msg % args is left to the writer when nothing in args can change
+      # in the meantime.
+      args = record.args
+      if isinstance(record.msg, str) and (not args or (
+          isinstance(args, tuple) and all(isinstance(arg, _IMMUTABLE_ARGS) for arg in args))):
+        message = record.msg
+      else:
+        message = record.getMessage()
+        args = None
+        pass
       get_log_store().log(
         LogEventType.LOG,
-        record.getMessage(),
+        message,
         level=record.levelname,
         source=record.name,
-        data={"processName": record.processName, "threadName": record.threadName})
+        data={"processName": record.processName, "threadName": record.threadName},
+        args=args or None,
+        created=record.created)
     except Exception:
       self.handleError(record)
       pass
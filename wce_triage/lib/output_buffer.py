@@ -0,0 +1,93 @@
+"""
+Bounded, line by line buffer for a subprocess's stdout/stderr.
+
+op_task_process used to keep everything a process printed in one string,
+growing it with every read - quadratic for a chatty process, and without a
+limit for a long fsck or rsync. This keeps the first head_lines lines (what
+went wrong usually shows up first) and the last lines up to max_bytes, and
+only counts what falls in between. The head is held to max_bytes as well,
+and so is any one line.
+"""
+from collections import deque
+
+OUTPUT_HEAD_LINES = 200
+OUTPUT_MAX_BYTES = 2 ** 20
+
+
+class OutputBuffer:
+  def __init__(self, head_lines=OUTPUT_HEAD_LINES, max_bytes=OUTPUT_MAX_BYTES):
+    self.head_lines = head_lines
+    self.max_bytes = max_bytes
+    self.head = []
+    self.head_bytes = 0
+    self.tail = deque()
+    self.tail_bytes = 0
+    # Lines dropped between the head and the tail
+    self.dropped = 0
+    # Unterminated last line
+    self.fragment = ""
+    pass
+
+  def __len__(self):
+    return len(self.head) + len(self.tail) + (1 if self.fragment else 0)
+
+  def feed(self, data):
+    if not data:
+      return
+    pieces = (self.fragment + data).split("\n")
+    self.fragment = pieces.pop()
+    for line in pieces:
+      self._add_line(line)
+      pass
+    if len(self.fragment) > self.max_bytes:
+      # Something that never prints a newline. Only its latest output counts.
+      self.fragment = self.fragment[-self.max_bytes:]
+      pass
+    pass
+
+  def _add_line(self, line):
+    if len(line) >= self.max_bytes:
+      # Like the fragment, only its latest output counts - as much of it as
+      # fits in max_bytes with its newline.
+      line = line[len(line) - self.max_bytes + 1:]
+      pass
+    # Once a line has gone to the tail, the head is done.
+    if (not self.tail and len(self.head) < self.head_lines
+        and self.head_bytes + len(line) + 1 <= self.max_bytes):
+      self.head.append(line)
+      self.head_bytes += len(line) + 1
+      return
+    self.tail.append(line)
+    self.tail_bytes += len(line) + 1
+    while self.tail_bytes > self.max_bytes and len(self.tail) > 1:
+      self.tail_bytes -= len(self.tail.popleft()) + 1
+      self.dropped += 1
+      pass
+    pass
+
+  def take_lines(self):
+    """Returns the complete lines (without the newline) and forgets them, for
+    a task that parses the output as it comes in. The fragment stays until
+    its newline arrives."""
+    lines = self.head + list(self.tail)
+    self.head = []
+    self.head_bytes = 0
+    self.tail.clear()
+    self.tail_bytes = 0
+    self.dropped = 0
+    return lines
+
+  def text(self):
+    """Everything kept, as one string."""
+    lines = self.head
+    if self.dropped:
+      lines = lines + ["[... %d lines dropped ...]" % self.dropped]
+      pass
+    lines = lines + list(self.tail)
+    text = "\n".join(lines)
+    if lines:
+      text = text + "\n"
+      pass
+    return text + self.fragment
+
+  pass
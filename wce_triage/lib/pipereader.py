@@ -1,19 +1,29 @@
 """
 pipe reader utility. reads stream from pipe and buffer data.
+
+Reads whatever the pipe has, up to CHUNK_SIZE, with one os.read() and splits
+it into lines at \\r and \\n. os.read() on a pipe returns as soon as anything
+is there, so a \\r-terminated progress line comes out as soon as its \\r
+arrives - the same as the old byte at a time read, minus a syscall per byte.
 """
 from collections import deque
-import subprocess, sys
+import os, subprocess, sys
 from ..lib.util import get_triage_logger
 
 
 tlog = get_triage_logger()
 
+CHUNK_SIZE = 2 ** 16
+
 class PipeReader:
   def __init__(self, pipe, tag=None, encoding='iso-8859-1'):
     self.encoding = encoding
     self.alive = True
     self.pipe = pipe
-    self.fragments = deque()
+    self.fd = pipe if isinstance(pipe, int) else pipe.fileno()
+    # Complete lines read ahead, and the unterminated tail of the last read.
+    self.lines = deque()
+    self.fragment = b''
     self.tag = tag
     pass
 
@@ -21,32 +31,48 @@ class PipeReader:
     return self.pipe if self.alive else None
 
   def readline(self):
+    '''Returns a line ending with \\n, None when no complete line came in
+    yet, or b'' once the pipe is closed and everything is read.'''
+    if self.lines:
+      return self.lines.popleft()
+
     if not self.alive:
       return b''
 
-    # it's painful to read one at a time but any other way seems to block.
-    ch = self.pipe.read(1) # oh so C
-    if ch == b'':
+    self._read()
+    return self.lines.popleft() if self.lines else None
+
+  def readlines(self):
+    '''Reads once and returns every complete line, for a caller that
+    selects on fd - the read doesn't block when the fd is readable. Once
+    the pipe is closed, the last one is the flushed fragment and alive
+    is False.'''
+    if self.alive:
+      self._read()
+      pass
+    lines = list(self.lines)
+    self.lines.clear()
+    return lines
+
+  def _read(self):
+    chunk = os.read(self.fd, CHUNK_SIZE)
+    if chunk == b'':
       # Pipe is closed.
       self.alive = False
-      return self._flush_fragments()
-    else:
-      if ch in [ b'\n', b'\r']:
-        return self._flush_fragments()
-      else:
-        self.fragments.append(ch)
-        return None
+      self.lines.append(self._flush_fragments())
+      return
+
+    pieces = (self.fragment + chunk).replace(b'\r', b'\n').split(b'\n')
+    self.fragment = pieces.pop()
+    for piece in pieces:
+      self.lines.append(piece.decode(self.encoding) + '\n')
       pass
     pass
 
   def _flush_fragments(self):
-    buffer = bytearray(len(self.fragments)+1)
-    for i in range(len(self.fragments)):
-      buffer[i] = ord(self.fragments[i])
-      pass
-    buffer[len(self.fragments)] = ord(b'\n')
-    self.fragments.clear()
-    return buffer.decode(self.encoding)
+    line = self.fragment.decode(self.encoding) + '\n'
+    self.fragment = b''
+    return line
 
   def flush(self):
     return self._flush_fragments()
@@ -66,4 +92,4 @@ if __name__ == "__main__":
       sys.stdout.write(chunk)
       pass
     pass
-  pass
\ No newline at end of file
+  pass
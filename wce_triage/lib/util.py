@@ -121,8 +121,16 @@ def find_disk_device_files(devpath):
 decomps = { ".7z":  ( [ "7z", "e", "-so" ], None ),
             ".xz":  ( [ "unxz" ], ["-c"] ),
             ".lzo": ( [ "lzop", "-d"], ["-c"] ),
+            # --long=31 only lifts the window size limit for images made with a bigger --long.
+            ".zst": ( [ "zstd", "-d", "-q", "--long=31" ], ["-c"] ),
             ".gz":  ( [ "gunzip" ], ["-c"] ) }
 
+#
+# Faster drop-in decompressors, used when they are installed.
+# pigz decodes with separate read/write/check threads.
+#
+fast_decomps = { ".gz": ( [ "pigz", "-d" ], ["-c"] ) }
+
 def get_file_decompression_app(path):
   ext = ""
   try:
@@ -137,9 +145,22 @@ def get_file_decompression_app(path):
 # it takes so much longer. You can convert the compressor
 # if there is a good reason (hence, the decomp takes more
 # options but for compression from here, gzip/pigz is it.
-
-def get_file_compression_app(path):
-  return ( ["pigz", "-7" ], [] )
+#
+# Except zstd - it decompresses a lot faster than gzip, which is what
+# counts for an image restored over and over. The level and the window
+# (--long, log2 of bytes) come from the image catalog.
+
+def get_file_compression_app(path, level=None, long_window=None):
+  if path.endswith(".zst"):
+    argv = ["zstd", "-q", "-T0", "-%d" % (level if level else 15)]
+    if level and level > 19:
+      argv.append("--ultra")
+      pass
+    if long_window:
+      argv.append("--long=%d" % long_window)
+      pass
+    return ( argv, ["-c"] )
+  return ( ["pigz", "-%d" % (level if level else 7) ], [] )
 
 #
 #
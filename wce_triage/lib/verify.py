@@ -0,0 +1,58 @@
+#
+# Verify-after-write helpers for the copy tools (fanout_copy, binarycopy)
+#
+# The source is hashed once, by whoever reads it, while it's being copied.
+# Each destination is then read back and hashed on its own, and the two
+# digests are compared.
+#
+import hashlib
+import os
+
+DIGEST_SIZE = 32
+
+
+def new_hash():
+  """Streaming hash used for verification. BLAKE2b is faster than SHA-256
+  on the 64-bit machines we triage, and hashlib drops the GIL while it
+  hashes a big buffer, so it overlaps with the other threads' I/O."""
+  return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def drop_cached_pages(fd):
+  """Flushes fd and drops its pages from the page cache, so reading it back
+  gets what's on the device and not what we just wrote."""
+  os.fsync(fd)
+  if hasattr(os, "posix_fadvise"):
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    pass
+  pass
+
+
+def readback_digest(path, length, buffer_size=2**22, progress=None, extents=None):
+  """Hashes the first length bytes of path. A disk is usually bigger than
+  what was written to it, so only length bytes count.
+  progress: called with the number of bytes hashed so far.
+  extents: (offset, length) pieces to hash instead, for a sparse copy."""
+  hasher = new_hash()
+  buffer = bytearray(buffer_size)
+  view = memoryview(buffer)
+  done = 0
+  with open(path, "rb", buffering=0) as readback:
+    for offset, extent_length in (extents if extents is not None else [(0, length)]):
+      readback.seek(offset)
+      remaining = extent_length
+      while remaining > 0:
+        nread = readback.readinto(view[:min(buffer_size, remaining)])
+        if not nread:
+          raise IOError("%s is shorter than %d bytes." % (path, offset + extent_length))
+        hasher.update(view[:nread])
+        remaining -= nread
+        done += nread
+        if progress:
+          progress(done)
+          pass
+        pass
+      pass
+    pass
+  view.release()
+  return hasher.digest()
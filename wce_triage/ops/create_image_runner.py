@@ -11,7 +11,7 @@ from .tasks import (task_fetch_partitions, task_refresh_partitions, task_mount,
 from .partclone_tasks import task_create_disk_image
 from ..components.disk import create_storage_instance
 from .runner import Runner
-from ..lib.disk_images import make_disk_image_name
+from ..lib.disk_images import make_disk_image_name, read_disk_image_type, get_image_compression
 from .json_ui import json_ui
 from ..lib.util import get_triage_logger, is_block_device
 
@@ -40,6 +40,7 @@ For now, this is only dealing with the EXT4 linux partition.
     self.destdir = destdir
 
     self.imagename = make_disk_image_name(destdir, suggestedname)
+    self.compression = get_image_compression(read_disk_image_type(destdir))
     pass
 
 
@@ -59,7 +60,7 @@ For now, this is only dealing with the EXT4 linux partition.
     self.tasks.append(task)
     self.tasks.append(task_fsck("fsck partition", disk=self.disk, partition_id=self.partition_id, fix_file_system=True))
     self.tasks.append(task_shrink_partition("Shrink partition to smallest", disk=self.disk, partition_id=self.partition_id))
-    self.tasks.append(task_create_disk_image("Create disk image", disk=self.disk, partition_id=self.partition_id, imagename=self.imagename))
+    self.tasks.append(task_create_disk_image("Create disk image", disk=self.disk, partition_id=self.partition_id, imagename=self.imagename, compression=self.compression))
 
     task = task_expand_partition("Expand the partition back", disk=self.disk, partition_id=self.partition_id)
     task.set_teardown_task()
@@ -4,7 +4,7 @@
 import sys
 import json
 import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 from .run_state import RunState
 from .protocol import OperationProgress, OperationEnvelope, TaskStatus
 from .tasks import op_task
@@ -36,7 +36,8 @@ def _describe_task(task, current_time: datetime.datetime) -> TaskStatus:
     taskStatus=TASK_STATUS[task_state],
     taskMessage=task.message,
     taskExplain=task.explain(),
-    taskVerdict=task.verdict if task_state > 1 and task.verdict else [])
+    taskVerdict=task.verdict if task_state > 1 and task.verdict else [],
+    taskBytes=task.bytes_done)
 
 
 def _describe_tasks(tasks: List[op_task], current_time: datetime.datetime) -> List[TaskStatus]:
@@ -55,15 +56,42 @@ def _describe_tasks(tasks: List[op_task], current_time: datetime.datetime) -> Li
   return result
 
 
+def _task_state(task, current_time: datetime.datetime) -> tuple:
+  """What the task's TaskStatus would show, without building it (explain()
+  and all). A running task's elapsed time changes on every report."""
+  task_state = task._get_status()
+  if task_state == 1:
+    return (task_state, current_time)
+  return (task_state, task.progress, task.message, len(task.verdict), task.time_estimate, task.get_description())
+
+
 class json_ui(object):
   wock_event: str
   message_catalog: Optional[dict]
+  delta: bool
 
-  def __init__(self, wock_event: str = "loadimage", message_catalog: Optional[dict] = None):
+  def __init__(self, wock_event: str = "loadimage", message_catalog: Optional[dict] = None, delta: bool = True):
     self.wock_event = wock_event
     self.message_catalog = message_catalog
+    # After the plan, send only the steps that changed. See protocol.merge_progress.
+    self.delta = delta
+    # step -> _task_state() as last reported
+    self._reported: Dict[int, tuple] = {}
     pass
 
+  def _describe_changed_tasks(self, tasks: List[op_task], current_time: datetime.datetime) -> List[TaskStatus]:
+    if not self.delta:
+      return _describe_tasks(tasks, current_time)
+    changed = []
+    for task in tasks:
+      state = _task_state(task, current_time)
+      if self._reported.get(task.task_number) != state:
+        self._reported[task.task_number] = state
+        changed.append(task)
+        pass
+      pass
+    return _describe_tasks(changed, current_time)
+
   def send(self, event: str, obj: OperationProgress | dict) -> None:
     if isinstance(obj, OperationProgress):
       jata = OperationEnvelope(event=event, message=obj).model_dump_json(exclude_none=True)
@@ -86,6 +114,7 @@ class json_ui(object):
       runEstimate=round(in_seconds(run_estimate)),
       runTime=0,
       tasks=_describe_tasks(tasks, current_time)))
+    self._reported = {task.task_number: _task_state(task, current_time) for task in tasks}
     pass
 
   #
@@ -102,7 +131,8 @@ class json_ui(object):
       runEstimate=round(run_estimate),
       runTime=round(in_seconds(run_time)),
       step=task.task_number,
-      tasks=_describe_tasks(tasks, current_time)))
+      tasks=self._describe_changed_tasks(tasks, current_time),
+      delta=self.delta))
     pass
 
 
@@ -116,7 +146,8 @@ class json_ui(object):
       runStatus=RunState.Failed,
       runTime=round(in_seconds(run_time)),
       step=task.task_number,
-      tasks=_describe_tasks(tasks, current_time)))
+      tasks=self._describe_changed_tasks(tasks, current_time),
+      delta=self.delta))
     pass
 
   def report_task_success(self, runner_id: str, current_time: datetime.datetime,
@@ -129,7 +160,8 @@ class json_ui(object):
       runStatus=RunState.Running,
       runTime=round(in_seconds(run_time)),
       step=task.task_number,
-      tasks=_describe_tasks(tasks, current_time)))
+      tasks=self._describe_changed_tasks(tasks, current_time),
+      delta=self.delta))
     pass
 
 
@@ -170,7 +202,8 @@ tasks: array of tasks
       runMessage=status_message,
       runEstimate=round(in_seconds(run_estimate), 1),
       runTime=round(in_seconds(run_time), 1),
-      tasks=_describe_tasks(tasks, current_time)))
+      tasks=self._describe_changed_tasks(tasks, current_time),
+      delta=self.delta))
     pass
 
   def log(self, runner_id: str, msg: str) -> None:
@@ -12,7 +12,7 @@ import datetime, re
 import sys
 
 from .tasks import op_task_process
-from .protocol import DriverEvent, DriverEventType, split_lines
+from .protocol import DriverEventType, driver_framing_requested, DRIVER_PARTIAL_FAILURE
 from ..lib.timeutil import in_seconds
 from ..lib.util import get_triage_logger
 from ..lib.disk_images import get_file_system_from_source
@@ -35,6 +35,7 @@ class task_partclone(op_task_process):
     #
     kwargs['progress_running'] = None
     super().__init__(description, **kwargs)
+    self.driver_framing = driver_framing_requested()
 
     self.start_re = []
     # If we don't skip the superblock part, the progress is totally messed up
@@ -58,21 +59,13 @@ class task_partclone(op_task_process):
 
   def parse_partclone_progress(self):
     #
-    # Check the progress. driver prints everything to stderr, as DriverEvent NDJSON.
+    # Check the progress. driver prints everything to stderr, as DriverEvents.
     #
-    if len(self.err) == 0:
-      return
-
-    lines, self.err = split_lines(self.err)
-    for raw_line in lines:
-      if not raw_line:
+    for line, event in self.take_driver_events():
+      if event is None:
         continue
       current_time = datetime.datetime.now()
 
-      try:
-        event = DriverEvent.model_validate_json(raw_line)
-      except Exception:
-        continue
 
       # Other processes in the pipeline (wget, decompressor) are not partclone's own progress.
       if event.proc != "partclone":
@@ -136,13 +129,15 @@ class task_partclone(op_task_process):
 #
 class task_create_disk_image(task_partclone):
   
-  def __init__(self, description, disk=None, partition_id="Linux", imagename=None, partition_size=None, **kwargs):
+  def __init__(self, description, disk=None, partition_id="Linux", imagename=None, partition_size=None, compression=None, **kwargs):
     # FIXME: This time_estimate is so wrong in so many levels.
     super().__init__(description, time_estimate=disk.get_byte_size() / 500000000, **kwargs)
     self.disk = disk
     self.partition_id = partition_id
     self.imagename = imagename
     self.partition_size = partition_size
+    # From lib.disk_images.get_image_compression() - the codec itself goes by the imagename.
+    self.compression = compression if compression else {}
     pass
 
   # 
@@ -157,7 +152,14 @@ class task_create_disk_image(task_partclone):
       return
 
     # Unlike others, image_volume outputs progress to stderr.
-    self.argv = [sys.executable, "-m", "wce_triage.bin.image_volume", part.device_name, part.file_system, self.imagename ]
+    self.argv = [sys.executable, "-m", "wce_triage.bin.image_volume"]
+    if self.compression.get("level"):
+      self.argv += ["-l", str(self.compression["level"])]
+      pass
+    if self.compression.get("long"):
+      self.argv += ["-w", str(self.compression["long"])]
+      pass
+    self.argv += [part.device_name, part.file_system, self.imagename]
     super().setup()
     pass
 
@@ -170,7 +172,7 @@ class task_create_disk_image(task_partclone):
 class task_restore_disk_image(task_partclone):
   
   # Restore partclone image file to the first partition
-  def __init__(self, description, disk=None, partition_id="Linux", source=None, source_size=None, **kwargs):
+  def __init__(self, description, disk=None, partition_id="Linux", source=None, source_size=None, engine=None, **kwargs):
     #
     speed = disk.estimate_speed(operation="restore")
     self.initial_time_estimate=2*source_size/speed
@@ -179,6 +181,8 @@ class task_restore_disk_image(task_partclone):
     self.partition_id = partition_id
     self.source = source
     self.source_size = source_size
+    # restore_volume engine - "inprocess" or "pipeline" (default)
+    self.engine = engine
     if self.source is None:
       raise Exception("bone head. it needs the source image.")
     self.percent_done = None
@@ -188,7 +192,11 @@ class task_restore_disk_image(task_partclone):
     part = self.disk.find_partition(self.partition_id)
     if part is None:
       raise Exception("Partition %s is not found." % self.partition_id)
-    self.argv = [sys.executable, "-m", "wce_triage.bin.restore_volume", self.source, get_file_system_from_source(self.source), part.device_name]
+    self.argv = [sys.executable, "-m", "wce_triage.bin.restore_volume"]
+    if self.engine:
+      self.argv += ["-e", self.engine]
+      pass
+    self.argv += [self.source, get_file_system_from_source(self.source), part.device_name]
     super().setup()
     pass
 
@@ -198,21 +206,13 @@ class task_restore_disk_image(task_partclone):
   # ignore parsing partclone progress. for restore, it is 100$ wrong.
   def parse_partclone_progress(self):
     #
-    # Check the progress. driver prints everything to stderr, as DriverEvent NDJSON.
+    # Check the progress. driver prints everything to stderr, as DriverEvents.
     #
-    if len(self.err) == 0:
-      return
-
-    lines, self.err = split_lines(self.err)
-    for raw_line in lines:
-      if not raw_line:
+    for line, event in self.take_driver_events():
+      if event is None:
         continue
       current_time = datetime.datetime.now()
 
-      try:
-        event = DriverEvent.model_validate_json(raw_line)
-      except Exception:
-        continue
 
       if event.proc != "partclone":
         continue
@@ -280,3 +280,106 @@ class task_restore_disk_image(task_partclone):
     pass
 
   pass
+
+#
+#
+class task_restore_disk_images(op_task_process):
+  """Restores one image to the same partition of several disks at once.
+restore_volume fetches and decompresses the image once and tees it into a
+partclone per disk. A disk failing doesn't fail the task, unless every one
+of them does - failed_disks() tells which ones did.
+"""
+
+  def __init__(self, description, targets=None, source=None, source_size=None, **kwargs):
+    # targets: list of (disk, partition_id)
+    self.targets = targets if targets else []
+    if not self.targets:
+      raise Exception("No disk to restore to.")
+    # The stream goes as fast as the slowest disk.
+    speed = min([disk.estimate_speed(operation="restore") for disk, partition_id in self.targets])
+    kwargs['progress_running'] = None
+    super().__init__(description, time_estimate=2*source_size/speed, **kwargs)
+    self.driver_framing = driver_framing_requested()
+    self.source = source
+    self.source_size = source_size
+    if self.source is None:
+      raise Exception("bone head. it needs the source image.")
+    self.good_returncode = [0, DRIVER_PARTIAL_FAILURE]
+    # partition device name -> disk
+    self.devices = {}
+    self.device_progress = {}
+    self.device_returncode = {}
+    pass
+
+  def setup(self):
+    for disk, partition_id in self.targets:
+      part = disk.find_partition(partition_id)
+      if part is None:
+        raise Exception("Partition %s is not found on %s." % (partition_id, disk.device_name))
+      self.devices[part.device_name] = disk
+      self.device_progress[part.device_name] = 0
+      pass
+    self.argv = [sys.executable, "-m", "wce_triage.bin.restore_volume", "-e", "inprocess",
+                 self.source, get_file_system_from_source(self.source)] + list(self.devices.keys())
+    super().setup()
+    pass
+
+  def explain(self):
+    return "Restore disk image from %s to %s" % (self.source, ", ".join([disk.device_name for disk, partition_id in self.targets]))
+
+  def failed_disks(self):
+    return [self.devices[device] for device, returncode in self.device_returncode.items() if returncode != 0]
+
+  def poll(self):
+    super().poll()
+    self.parse_partclone_progress()
+    pass
+
+  def parse_partclone_progress(self):
+    events = self.take_driver_events()
+    if not events:
+      return
+
+    for line, event in events:
+      if event is None:
+        continue
+
+      # One partclone per device, named "partclone:<device>".
+      if not event.proc.startswith("partclone:"):
+        if event.type == DriverEventType.error and event.line:
+          self.verdict.append("%s: %s" % (event.proc, event.line.strip()))
+          pass
+        continue
+      device = event.proc[len("partclone:"):]
+
+      if event.type == DriverEventType.exit:
+        self.device_returncode[device] = event.returncode
+        if event.returncode != 0:
+          self.verdict.append("%s: restore failed with return code %s" % (device, str(event.returncode)))
+          pass
+        continue
+
+      if event.type == DriverEventType.error:
+        if event.line:
+          self.verdict.append("%s: %s" % (device, event.line.strip()))
+          pass
+        continue
+
+      if event.type != DriverEventType.line:
+        continue
+
+      m = task_partclone.progress1_re.search(event.line or "")
+      if m:
+        self.device_progress[device] = min(float(m.group(3)), 99)
+        pass
+      pass
+
+    if self.process.returncode is None:
+      running = [progress for device, progress in self.device_progress.items() if device not in self.device_returncode]
+      if running:
+        slowest = min(running)
+        self.set_progress(max(1, round(slowest)), "%d%% done on %d disks" % (slowest, len(running)))
+        pass
+      pass
+    pass
+  pass
@@ -13,15 +13,19 @@
 #   curl). The subprocess's own textual progress output is carried verbatim
 #   in `line` - we don't parse partclone/rsync's own format here, only frame
 #   it so the consumer doesn't have to regex a "name: proc.stream:text" prefix.
+#   NDJSON by default. A task that asks for it gets them as length-prefixed
+#   struct frames instead (see DRIVER_FRAMING_ENV).
 #
 from __future__ import annotations
 
 import datetime
+import os
+import struct
 import sys
 from enum import Enum
-from typing import List, Literal, Optional, TextIO, Tuple
+from typing import Dict, List, Literal, NamedTuple, Optional, TextIO, Tuple, Type, TypeVar
 
-from pydantic import BaseModel, ConfigDict
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
 
 from .run_state import RunState
 
@@ -40,6 +44,46 @@ def split_lines(buffer: str) -> Tuple[List[str], str]:
   return lines[:-1], lines[-1]
 
 
+Model = TypeVar("Model", bound=BaseModel)
+_list_adapters: Dict[type, TypeAdapter] = {}
+
+
+def parse_lines(model: Type[Model], lines: List[str]) -> List[Optional[Model]]:
+  """Parses NDJSON lines as model, all the lines a consumer took off its
+  process output in one go. Returns one entry per line, None where the line
+  is blank or isn't a model.
+
+  All of the lines go through pydantic in one validate_json() call, which
+  costs noticeably less per line than a call per line. Only a batch with
+  something else mixed in (a traceback, a synthetic line) is redone line
+  by line."""
+  if not lines:
+    return []
+  adapter = _list_adapters.get(model)
+  if adapter is None:
+    adapter = _list_adapters[model] = TypeAdapter(List[model])
+    pass
+  if all(line.strip() for line in lines):
+    try:
+      parsed = adapter.validate_json("[" + ",".join(lines) + "]")
+      # A line holding two objects would shift the rest.
+      if len(parsed) == len(lines):
+        return parsed
+      pass
+    except ValueError:
+      pass
+    pass
+  parsed = []
+  for line in lines:
+    try:
+      parsed.append(model.model_validate_json(line) if line else None)
+    except ValidationError:
+      parsed.append(None)
+      pass
+    pass
+  return parsed
+
+
 #
 # Progress reports for copy/wipe style tools (fanout_copy, multiwipe, binarycopy)
 #
@@ -57,6 +101,7 @@ class ProgressReport(BaseModel):
   writtenSectors: Optional[int] = None
   remainingSectors: Optional[int] = None
   destination: Optional[str] = None
+  phase: Optional[str] = None              # tool specific, e.g. multiwipe's "write" then "sync"
   startTime: Optional[datetime.datetime] = None
   currentTime: Optional[datetime.datetime] = None
   verdict: Optional[str] = None
@@ -110,12 +155,162 @@ class DriverEvent(BaseModel):
   pass
 
 
+# process_driver's own exit code when some of its independent processes
+# (e.g. one partclone per target disk) failed but not all of them. Each
+# one's "exit" DriverEvent tells which.
+DRIVER_PARTIAL_FAILURE = 2
+
+
+#
+# DriverEvents as length-prefixed struct frames - the alternative to NDJSON,
+# for a long sync or restore where pydantic's parsing and serializing of
+# every progress line adds up. Set WCE_DRIVER_FRAMING=struct in the
+# server's environment to use them. A task that reads DriverEvents
+# (op_task_process.driver_framing) passes it on to its process_driver;
+# every other child has it taken out of its environment, and process_driver
+# writes NDJSON unless it's there.
+#
+# A frame is FRAME_MARK, the header, then proc, stream and line in UTF-8.
+# The header holds the event type, which of the optional fields are there,
+# pid, returncode and the lengths of line, proc and stream. Anything else on
+# the stream, like a traceback, is passed through as text.
+#
+DRIVER_FRAMING_ENV = "WCE_DRIVER_FRAMING"
+DRIVER_FRAMING_STRUCT = "struct"
+FRAME_MARK = b"\x1e"
+_FRAME_MARK_BYTE = FRAME_MARK[0]
+
+_frame_header = struct.Struct("!cBBiiIHH")
+# The lengths of proc and stream, then proc and stream themselves.
+_NAMES_AT = _frame_header.size - 4
+_event_types = list(DriverEventType)
+_event_type_codes = {event_type: code for code, event_type in enumerate(_event_types)}
+_HAS_PID = 1
+_HAS_RETURNCODE = 2
+_HAS_STREAM = 4
+_HAS_LINE = 8
+
+
+def driver_framing_requested() -> bool:
+  return os.environ.get(DRIVER_FRAMING_ENV) == DRIVER_FRAMING_STRUCT
+
+
+def encode_driver_frame(event_type: DriverEventType, proc: str, stream: Optional[str] = None,
+                        pid: Optional[int] = None, line: Optional[str] = None,
+                        returncode: Optional[int] = None) -> bytes:
+  """One DriverEvent as a frame, straight from its fields - no model needed."""
+  flags = 0
+  if pid is not None:
+    flags |= _HAS_PID
+    pass
+  if returncode is not None:
+    flags |= _HAS_RETURNCODE
+    pass
+  proc_bytes = proc.encode("utf-8")
+  stream_bytes = b""
+  if stream is not None:
+    flags |= _HAS_STREAM
+    stream_bytes = stream.encode("utf-8")
+    pass
+  line_bytes = b""
+  if line is not None:
+    flags |= _HAS_LINE
+    line_bytes = line.encode("utf-8", errors="replace")
+    pass
+  return _frame_header.pack(FRAME_MARK, _event_type_codes[event_type], flags, pid or 0, returncode or 0,
+                            len(line_bytes), len(proc_bytes), len(stream_bytes)) + proc_bytes + stream_bytes + line_bytes
+
+
+class FramedDriverEvent(NamedTuple):
+  """A DriverEvent as it comes out of a frame - the same fields, read the
+  same way, but no pydantic model. Building one of those, even with
+  model_construct(), costs more than the rest of decoding the frame."""
+  type: DriverEventType
+  proc: str
+  stream: Optional[str]
+  pid: Optional[int]
+  line: Optional[str]
+  returncode: Optional[int]
+  pass
+
+
+class DriverFrameDecoder:
+  """Takes the frames out of a process's stderr as it's read."""
+
+  def __init__(self):
+    self._pending = b""
+    self._events: List[FramedDriverEvent] = []
+    # (proc, stream) by their lengths and bytes - a process_driver has a few
+    # of them, over and over.
+    self._names: Dict[bytes, Tuple[str, Optional[str]]] = {}
+    pass
+
+  def feed(self, data: bytes) -> bytes:
+    """Returns the rest of data, the text that isn't frames. A frame cut off
+    at the end waits for the next read."""
+    buffer = self._pending + data if self._pending else data
+    text = []
+    pos = 0
+    end = len(buffer)
+    header_size = _frame_header.size
+    unpack_from = _frame_header.unpack_from
+    names = self._names
+    append = self._events.append
+    while pos < end:
+      if buffer[pos] != _FRAME_MARK_BYTE:
+        mark = buffer.find(FRAME_MARK, pos + 1)
+        text_end = end if mark < 0 else mark
+        text.append(buffer[pos:text_end])
+        pos = text_end
+        continue
+      if end - pos < header_size:
+        break
+      _, code, flags, pid, returncode, line_len, proc_len, stream_len = unpack_from(buffer, pos)
+      if code >= len(_event_types):
+        # Not a frame after all.
+        text.append(FRAME_MARK)
+        pos += 1
+        continue
+      line_start = pos + header_size + proc_len + stream_len
+      frame_end = line_start + line_len
+      if frame_end > end:
+        break
+      raw_names = buffer[pos + _NAMES_AT:line_start]
+      proc, stream = names.get(raw_names) or self._decode_names(raw_names, proc_len, flags & _HAS_STREAM)
+      line = buffer[line_start:frame_end].decode("utf-8", "replace") if flags & _HAS_LINE else None
+      append(FramedDriverEvent(
+        _event_types[code], proc, stream,
+        pid if flags & _HAS_PID else None,
+        line,
+        returncode if flags & _HAS_RETURNCODE else None))
+      pos = frame_end
+      pass
+    self._pending = buffer[pos:]
+    return b"".join(text)
+
+  def _decode_names(self, raw_names: bytes, proc_len: int, has_stream: int) -> Tuple[str, Optional[str]]:
+    proc = raw_names[4:4 + proc_len].decode("utf-8", "replace")
+    stream = raw_names[4 + proc_len:].decode("utf-8", "replace") if has_stream else None
+    # No stream and an empty one look the same - neither is kept.
+    if stream and len(self._names) < 256:
+      self._names[raw_names] = (proc, stream)
+      pass
+    return proc, stream
+
+  def take_events(self) -> List[FramedDriverEvent]:
+    events, self._events = self._events, []
+    return events
+  pass
+
+
 #
 # ops/runner.py + ops/json_ui.py's progress protocol: the overall status of a
-# Runner plus the status of every task it holds. Sent whole on every report -
-# there is exactly one machine involved (the disk being rewritten IS the
-# server), so there is no reason to send only a delta and reconstruct state
-# on the receiving end.
+# Runner plus the status of every task it holds. The plan (report="tasks")
+# goes out whole. After that, json_ui sends deltas: the run totals, and only
+# the steps that changed since its last report - a sync of 30+ tasks used to
+# re-send all of them on every tick. RunnerOutputDispatch puts the whole
+# snapshot back together (merge_progress) for the REST status routes and the
+# browser, so those still only ever see whole reports.
 #
 TaskState = Literal["waiting", "running", "done", "fail"]
 
@@ -132,6 +327,7 @@ class TaskStatus(BaseModel):
   taskMessage: Optional[str] = None
   taskExplain: str
   taskVerdict: List[str] = []
+  taskBytes: Optional[int] = None          # bytes copied/written so far, for tasks that know
 
   model_config = ConfigDict(from_attributes=True)
   pass
@@ -150,6 +346,7 @@ class OperationProgress(BaseModel):
   runTime: float = 0
   step: Optional[int] = None               # which task just changed, informational only
   tasks: List[TaskStatus] = []
+  delta: bool = False                      # tasks holds only the steps that changed
 
   model_config = ConfigDict(from_attributes=True)
   pass
@@ -163,6 +360,40 @@ class OperationEnvelope(BaseModel):
   pass
 
 
+def merge_progress(snapshot: dict, update: OperationProgress) -> dict:
+  """Applies a delta report to the last whole one (both as model_dump(mode="json")
+  dicts), and returns the new whole one. A changed step replaces every
+  entry of that step - a task with describe_subtasks() has several."""
+  merged = update.model_dump(mode="json")
+  merged["delta"] = False
+  if not update.delta:
+    return merged
+
+  changed: Dict[int, List[dict]] = {}
+  for row in merged["tasks"]:
+    changed.setdefault(row["step"], []).append(row)
+    pass
+
+  tasks = []
+  for row in snapshot.get("tasks", []):
+    step = row["step"]
+    if step not in changed:
+      tasks.append(row)
+    elif changed[step] is not None:
+      tasks.extend(changed[step])
+      changed[step] = None
+      pass
+    pass
+  # Steps the snapshot doesn't have yet
+  for step in sorted(changed):
+    if changed[step] is not None:
+      tasks.extend(changed[step])
+      pass
+    pass
+  merged["tasks"] = tasks
+  return merged
+
+
 def idle_operation_progress(device: str = "") -> OperationProgress:
   """The 'nothing has run yet' placeholder for a load/save/sync/wipe status endpoint."""
   return OperationProgress(report="tasks", device=device, runStatus=RunState.Initial,
@@ -9,7 +9,9 @@ from .tasks import task_fetch_partitions, task_refresh_partitions, task_set_fat_
 from .partition_runner import PartitionDiskRunner
 from ..components.video import detect_video_cards
 from ..components.disk import create_storage_instance
-from .partclone_tasks import task_restore_disk_image
+from .partclone_tasks import task_restore_disk_image, task_restore_disk_images
+from .runner import Runner
+from .run_state import RunState
 from ..lib.util import get_triage_logger
 from .json_ui import json_ui
 from ..const import const
@@ -84,21 +86,38 @@ class RestoreDiskRunner(PartitionDiskRunner):
 
     # once the partitioning is done, refresh the partition
     self.tasks.append(task_fetch_partitions("Fetch disk information", disk))
-    self.tasks.append(task_refresh_partitions("Refresh partition information", disk))
+    refresh = task_refresh_partitions("Refresh partition information", disk)
+    self.tasks.append(refresh)
 
     # load efi
     # hack - source size is hardcoded to 4MB...
     if self.efi_source:
-      self.tasks.append(task_restore_disk_image("Load EFI System partition", disk=disk, partition_id=EFI_NAME, source=self.efi_source, source_size=2**22))
+      # The EFI partition is loaded while the main partition loads, not before.
+      self.max_parallel = 2
+      load_efi = task_restore_disk_image("Load EFI System partition", disk=disk, partition_id=EFI_NAME, source=self.efi_source, source_size=2**22)
+      load_efi.set_dependencies([refresh])
+      self.tasks.append(load_efi)
       # Loading EFI parition changes the partition ID to the previous volume id. I want to have unique ID so
       # set the ID I have to the EFI partition.
-      self.tasks.append(task_set_fat_volume_id("Set EFI partition UUID", disk=disk, partition_id=EFI_NAME))
-      # This should now match the previous volume ID so this isn't needed.
-      self.tasks.append(task_refresh_partitions("Refresh partition information", disk))
+      set_efi_id = task_set_fat_volume_id("Set EFI partition UUID", disk=disk, partition_id=EFI_NAME)
+      set_efi_id.set_dependencies([load_efi])
+      self.tasks.append(set_efi_id)
       pass
 
     # load disk image
-    self.tasks.append(task_restore_disk_image("Load disk image", disk=disk, partition_id=partition_id, source=self.source, source_size=self.source_size))
+    # The catalog's .disk_image_type.json can pick restore_volume's engine,
+    # e.g. "restore_engine": "inprocess".
+    self.load_task = task_restore_disk_image("Load disk image", disk=disk, partition_id=partition_id, source=self.source, source_size=self.source_size,
+                                             engine=self.restore_type.get("restore_engine"))
+    self.load_task.set_dependencies([refresh])
+    self.tasks.append(self.load_task)
+
+    if self.efi_source:
+      # This should now match the previous volume ID so this isn't needed.
+      # Waits for both loads (everything before it) so it doesn't read a
+      # partition half written.
+      self.tasks.append(task_refresh_partitions("Refresh partition information", disk))
+      pass
 
     # Make sure it went right. If this is a bad disk, this should catch it.
     self.tasks.append(task_fsck("fsck partition", disk=disk, partition_id=partition_id, payload_size=self.source_size/4, fix_file_system=True))
@@ -180,6 +199,106 @@ class RestoreDiskRunner(PartitionDiskRunner):
   pass
 
 
+class BatchRestoreRunner(Runner):
+  '''Restores one image to several disks. Each disk gets its RestoreDiskRunner's
+tasks, except loading the image itself - that's done once for all of them by
+task_restore_disk_images, so the image is fetched and decompressed once.
+
+A disk whose task fails is dropped (its teardown tasks still run) and the
+rest of the disks carry on.
+'''
+
+  def __init__(self, ui, runner_id, members):
+    super().__init__(ui, runner_id)
+    # RestoreDiskRunner per disk, not prepared yet.
+    self.members = members
+    self.failed_members = []
+    self.task_members = {}
+    self.load_task = None
+    pass
+
+  def prepare(self):
+    super().prepare()
+    before_load = []
+    after_load = []
+    for member in self.members:
+      member.prepare()
+      load_index = member.tasks.index(member.load_task)
+      for task in member.tasks[:load_index]:
+        before_load.append(self._adopt_task(member, task))
+        pass
+      for task in member.tasks[load_index+1:]:
+        after_load.append(self._adopt_task(member, task))
+        pass
+      pass
+    first = self.members[0]
+    self.load_task = task_restore_disk_images("Load disk image",
+                                              targets=[(member.disk, member.partition_id) for member in self.members],
+                                              source=first.source, source_size=first.source_size)
+    self.tasks = before_load + [self.load_task] + after_load
+    pass
+
+  def _adopt_task(self, member, task):
+    task.description = "%s: %s" % (member.disk.device_name, task.description)
+    # The member's dependencies can point at its own load task, which the
+    # shared one replaces. Here the tasks go one after another.
+    task.depends_on = None
+    self.task_members[task] = member
+    return task
+
+  def should_run_task(self, task):
+    if self.task_members.get(task) in self.failed_members and not task.teardown_task:
+      return False
+    if task is self.load_task:
+      # Disks dropped before the load don't get the image.
+      failed_disks = [member.disk for member in self.failed_members]
+      task.targets = [target for target in task.targets if target[0] not in failed_disks]
+      pass
+    return super().should_run_task(task)
+
+  def task_finished(self, task):
+    if self.interrupted:
+      return
+    if task is self.load_task:
+      # When the whole load fails, nothing got restored anywhere.
+      failed_disks = [member.disk for member in self.members] if task.progress > 100 else task.failed_disks()
+      for member in self.members:
+        if member.disk in failed_disks and member not in self.failed_members:
+          self.failed_members.append(member)
+          pass
+        pass
+      pass
+    elif task.progress > 100:
+      member = self.task_members.get(task)
+      if member is None:
+        return
+      if member not in self.failed_members:
+        self.failed_members.append(member)
+        pass
+      pass
+    else:
+      return
+
+    if len(self.failed_members) < len(self.members) and self.state == RunState.Failed:
+      # Only the failed disk is out. Keep going with the others.
+      self.ui.log(self.runner_id, "Dropping %s." % ", ".join([member.disk.device_name for member in self.failed_members]))
+      self.state = RunState.Running
+      pass
+    pass
+
+  def report_run_state(self):
+    if self.state == RunState.Success and self.failed_members:
+      # Every task ran, but not for every disk.
+      self.state = RunState.Failed
+      restored = [member.disk.device_name for member in self.members if member not in self.failed_members]
+      self.ui.log(self.runner_id, "Restored %s. Failed %s." % (", ".join(restored),
+                                                              ", ".join([member.disk.device_name for member in self.failed_members])))
+      pass
+    super().report_run_state()
+    pass
+  pass
+
+
 def get_source_size(src):
   srcst = os.stat(src)
   return srcst.st_size
@@ -188,23 +307,16 @@ def get_source_size(src):
 #
 # Running restore - loading disk image to a disk
 #
-def run_load_image(ui, devname, imagefile, imagefile_size, efisrc, newhostname, restore_type, wipe, do_it=True):
-  '''Loading image to desk.
-     :ui: User interface - instance of json_ui
-     :devname: Restroing device name
-     :imagefile: compressed partclone image file
-     :imagefile_size: Size of image file. If not known, 0 is used.
-     :newhostname: New host name assigned to the restored disk. ORIGINAL and RANDOM are special host name.
-     :restore_type: dictionary describing the restore parameter. should come from .disk_image_type.json in the image file directory.
-     :wipe: 0: no wipe, 1: quick wipe, 2: full wipe
-  '''
+def make_restore_runner(ui, devname, imagefile, imagefile_size, efisrc, newhostname, restore_type, wipe):
+  '''Makes the RestoreDiskRunner for loading image to desk. Same args as run_load_image.
+     Returns None if the restore type has no id.'''
   # Should the restore type be json or the file?
 
   disk = create_storage_instance(devname)
   
   id = restore_type.get("id")
   if id is None:
-    return
+    return None
   
   efi_image = restore_type.get(const.efi_image)
   efi_boot=efi_image is not None
@@ -292,10 +404,45 @@ def run_load_image(ui, devname, imagefile, imagefile_size, efisrc, newhostname,
 
   disk.detect_disk()
 
-  runner = RestoreDiskRunner(ui, disk.device_name, disk, imagefile, imagefile_size, efisrc,
-                             partition_id=partition_id, pplan=pplan, partition_map=partition_map,
-                             newhostname=newhostname, restore_type=restore_type, wipe=wipe,
-                             media=media, wce_share_url=wce_share_url)
+  return RestoreDiskRunner(ui, disk.device_name, disk, imagefile, imagefile_size, efisrc,
+                           partition_id=partition_id, pplan=pplan, partition_map=partition_map,
+                           newhostname=newhostname, restore_type=restore_type, wipe=wipe,
+                           media=media, wce_share_url=wce_share_url)
+
+
+#
+# Running restore - loading disk image to a disk
+#
+def run_load_image(ui, devname, imagefile, imagefile_size, efisrc, newhostname, restore_type, wipe, do_it=True):
+  '''Loading image to desk.
+     :ui: User interface - instance of json_ui
+     :devname: Restroing device name
+     :imagefile: compressed partclone image file
+     :imagefile_size: Size of image file. If not known, 0 is used.
+     :newhostname: New host name assigned to the restored disk. ORIGINAL and RANDOM are special host name.
+     :restore_type: dictionary describing the restore parameter. should come from .disk_image_type.json in the image file directory.
+     :wipe: 0: no wipe, 1: quick wipe, 2: full wipe
+  '''
+  runner = make_restore_runner(ui, devname, imagefile, imagefile_size, efisrc, newhostname, restore_type, wipe)
+  if runner is None:
+    return
+  runner.prepare()
+  runner.preflight()
+  runner.explain()
+  if do_it:
+    runner.run()
+    pass
+  pass
+
+
+def run_load_images(ui, devnames, imagefile, imagefile_size, efisrc, newhostname, restore_type, wipe, do_it=True):
+  '''Loading one image to several disks, fetching and decompressing it once.
+     Same as run_load_image otherwise. A given newhostname goes to every disk.
+  '''
+  members = [make_restore_runner(ui, devname, imagefile, imagefile_size, efisrc, newhostname, restore_type, wipe) for devname in devnames]
+  if None in members:
+    return
+  runner = BatchRestoreRunner(ui, ",".join(devnames), members)
   runner.prepare()
   runner.preflight()
   runner.explain()
@@ -310,7 +457,7 @@ if __name__ == "__main__":
 
   parser = argparse.ArgumentParser(description="Restore Disk image using partclone disk image.")
 
-  parser.add_argument("devname", help="Device name. This is /dev/sdX or /dev/nvmeXnX, not the partition.")
+  parser.add_argument("devname", help="Device name. This is /dev/sdX or /dev/nvmeXnX, not the partition. Comma separated device names restore the image to all of them at once.")
   parser.add_argument("imagesource", help="Image source file. File path or URL.")
   parser.add_argument("imagesize", type=int, help="Size of image. If this the disk image file is on disk, size can be 0, and the loader gets the actual file size.")
   parser.add_argument("restore_type", help="Restore type. This can be a path to the disk image metadata file or a keyword.")
@@ -393,9 +540,10 @@ if __name__ == "__main__":
     efi_source = None
     pass
   
+  devnames = [devname for devname in args.devname.split(",") if devname]
   try:
-    run_load_image(ui,
-                   args.devname,
+    (run_load_image if len(devnames) == 1 else run_load_images)(ui,
+                   devnames[0] if len(devnames) == 1 else devnames,
                    src,
                    args.imagesize,
                    efi_source,
@@ -10,6 +10,7 @@
 #
 
 import datetime, traceback
+import os, select, errno
 import signal
 
 from .run_state import RunState
@@ -20,7 +21,14 @@ from .tasks import op_task
 # Base class for runner
 #
 class Runner:
-  
+
+  # Seconds between progress reports while a task runs
+  progress_report_interval = 0.75
+
+  # How many tasks run at once. Tasks wait for their depends_on (by default,
+  # every task before them) and don't share resources with a running task.
+  max_parallel = 1
+
   def __init__(self, ui, runner_id):
     self.state = RunState.Initial
     self.ui = ui
@@ -41,6 +49,12 @@ class Runner:
     # runner's current time
     self.current_time = None
 
+    # Set when a signal stopped the run, as opposed to a task failing.
+    self.interrupted = False
+
+    # wake() writes here to cut the wait between polls short.
+    self._wake_read = None
+    self._wake_write = None
     pass
 
   def prepare(self):
@@ -73,6 +87,14 @@ class Runner:
       task_number += 1
       pass
 
+    # Dependencies come first in the list, so there's no cycle to wait on.
+    for task in self.tasks:
+      for other in task.depends_on or []:
+        if other.runner is not self or other.task_number >= task.task_number:
+          raise Exception("%s depends on a task that doesn't come before it" % task.description)
+        pass
+      pass
+
     # This gives a chance for tasks to know the neighbors.
     for task in self.tasks:
       task.preflight(self.tasks)
@@ -121,34 +143,73 @@ class Runner:
     self.state = RunState.Running
     def kill_handler(signum, frame):
       self.ui.log(self.runner_id, "Received signal %d" % signum)
+      self.interrupted = True
       self.state = RunState.Failed
       pass
     signal.signal(signal.SIGINT, kill_handler)
 
+    self._wake_read, self._wake_write = os.pipe()
+    os.set_blocking(self._wake_write, False)
+
     self.start_time = datetime.datetime.now()
-    while self.task_step < len(self.tasks):
-      self.report_run_state()
-
-      task = self.tasks[self.task_step]
-
-      if self.state == RunState.Running or task.teardown_task:
-        try:
-          self._run_task(task, self.ui)
-        except Exception as exc:
-          self.state = RunState.Failed
-          tb = traceback.format_exc()
-          fail_msg = "Task: " + task.description + "\n" + tb
-          self.ui.log(self.runner_id, fail_msg)
-          task.verdict.append(tb)
-          task.set_progress(999, 'Task failed due to internal error. See details/logging.')
+    pending = list(self.tasks)
+    running = []
+    finished = set()
+    last_progress_time = self.start_time
+
+    while pending or running:
+      # Start what can start, in list order.
+      for task in list(pending):
+        if len(running) >= self.max_parallel:
+          break
+        if not self._is_ready(task, running, finished):
+          continue
+        pending.remove(task)
+        if self._start_task(task):
+          running.append(task)
+        else:
+          finished.add(task)
           pass
         pass
-      else:
+
+      if not running:
+        # preflight() made sure dependencies come first, so this is the end.
+        break
+
+      for task in list(running):
+        if self._poll_task(task):
+          running.remove(task)
+          finished.add(task)
+          self.task_finished(task)
+          pass
         pass
 
-      self.task_step = self.task_step + 1
+      if not running:
+        continue
+
+      self.task_step = running[0].task_number
+      since_report = in_seconds(self.current_time - last_progress_time)
+      if since_report >= self.progress_report_interval:
+        last_progress_time = self.current_time
+        since_report = 0
+        self._update_run_estimate()
+
+        # When the poll comes back too fast, this creates a lot of traffic.
+        # Need to tame down a little
+        self.report_task_progress(self.current_time - self.start_time, running[0])
+        pass
+
+      # Nothing to do until a task has something, or the next report is due.
+      self._wait_for_tasks(running, self.progress_report_interval - since_report)
       pass
 
+    self.task_step = len(self.tasks)
+
+    wake_read, wake_write = self._wake_read, self._wake_write
+    self._wake_read = self._wake_write = None
+    os.close(wake_read)
+    os.close(wake_write)
+
     if self.state == RunState.Running:
       self.state = RunState.Success
       pass
@@ -156,56 +217,138 @@ class Runner:
     pass
 
 
+  def should_run_task(self, task):
+    '''Once something failed, only the teardown tasks run.'''
+    return self.state == RunState.Running or task.teardown_task
+
+  def task_finished(self, task):
+    '''Called after a task ran, whether it failed or not.'''
+    pass
+
+  def _is_ready(self, task, running, finished):
+    if task.depends_on is None:
+      # Everything before it.
+      if any(other not in finished for other in self.tasks[:task.task_number]):
+        return False
+      pass
+    elif any(other not in finished for other in task.depends_on):
+      return False
+    for other in running:
+      if task.resources & other.resources:
+        return False
+      pass
+    return True
+
+  def wake(self):
+    '''Makes the running tasks' wait end now, so they're polled right away.
+    Safe to call from any thread.'''
+    wake_write = self._wake_write
+    if wake_write is not None:
+      try:
+        os.write(wake_write, b'x')
+      except (BlockingIOError, OSError):
+        # Full means a wake up is pending already.
+        pass
+      pass
+    pass
+
+  def _wait_for_tasks(self, tasks, timeout):
+    '''Waits until one of the tasks' wait_fds() is readable, a task calls
+    notify(), or timeout seconds - whichever comes first.'''
+    wait_set = []
+    for task in tasks:
+      if task.poll_interval is not None:
+        timeout = min(timeout, task.poll_interval)
+        pass
+      wait_set.extend(task.wait_fds())
+      pass
+    if timeout <= 0:
+      return
+    if self._wake_read is not None:
+      wait_set.append(self._wake_read)
+      pass
+    try:
+      rlist, _, _ = select.select(wait_set, [], [], timeout)
+    except OSError as exc:
+      # A signal (our SIGINT handler) cuts the wait short - that's fine.
+      if exc.errno != errno.EINTR:
+        raise
+      return
+    if self._wake_read in rlist:
+      os.read(self._wake_read, 4096)
+      pass
+    pass
+
   def report_task_progress(self, run_time, task):
     self.ui.report_task_progress(self.runner_id, self.current_time, self.run_estimate, run_time, task, self.tasks)
     pass
 
 
-  def _run_task(self, task: op_task, ui):
-    task.pre_setup()
-    task.setup()
-    current_time = task.start_time
+  def _start_task(self, task: op_task):
+    '''Sets up the task. Returns True when it needs polling, False when it
+    was skipped or is over already.'''
+    self.task_step = task.task_number
+    self.report_run_state()
+
+    if not self.should_run_task(task):
+      return False
+
+    try:
+      task.pre_setup()
+      task.setup()
+    except Exception:
+      self._task_crashed(task)
+      self.task_finished(task)
+      return False
+
     self.current_time = task.start_time
-    run_time = self.current_time - self.start_time
-    last_progress_time = current_time
+    self.report_task_progress(self.current_time - self.start_time, task)
+    if task.progress >= 100:
+      self.task_finished(task)
+      return False
+    return True
 
-    self.report_task_progress(run_time, task)
 
-    while task.progress < 100:
+  def _poll_task(self, task: op_task):
+    '''Polls the task once. Returns True when it's done.'''
+    try:
       task.poll()
       current_time = datetime.datetime.now()
       task.current_time = current_time
       self.current_time = current_time
       run_time = current_time - self.start_time
 
-      if in_seconds(current_time - last_progress_time) >= 0.75:
-        last_progress_time = current_time
-        self._update_run_estimate()
-
-        # When the poll comes back too fast, this creates a lot of traffic.
-        # Need to tame down a little
-        self.report_task_progress(run_time, task)
-        pass
-
       # Update the estimate time with actual elapsed time.
       if task.progress >= 100:
         task.teardown()
         pass
+    except Exception:
+      self._task_crashed(task)
+      return True
 
-      if task.progress > 100:
-        # something went wrong.
-        self.state = RunState.Failed
-        ui.report_task_failure(self.runner_id, self.current_time, run_time, task, self.tasks)
-        if task.verdict:
-          self.ui.log(self.runner_id, "%s failed.\n%s" % (task.description, "\n".join(task.verdict)))
-          pass
-        break
-
-      if task.progress == 100:
-        # done
-        ui.report_task_success(self.runner_id, self.current_time, run_time, task, self.tasks)
+    if task.progress > 100:
+      # something went wrong.
+      self.state = RunState.Failed
+      self.ui.report_task_failure(self.runner_id, self.current_time, run_time, task, self.tasks)
+      if task.verdict:
+        self.ui.log(self.runner_id, "%s failed.\n%s" % (task.description, "\n".join(task.verdict)))
         pass
-      pass
+      return True
+
+    if task.progress == 100:
+      # done
+      self.ui.report_task_success(self.runner_id, self.current_time, run_time, task, self.tasks)
+      return True
+    return False
+
+
+  def _task_crashed(self, task):
+    self.state = RunState.Failed
+    tb = traceback.format_exc()
+    fail_msg = "Task: " + task.description + "\n" + tb
+    self.ui.log(self.runner_id, fail_msg)
+    task.verdict.append(tb)
+    task.set_progress(999, 'Task failed due to internal error. See details/logging.')
     pass
 
   def log(self, task, msg):
@@ -46,18 +46,34 @@ For now, this is only dealing with the EXT4 linux partition.
       self.scoreboard[disk.device_name] = {"total_size": 0, "completed_size": 0, "inflight_size" : 0, "completed_seconds": 0, "inflight_seconds": 0, "bps": 0}
       pass
 
+    # Getting the disks ready is one chain of tasks per disk, and the chains
+    # don't wait for each other.
+    self.max_parallel = max(1, len(self.disks))
+    mounts = {}
     for disk in self.disks:
-      self.tasks.append(task_fetch_partitions("Fetch partitions on %s" % disk.device_name , disk=disk))
-      self.tasks.append(task_refresh_partitions("Refresh partitions on %s" % disk.device_name, disk=disk))
-      self.tasks.append(task_mount("Mount the disk %s" % disk.device_name, disk=disk, partition_id=self.partition_id, add_mount_point=self.add_mount_point))
+      fetch = task_fetch_partitions("Fetch partitions on %s" % disk.device_name , disk=disk)
+      fetch.set_dependencies([])
+      refresh = task_refresh_partitions("Refresh partitions on %s" % disk.device_name, disk=disk)
+      refresh.set_dependencies([fetch])
+      mount = task_mount("Mount the disk %s" % disk.device_name, disk=disk, partition_id=self.partition_id, add_mount_point=self.add_mount_point)
+      mount.set_dependencies([refresh])
+      for task in [fetch, refresh, mount]:
+        task.add_resources(disk.device_name)
+        self.tasks.append(task)
+        pass
+      mounts[disk.device_name] = mount
       pass
 
-    task = task_image_sync_delete("Delete unwanted disk images", keepers=self.sources, testflight=self.testflight)
-    self.tasks.append(task)
-    self.sync_tasks.append(task)
+    # The delete goes through every mounted disk.
+    delete_task = task_image_sync_delete("Delete unwanted disk images", keepers=self.sources, testflight=self.testflight)
+    delete_task.set_dependencies(mounts.values())
+    self.tasks.append(delete_task)
+    self.sync_tasks.append(delete_task)
 
     for disk in self.disks:
       sync_meta_task = task_image_sync_metadata("Sync metadata on %s" % disk.device_name, disk=disk, testflight=self.testflight)
+      sync_meta_task.set_dependencies([mounts[disk.device_name], delete_task])
+      sync_meta_task.add_resources(disk.device_name)
       self.tasks.append(sync_meta_task)
       self.sync_tasks.append(sync_meta_task)
       pass
@@ -15,7 +15,7 @@ from typing import Optional
 from ..lib import in_seconds
 from ..lib.util import get_triage_logger
 from .run_state import RunState
-from .protocol import ProgressReport, ProgressEnvelope, DriverEvent, DriverEventType, split_lines
+from .protocol import ProgressReport, ProgressEnvelope, DriverEvent, DriverEventType, parse_lines, driver_framing_requested
 from ..lib.disk_images import list_image_files
 from .tasks import op_task_process_simple
 
@@ -36,6 +36,11 @@ class task_image_sync:
   def update_time_estimate(self):
     pass
 
+  def update_bytes_done(self, reports):
+    """What the destinations have so far, together - the latest report of each."""
+    self.bytes_done = sum(report.totalBytes or 0 for report in reports)
+    pass
+
   pass
 
 
@@ -130,6 +135,8 @@ class task_image_sync_copy(op_task_process_simple, task_image_sync):
 
     source_filename = self.source["name"]
     argv = bin + ['-m', 'wce_triage.bin.fanout_copy', self.source["fullpath"]]
+    # Each destination copies at its own pace (see fanout_copy's lag window)
+    self.device_reports = {}
     super().__init__(description,
                      argv=argv,
                      progress_finished="Image file %s copied" % source_filename,
@@ -178,11 +185,11 @@ class task_image_sync_copy(op_task_process_simple, task_image_sync):
     self.pares_fanout_copy_progress()
     # Same guard as task_image_rsync.poll() below: self.progress here comes
     # purely from parsing relayed progress text, not from the outer
-    # `fanout_copy.py` driver process actually exiting. Runner._run_task()'s
-    # `while task.progress < 100` loop treats progress==100 as authoritative
-    # and moves on immediately, so don't let it reach 100 until
-    # self.process.returncode (set by _poll_process()'s process.poll()
-    # above) confirms the OS process has really returned.
+    # `fanout_copy.py` driver process actually exiting. Runner._poll_task()
+    # treats progress==100 as authoritative and moves on immediately, so
+    # don't let it reach 100 until self.process.returncode (set by
+    # _poll_process()'s process.poll() above) confirms the OS process has
+    # really returned.
     if self.progress >= 100 and self.process.returncode is None:
       self.progress = 99
       pass
@@ -190,20 +197,23 @@ class task_image_sync_copy(op_task_process_simple, task_image_sync):
 
   def pares_fanout_copy_progress(self):
     #
-    if len(self.err) == 0:
+    lines = self.err_buffer.take_lines()
+    if not lines:
       return
 
-    lines, self.err = split_lines(self.err)
     last_report: Optional[ProgressReport] = None
-    for line in lines:
+    for line, envelope in zip(lines, parse_lines(ProgressEnvelope, lines)):
       if not line:
         continue
 
       # each line is an NDJSON envelope: {"event": "fanoutcopy", "message": ProgressReport}
       try:
-        report = ProgressEnvelope.model_validate_json(line).message
+        if envelope is None:
+          raise ValueError("Not a progress report.")
+        report = envelope.message
         device_name = report.key
         self.scoreboard[device_name]["report"] = report
+        self.device_reports[device_name] = report
         last_report = report
 
         if report.verdict:
@@ -235,7 +245,15 @@ class task_image_sync_copy(op_task_process_simple, task_image_sync):
         pass
       pass
 
-    if last_report:
+    # A fast destination finishes before the slow ones, so the task is only
+    # as far along as the slowest destination still copying.
+    self.update_bytes_done(self.device_reports.values())
+    running = [report for report in self.device_reports.values() if report.runStatus == RunState.Running]
+    if running:
+      slowest = min(running, key=lambda report: report.progress)
+      self.set_progress(slowest.progress, slowest.runMessage)
+      self.set_time_estimate(max(report.runEstimate for report in running))
+    elif last_report:
       report = last_report
       self.set_progress(report.progress, report.runMessage)
       self.set_time_estimate(report.runEstimate)
@@ -318,12 +336,14 @@ class task_image_rsync(op_task_process_simple, task_image_sync):
 
     source_filename = self.source["name"]
     argv = bin + ['-m', 'wce_triage.bin.rsync_copy', self.source["fullpath"]]
+    self.device_reports = {}
     super().__init__(description,
                      argv=argv,
                      progress_finished="Image file %s copied" % source_filename,
                      time_estimate=100,
                      **kwargs)
     task_image_sync.__init__(self, description)
+    self.driver_framing = driver_framing_requested()
     pass
 
   def preflight(self, tasks):
@@ -387,16 +407,14 @@ class task_image_rsync(op_task_process_simple, task_image_sync):
       pass
     pass
 
-  def _parse_rsync_line(self, line: str, dt_elapsed: float, source_size: int) -> Optional[ProgressReport]:
-    # The synthetic "no copy needed" line is a bare ProgressReport (no envelope).
-    try:
+  def _parse_rsync_line(self, line: Optional[str], event: Optional[DriverEvent], dt_elapsed: float, source_size: int) -> Optional[ProgressReport]:
+    # event is the line parsed as DriverEvent, None if it's not one.
+    if event is None:
+      # The synthetic "no copy needed" line is a bare ProgressReport (no envelope).
       return ProgressReport.model_validate_json(line)
-    except Exception:
-      pass
 
     # Everything else is a DriverEvent from process_driver.py: proc is "<device>:<dest>[:]",
     # rsync's own "--info=progress2" text is carried verbatim in .line.
-    event = DriverEvent.model_validate_json(line)
     device_name = event.proc.split(":")[0]
 
     if event.type == DriverEventType.start:
@@ -453,25 +471,26 @@ class task_image_rsync(op_task_process_simple, task_image_sync):
 
   def parse_rsync_copy_progress(self):
     #
-    if len(self.err) == 0:
+    events = self.take_driver_events()
+    if not events:
       return
 
     source_size = self.source["size"]
-    lines, self.err = split_lines(self.err)
     last_report: Optional[ProgressReport] = None
 
-    for line in lines:
-      if not line:
+    for line, event in events:
+      if not line and event is None:
         continue
       current_time = datetime.datetime.now()
       dt_elapsed = in_seconds(current_time - self.start_time)
 
       try:
-        report = self._parse_rsync_line(line, dt_elapsed, source_size)
+        report = self._parse_rsync_line(line, event, dt_elapsed, source_size)
 
         if report:
           last_report = report
           device_name = report.key
+          self.device_reports[device_name] = report
 
           scoreboard = self.scoreboard[device_name]
           if report.runStatus == RunState.Running:
@@ -491,7 +510,7 @@ class task_image_rsync(op_task_process_simple, task_image_sync):
           scoreboard["bps"] = 1
         pass
       except Exception as exc:
-        msg = "Output line: '" + line + "'\n" + traceback.format_exc()
+        msg = "Output line: '" + (line if line is not None else repr(event)) + "'\n" + traceback.format_exc()
         tlog.info("Image copy: "+ msg)
         self.verdict.append(msg)
         pass
@@ -499,6 +518,7 @@ class task_image_rsync(op_task_process_simple, task_image_sync):
 
     if last_report:
       report = last_report
+      self.update_bytes_done(self.device_reports.values())
       self.set_progress(report.progress, report.runMessage)
       self.set_time_estimate(report.runEstimate)
       pass
@@ -7,22 +7,24 @@
 # exec runs through the tasks.
 #
 
-import datetime, re, subprocess, abc, os, select, uuid, json, traceback, shutil
+import datetime, re, subprocess, abc, os, select, uuid, json, traceback, shutil, codecs
 import signal
 import struct
 import errno
 import sys
-from typing import Optional
+from typing import List, Optional, Tuple, Union
 import io
 
 from .run_state import RunState
-from .protocol import ProgressEnvelope, TaskStatus, split_lines
+from .protocol import (ProgressEnvelope, TaskStatus, DriverEvent, DriverFrameDecoder, FramedDriverEvent, parse_lines,
+                       DRIVER_FRAMING_ENV, DRIVER_FRAMING_STRUCT)
 from ..components.pci import find_pci_device_node
-from ..components.disk import Partition, PartitionLister
+from ..components.disk import Partition, PartitionLister, BusType
 from ..components.network import detect_net_devices, get_router_ip_address
 from ..lib.util import get_triage_logger, get_filename_stem
 from ..lib.timeutil import in_seconds
 from ..lib.grub import grub_config
+from ..lib.output_buffer import OutputBuffer, OUTPUT_HEAD_LINES, OUTPUT_MAX_BYTES
 from .pplan import EFI_NAME
 from ..version import TRIAGE_VERSION, TRIAGE_TIMESTAMP
 from ..const import const
@@ -33,6 +35,12 @@ tlog = get_triage_logger()
 class op_task(object, metaclass=abc.ABCMeta):
   """Task is a unit of oction"""
 
+  # Between poll() calls, the runner waits for one of wait_fds() to turn
+  # readable or for notify(), but no longer than this many seconds. None
+  # waits for those alone (and the next progress report) - for a task that
+  # is fully asynchronous and says when it has something.
+  poll_interval = 0.1
+
   def __init__(self, description, encoding='utf-8', time_estimate=None, estimate_factors=None, **kwargs):
     if not isinstance(description, str):
       raise Exception("Description must be a string")
@@ -48,9 +56,16 @@ class op_task(object, metaclass=abc.ABCMeta):
     self.progress = 0
     self.message = None # Progress message
     self.verdict = [] # Important messages
+    self.bytes_done = None # Bytes copied/written so far, for tasks that know
     self.start_time = None
     self.end_time = None
     self.teardown_task = False
+    # Tasks this one waits for. None means every task before it in the
+    # runner's list - one after another. See Runner.max_parallel.
+    self.depends_on = None
+    # What the task holds while it runs, e.g. a disk's device name. Tasks
+    # sharing a resource never run at the same time.
+    self.resources = set()
     # file descriptors
     self.read_set = None 
 
@@ -122,11 +137,37 @@ class op_task(object, metaclass=abc.ABCMeta):
     self.teardown_task = True
     pass
 
+  def set_dependencies(self, tasks) -> None:
+    """Declare the tasks this one waits for, instead of every task before it.
+    They must come before this one in the runner's list. With an empty list,
+    the task runs as soon as the runner has room for it."""
+    self.depends_on = list(tasks)
+    pass
+
+  def add_resources(self, *resources) -> None:
+    """Declare what the task holds while it runs - disk or partition device
+    names. The runner doesn't run two tasks holding the same one at once."""
+    self.resources.update(resources)
+    pass
+
   @abc.abstractmethod
   def poll(self):
     """poll is called while the execution is going on"""
     pass
 
+  def wait_fds(self):
+    """fds (or objects with fileno()) whose readability means poll() has
+    something to do. The runner waits on them between poll() calls."""
+    return []
+
+  def notify(self):
+    """Has the runner poll this task right away, instead of at the end of
+    its wait. Safe to call from any thread."""
+    if self.runner is not None:
+      self.runner.wake()
+      pass
+    pass
+
   def get_description(self):
     return self.description
 
@@ -260,23 +301,65 @@ class op_task_process(op_task):
   select_timeout: float
   good_returncode: list
   read_set: list
-  out: str
-  err: str
+  out_buffer: OutputBuffer
+  err_buffer: OutputBuffer
+  err_frames: Optional[DriverFrameDecoder]
 
-  def __init__(self, description, argv=None, select_timeout=1, **kwargs):
+  # Bytes read from a pipe at a time
+  read_size = 2 ** 16
+
+  def __init__(self, description, argv=None, select_timeout=1,
+               output_head_lines=OUTPUT_HEAD_LINES, output_max_bytes=OUTPUT_MAX_BYTES, **kwargs):
     super().__init__(description, **kwargs)
 
     self.argv = argv
     self.process = None
+    # Readable when the process exits, so the runner wakes up for it.
+    self._pidfd = None
     self.stdout = None
     self.stderr = None
     self._kill_count = 0
     self.select_timeout = select_timeout
     self.good_returncode = [0]
     self.read_set = []
-    self.out = ""
-    self.err = ""
-    pass
+    # How much of stdout/stderr is kept, each
+    self.output_head_lines = output_head_lines
+    self.output_max_bytes = output_max_bytes
+    # The process is a process_driver, and its DriverEvents come as frames
+    # (see protocol.DRIVER_FRAMING_ENV). Set by a task that reads them with
+    # take_driver_events().
+    self.driver_framing = False
+    self._reset_output()
+    pass
+
+  def _reset_output(self):
+    self.out_buffer = OutputBuffer(head_lines=self.output_head_lines, max_bytes=self.output_max_bytes)
+    self.err_buffer = OutputBuffer(head_lines=self.output_head_lines, max_bytes=self.output_max_bytes)
+    self.err_frames = DriverFrameDecoder() if self.driver_framing else None
+    # A multibyte character can straddle two reads.
+    self._decoders = {}
+    pass
+
+  @property
+  def out(self) -> str:
+    """stdout kept so far, not counting the lines taken with take_lines()."""
+    return self.out_buffer.text()
+
+  @property
+  def err(self) -> str:
+    """stderr kept so far, not counting the lines taken with take_lines()."""
+    return self.err_buffer.text()
+
+  def take_driver_events(self) -> List[Tuple[Optional[str], Union[DriverEvent, FramedDriverEvent, None]]]:
+    """The stderr lines taken so far, each with the DriverEvent it is - None
+    for a line that isn't one - and then the events that came as frames,
+    with None for the line."""
+    lines = self.err_buffer.take_lines()
+    taken = list(zip(lines, parse_lines(DriverEvent, lines)))
+    if self.err_frames is not None:
+      taken.extend((None, event) for event in self.err_frames.take_events())
+      pass
+    return taken
 
   def is_success(self) -> Optional[bool]:
     if self.process.returncode is None:
@@ -299,17 +382,37 @@ class op_task_process(op_task):
   def setup(self):
     tlog.debug( "op_task_process Poepn: " + repr(self.argv))
     self.verdict.append("Process: " + repr(self.argv))
-    self.process = subprocess.Popen(self.argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL)
+    # Frames only go to a task that reads them.
+    env = None
+    if self.driver_framing:
+      env = dict(os.environ)
+      env[DRIVER_FRAMING_ENV] = DRIVER_FRAMING_STRUCT
+    elif DRIVER_FRAMING_ENV in os.environ:
+      env = {name: value for name, value in os.environ.items() if name != DRIVER_FRAMING_ENV}
+      pass
+    self.process = subprocess.Popen(self.argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL, env=env)
     self.stdout = self.process.stdout
     self.stderr = self.process.stderr
     self.read_set = [self.stdout, self.stderr]
-    self.out = ""
-    self.err = ""
+    self._reset_output()
+    if hasattr(os, "pidfd_open"):
+      try:
+        self._pidfd = os.pidfd_open(self.process.pid)
+        # Pipes and the exit is all there is to wait for.
+        self.poll_interval = None
+      except OSError:
+        pass
+      pass
     super().setup()
     assert(self.argv is not None)
     pass
 
 
+  def wait_fds(self):
+    if self._pidfd is not None:
+      return self.read_set + [self._pidfd]
+    return self.read_set
+
   def _poll_process(self):
     #
     if self.runner and self.runner.state != RunState.Running:
@@ -323,43 +426,86 @@ class op_task_process(op_task):
       pass
 
     # check the process but not be blocked.
-    self.process.poll()
+    exited = self.process.poll() is not None
+
+    # The runner already waited for wait_fds(), so this only picks up what's
+    # ready. Polled by hand, with no runner, it waits here.
+    self._read_ready_pipes(0 if self.runner is not None else self.select_timeout)
 
+    if exited:
+      if self._pidfd is not None:
+        os.close(self._pidfd)
+        self._pidfd = None
+        pass
+      # Whatever it printed last is in the pipes still. Have it all before
+      # the task is reported done - within reason, in case something it
+      # left behind keeps writing.
+      for _ in range(64):
+        if not (self.read_set and self._read_ready_pipes(0)):
+          break
+        pass
+      pass
+    pass
+
+  def teardown(self):
+    if self._pidfd is not None:
+      os.close(self._pidfd)
+      self._pidfd = None
+      pass
+    super().teardown()
+    pass
+
+  def _read_ready_pipes(self, timeout):
+    '''Reads the pipes that are readable within timeout. Returns whether any was.'''
     selecting = True
     while selecting:
       selecting = False
       rlist = wlist = xlist = None
       try:
-        rlist, wlist, xlist = select.select(self.read_set, [], [], self.select_timeout)
+        rlist, wlist, xlist = select.select(self.read_set, [], [], timeout)
       except select.error as exc:
         if exc.args[0] == errno.EINTR:
           selecting = True
-          pass
+          continue
         raise
       pass
-      
-    for pipe in self.read_set:
+
+    for pipe in list(self.read_set):
       if pipe in rlist:
         self._read_from_pipe(pipe)
         pass
       pass
-    pass
+    return bool(rlist)
 
   def _read_from_pipe(self, pipe):
-    data = os.read(pipe.fileno(), 1024)
+    data = os.read(pipe.fileno(), self.read_size)
+    decoder = self._decoders.get(pipe)
+    if decoder is None:
+      decoder = self._decoders[pipe] = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+      pass
     if data == b'':
       self.read_set.remove(pipe)
+      text = decoder.decode(b'', final=True)
+    else:
+      if pipe == self.stderr and self.err_frames is not None:
+        data = self.err_frames.feed(data)
+        pass
+      text = decoder.decode(data)
       pass
-    data = data.decode(self.encoding)
     if pipe == self.stdout:
-      self.out = self.out + data
+      self.out_buffer.feed(text)
     else:
-      self.err = self.err + data
+      self.err_buffer.feed(text)
       pass
     pass
 
   def _update_progress(self):
     completion = self.is_success()
+    if completion is not None:
+      # Joined once - both go to the log and the verdict.
+      out = self.out
+      err = self.err
+      pass
     if completion is None:  # still running
       # Let's fake it.
       wallclock = datetime.datetime.now()
@@ -373,12 +519,12 @@ class op_task_process(op_task):
       pass
     elif completion:  # success
       self.set_progress(100, self.kwargs.get('progress_finished', "Finished" ) )
-      if self.out:
-        out_msg = "Process stdout: " + self.out
+      if out:
+        out_msg = "Process stdout: " + out
         tlog.info(out_msg)
         pass
-      if self.err:
-        err_msg = "Process stderr: " + self.err
+      if err:
+        err_msg = "Process stderr: " + err
         tlog.info(err_msg)
         pass
       pass
@@ -390,21 +536,21 @@ class op_task_process(op_task):
         self.set_progress(999, "Failed with return code %d" % (self.process.returncode))
         log_msg = "%s failed with return code %d" % (self.description, self.process.returncode)
         pass
-      if self.out:
-        log_msg = log_msg + "\nstdout\n" + self.out
+      if out:
+        log_msg = log_msg + "\nstdout\n" + out
         pass
-      if self.err:
-        log_msg = log_msg + "\nstderr\n" + self.err
+      if err:
+        log_msg = log_msg + "\nstderr\n" + err
         pass
       tlog.info(log_msg)
       pass
 
     if completion is not None:
-      if self.out:
-        self.verdict.append("stdout: " + self.out)
+      if out:
+        self.verdict.append("stdout: " + out)
         pass
-      if self.err:
-        self.verdict.append("stderr: " + self.err)
+      if err:
+        self.verdict.append("stderr: " + err)
         pass
       pass
     pass
@@ -1977,22 +2123,60 @@ class task_uninstall_bcmwl(task_uninstall_package):
     pass
   pass
 
+#
+# bin/multiwipe.py's wipe methods
+#
+def choose_wipe_method(disk):
+  """Picks how bin/multiwipe.py wipes the disk, from how it's attached.
+  NVMe gets the kernel zero-out (NVMe Write Zeroes), a SATA/SCSI SSD that
+  takes TRIM gets discard - secure discard, or the kernel zero-out when it
+  can't, never a plain TRIM - and the rest - spinning disks, and anything
+  behind a USB bridge whose TRIM passthrough can't be trusted - get zeros
+  written the old way."""
+  if disk is None:
+    return "zero"
+  disk.detect_disk_type()
+  if disk.bus_type == BusType.NVME:
+    return "zeroout"
+  if disk.bus_type in (BusType.ATA, BusType.SCSI) and disk.is_rotational() is False and disk.supports_discard():
+    return "discard"
+  return "zero"
+
+
+def wipe_spec(device_name, method):
+  """bin/multiwipe.py's destination argument"""
+  if method == "zero":
+    return device_name
+  return "%s:%s:%s" % (device_name, device_name, method)
+
+
+def estimate_wipe_time(disk, method):
+  # The block ioctls are mostly done inside of the device.
+  speed = 40000000 if method == "zero" else 1000000000
+  return disk.get_byte_size()/speed
+
+
 #
 #
 #
 class op_task_wipe_disk(op_task_process):
   #
-  def __init__(self, description, disk=None, short=False, **kwargs):
+  def __init__(self, description, disk=None, short=False, direct_io=True, **kwargs):
     self.disk = disk
     argv = [sys.executable, "-m", "wce_triage.bin.multiwipe"]
+    if direct_io:
+      argv.append("-d")
+      pass
 
     estimate = 2
+    method = "zero"
     if short:
       argv.append("-s")
     else:
-      estimate += self.disk.get_byte_size()/40000000
+      method = choose_wipe_method(disk)
+      estimate += estimate_wipe_time(self.disk, method)
       pass
-    argv.append(disk.device_name)
+    argv.append(wipe_spec(disk.device_name, method))
     super().__init__(description, argv=argv, time_estimate=estimate, **kwargs)
     pass
 
@@ -2000,16 +2184,18 @@ class op_task_wipe_disk(op_task_process):
     super().poll()
 
     # nothing to look at.
-    if len(self.err) == 0:
+    lines = self.err_buffer.take_lines()
+    if not lines:
       return
 
     # what's coming out from multiwipe is NDJSON: {"event": "zerowipe", "message": ProgressReport}
-    lines, self.err = split_lines(self.err)
-    for line in lines:
+    for line, envelope in zip(lines, parse_lines(ProgressEnvelope, lines)):
       if not line:
         continue
       try:
-        report = ProgressEnvelope.model_validate_json(line).message
+        if envelope is None:
+          raise ValueError("Not a progress report.")
+        report = envelope.message
         self.set_progress(report.progress, report.runMessage)
         self.time_estimate = report.runEstimate
         pass
@@ -2020,7 +2206,7 @@ class op_task_wipe_disk(op_task_process):
         pass
       pass
 
-    out_lines, self.out = split_lines(self.out)
+    out_lines = self.out_buffer.take_lines()
     for line in out_lines:
       self.verdict.append(line)
       pass
@@ -2035,20 +2221,29 @@ class op_task_wipe_disk(op_task_process):
 # "tasks" list can show per-disk progress even though it's all one op_task.
 #
 class task_multiwipe(op_task_process):
-  def __init__(self, description, devices=None, short=False, disks=None, **kwargs):
+  def __init__(self, description, devices=None, short=False, disks=None, direct_io=True, **kwargs):
     self.devices = devices or []
     self.short = short
     self.device_reports = {}
 
     argv = [sys.executable, "-m", "wce_triage.bin.multiwipe"]
+    # Bypass the page cache so the progress is what's on the disk.
+    if direct_io:
+      argv.append("-d")
+      pass
     if short:
       argv.append("-s")
       pass
-    argv = argv + self.devices
 
+    disk_map = {disk.device_name: disk for disk in disks} if disks else {}
     estimate = 2
-    if not short and disks:
-      estimate += sum(disk.get_byte_size() for disk in disks) / 40000000
+    for device in self.devices:
+      disk = disk_map.get(device)
+      method = "zero" if short else choose_wipe_method(disk)
+      argv.append(wipe_spec(device, method))
+      if not short and disk:
+        estimate += estimate_wipe_time(disk, method)
+        pass
       pass
     kwargs["time_estimate"] = kwargs.get("time_estimate", estimate)
     super().__init__(description, argv=argv, **kwargs)
@@ -2061,15 +2256,17 @@ class task_multiwipe(op_task_process):
     pass
 
   def _parse_wipe_progress(self):
-    if len(self.err) == 0:
+    lines = self.err_buffer.take_lines()
+    if not lines:
       return
 
-    lines, self.err = split_lines(self.err)
-    for line in lines:
+    for line, envelope in zip(lines, parse_lines(ProgressEnvelope, lines)):
       if not line:
         continue
       try:
-        report = ProgressEnvelope.model_validate_json(line).message
+        if envelope is None:
+          raise ValueError("Not a progress report.")
+        report = envelope.message
         self.device_reports[report.key] = report
         pass
       except Exception as exc:
@@ -2079,7 +2276,7 @@ class task_multiwipe(op_task_process):
         pass
       pass
 
-    out_lines, self.out = split_lines(self.out)
+    out_lines = self.out_buffer.take_lines()
     for line in out_lines:
       self.verdict.append(line)
       pass